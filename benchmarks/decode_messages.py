@@ -0,0 +1,187 @@
+"""
+Messages decoded per second per core, by the listener's decoder and by the previous path.
+
+Builds a mix of SNEWS messages of every tier, half of them pickled models and
+half JSON (as published by different versions of the publishing tools), then
+times turning the raw payloads into archive table rows in a single process:
+
+- previous: `pickle.loads` + `model_dump()` or `json.loads`, then the field
+  by field mapping `message_to_row` used before `snews_db.decoding`;
+- decoder: `decode_payload` (restricted unpickling, orjson when installed)
+  followed by `decode_row`.
+
+    python benchmarks/decode_messages.py --messages 200000 --output decode_benchmark.json
+"""
+import json
+import pickle
+import time
+from datetime import datetime, timedelta, timezone
+
+import click
+from snews.models.messages import (
+    CoincidenceTierMessage,
+    HeartbeatMessage,
+    SignificanceTierMessage,
+    Tier,
+    TimingTierMessage,
+)
+
+from snews_db.database.models import (
+    CachedHeartbeats,
+    CoincidenceTierArchive,
+    SigTierArchive,
+    TimeTierArchive,
+)
+from snews_db.db_operations import get_machine_time, get_neutrino_time_utc, get_p_val
+from snews_db.decoding import (
+    decode_payload,
+    decode_row,
+    orjson,
+    parse_utc_datetime,
+    to_float_list,
+    to_ns_offsets,
+)
+
+# the message models only accept neutrino times of the past 48 hours
+START_TIME = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(hours=1)
+
+
+def make_models(n):
+    models = []
+    for i in range(n):
+        moment = (START_TIME + timedelta(milliseconds=i)).isoformat().replace("+00:00", "Z")
+        common = {"detector_name": f"Detector{i % 20}", "machine_time_utc": moment}
+        kind = i % 10
+        if kind < 7:
+            models.append(HeartbeatMessage(detector_status="ON", **common))
+        elif kind == 7:
+            models.append(
+                CoincidenceTierMessage(neutrino_time_utc=moment, p_val=0.07, **common)
+            )
+        elif kind == 8:
+            models.append(
+                SignificanceTierMessage(
+                    p_val=0.05, p_values=[0.4, 0.5, 0.09, 0.04], t_bin_width_sec=0.6, **common
+                )
+            )
+        else:
+            models.append(
+                TimingTierMessage(
+                    neutrino_time_utc=moment,
+                    start_time_utc=moment,
+                    timing_series=[0, 303_000_000, 658_236_000],
+                    **common,
+                )
+            )
+    return models
+
+
+def make_payloads(models):
+    payloads = []
+    for i, model in enumerate(models):
+        if i % 2:
+            payloads.append(pickle.dumps(model))
+        else:
+            payloads.append(model.model_dump_json().encode())
+    return payloads
+
+
+def previous_decode(payload):
+    if payload[:1] == b"\x80":
+        return pickle.loads(payload).model_dump()
+    return json.loads(payload)
+
+
+def previous_row(snews_message, received_time_utc):
+    """The mapping of `message_to_row` before the decoder layer, kept for comparison."""
+    message_tier = snews_message["tier"]
+    row = {
+        "message_id": snews_message["id"],
+        "message_uuid": snews_message["uuid"],
+        "received_time_utc": received_time_utc,
+        "detector_name": snews_message["detector_name"],
+        "machine_time_utc": parse_utc_datetime(
+            get_machine_time(snews_message), "machine_time_utc"
+        ),
+        "is_test": int(snews_message["is_test"]),
+    }
+    if message_tier == Tier.COINCIDENCE_TIER:
+        model_class = CoincidenceTierArchive
+        row["neutrino_time_utc"] = parse_utc_datetime(
+            snews_message["neutrino_time_utc"], "neutrino_time_utc"
+        )
+        row["p_val"] = get_p_val(snews_message)
+        row["is_firedrill"] = int(snews_message["is_firedrill"])
+    elif message_tier == Tier.SIGNIFICANCE_TIER:
+        model_class = SigTierArchive
+        row["p_val"] = get_p_val(snews_message)
+        row["p_values"] = to_float_list(snews_message["p_values"], "p_values")
+        row["t_bin_width_sec"] = float(snews_message["t_bin_width_sec"])
+    elif message_tier == Tier.HEART_BEAT:
+        model_class = CachedHeartbeats
+        row["detector_status"] = snews_message["detector_status"]
+    else:
+        model_class = TimeTierArchive
+        row["neutrino_time_utc"] = parse_utc_datetime(
+            get_neutrino_time_utc(snews_message), "neutrino_time_utc"
+        )
+        row["start_time_utc"] = (
+            parse_utc_datetime(snews_message.get("start_time_utc"), "start_time_utc")
+            or row["neutrino_time_utc"]
+        )
+        row["timing_series"] = to_ns_offsets(snews_message["timing_series"], row["start_time_utc"])
+    return model_class, row
+
+
+def previous_path(payloads, received_time_utc):
+    for payload in payloads:
+        previous_row(previous_decode(payload), received_time_utc)
+
+
+def decoder_path(payloads, received_time_utc):
+    for payload in payloads:
+        decode_row(decode_payload(payload), received_time_utc)
+
+
+def best_rate(path, payloads, repeat):
+    received_time_utc = datetime.now(timezone.utc)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        path(payloads, received_time_utc)
+        best = min(best, time.perf_counter() - start)
+    return len(payloads) / best
+
+
+@click.command()
+@click.option("--messages", type=int, default=100_000, show_default=True)
+@click.option("--repeat", type=int, default=3, show_default=True, help="Timed runs per path")
+@click.option("--output", type=click.Path(), default=None, help="Write the results as JSON")
+def main(messages, repeat, output):
+    payloads = make_payloads(make_models(messages))
+    # both paths must produce the same rows
+    received_time_utc = datetime.now(timezone.utc)
+    for payload in payloads[:100]:
+        schema, values = decode_row(decode_payload(payload), received_time_utc)
+        model_class, row = previous_row(previous_decode(payload), received_time_utc)
+        assert schema.model_class is model_class
+        assert dict(zip(schema.columns, values)) == row
+
+    results = {
+        "messages": messages,
+        "orjson": orjson is not None,
+        "previous_per_sec": best_rate(previous_path, payloads, repeat),
+        "decoder_per_sec": best_rate(decoder_path, payloads, repeat),
+    }
+    click.echo(f"{'path':<12}{'messages/s/core':>18}")
+    click.echo(f"{'previous':<12}{results['previous_per_sec']:>18,.0f}")
+    click.echo(f"{'decoder':<12}{results['decoder_per_sec']:>18,.0f}")
+    click.echo(f"speedup {results['decoder_per_sec'] / results['previous_per_sec']:.1f}x")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+"""
+Ingestion throughput, latency and memory of the database write paths.
+
+Generates a synthetic stream of SNEWS message dicts of every tier, as they
+arrive from Kafka once decoded: every detector sends heartbeats at
+`--heartbeat-rate-hz`, and alerts (coincidence, significance, timing and
+retraction messages) at `--alert-rate-hz`, with `--timing-series-length`
+entries per timing series. The stream is written to a scratch schema by each
+write path, in a fresh process so that its peak RSS is its own:
+
+- arbitrary: `write_arbitrary_message`, one transaction per message (as the
+  listener with `--batch-size 1`); limited to `--single-row-limit` messages;
+- bulk: `write_messages_bulk`, one transaction per `--batch-size` messages;
+- copy: `copy_messages`, COPY per `--batch-size` messages and table;
+- async: `write_messages_bulk` on the asyncpg engine, `--writers` batches in flight.
+
+Throughput only counts the time spent in the writers, not generating the
+messages. Latency percentiles are per write call (a message for 'arbitrary',
+a batch for the others).
+
+    python benchmarks/ingest_messages.py --messages 1000000 --output ingest_benchmark.json
+
+Compare with the results of another version, exiting with status 1 if a path
+lost more than `--max-regression` of its throughput or p99 latency:
+
+    python benchmarks/ingest_messages.py --baseline ingest_benchmark.json
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+
+import click
+from snews.models.messages import Tier
+from sqlalchemy import create_engine, func, select, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from snews_db.copy_loader import copy_messages
+from snews_db.database.models import Base
+from snews_db.db_operations import write_arbitrary_message, write_messages_bulk
+from snews_db.decoding import TIER_SCHEMAS, orjson
+
+START_TIME = datetime(2024, 1, 1, tzinfo=timezone.utc)
+PATHS = ("arbitrary", "bulk", "copy", "async")
+ALERT_TIERS = (
+    Tier.COINCIDENCE_TIER,
+    Tier.SIGNIFICANCE_TIER,
+    Tier.TIMING_TIER,
+    Tier.RETRACTION,
+)
+
+
+def utc_text(moment):
+    # nanoseconds and a 'Z' suffix, as in SNEWS messages
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.%f") + "000Z"
+
+
+def generate_messages(
+    count,
+    detectors=50,
+    heartbeat_rate_hz=1.0,
+    alert_rate_hz=0.05,
+    timing_series_length=100,
+    seed=0,
+):
+    """
+    Yields `count` SNEWS message dicts of every tier, in the order they would be received.
+
+    Time advances by one heartbeat period per round, in which every detector
+    sends a heartbeat and, with probability alert_rate_hz / heartbeat_rate_hz,
+    an alert of a random tier. The same arguments yield the same messages.
+    """
+    rng = random.Random(seed)
+    period = timedelta(seconds=1 / heartbeat_rate_hz)
+    alert_chance = alert_rate_hz / heartbeat_rate_hz
+    produced = 0
+    moment = START_TIME
+    while True:
+        for detector in range(detectors):
+            tiers = [Tier.HEART_BEAT]
+            if rng.random() < alert_chance:
+                tiers.append(rng.choice(ALERT_TIERS))
+            for tier in tiers:
+                if produced == count:
+                    return
+                produced += 1
+                machine_time = moment + timedelta(microseconds=rng.randrange(1_000_000))
+                message = {
+                    "tier": tier,
+                    "id": f"{detector}_{tier.value}_{utc_text(machine_time)}",
+                    "uuid": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                    "detector_name": f"Detector{detector}",
+                    "machine_time_utc": utc_text(machine_time),
+                    "is_test": False,
+                }
+                neutrino_time = machine_time - timedelta(seconds=rng.uniform(1, 5))
+                if tier in (Tier.HEART_BEAT, Tier.RETRACTION):
+                    message["detector_status"] = "OFF" if rng.random() < 0.01 else "ON"
+                elif tier == Tier.COINCIDENCE_TIER:
+                    message["neutrino_time_utc"] = utc_text(neutrino_time)
+                    message["p_val"] = rng.random()
+                    message["is_firedrill"] = False
+                elif tier == Tier.SIGNIFICANCE_TIER:
+                    message["p_val"] = rng.random()
+                    message["p_values"] = [rng.random() for _ in range(timing_series_length)]
+                    message["t_bin_width_sec"] = 0.5
+                else:
+                    offset = 0
+                    series = []
+                    for _ in range(timing_series_length):
+                        offset += rng.randrange(1, 10_000_000)
+                        series.append(offset)
+                    message["neutrino_time_utc"] = utc_text(neutrino_time)
+                    message["start_time_utc"] = utc_text(neutrino_time)
+                    message["timing_series"] = series
+                yield message
+        moment += period
+
+
+def chunks(messages, size):
+    iterator = iter(messages)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run_arbitrary(engine, options):
+    SessionLocal = sessionmaker(bind=engine)
+    latencies = []
+    for snews_message in generate_messages(options["single_row_limit"], **options["stream"]):
+        start = time.perf_counter()
+        with SessionLocal() as session:
+            write_arbitrary_message(session, snews_message)
+        latencies.append(time.perf_counter() - start)
+    return latencies, sum(latencies)
+
+
+def run_bulk(engine, options):
+    SessionLocal = sessionmaker(bind=engine)
+    latencies = []
+    stream = generate_messages(options["messages"], **options["stream"])
+    for batch in chunks(stream, options["batch_size"]):
+        start = time.perf_counter()
+        with SessionLocal() as session:
+            write_messages_bulk(session, batch)
+        latencies.append(time.perf_counter() - start)
+    return latencies, sum(latencies)
+
+
+def run_copy(engine, options):
+    SessionLocal = sessionmaker(bind=engine)
+    latencies = []
+    stream = generate_messages(options["messages"], **options["stream"])
+    for batch in chunks(stream, options["batch_size"]):
+        start = time.perf_counter()
+        with SessionLocal() as session:
+            copy_messages(session, batch, chunk_size=options["batch_size"])
+        latencies.append(time.perf_counter() - start)
+    return latencies, sum(latencies)
+
+
+async def _run_async(database_url, options):
+    async_engine = create_async_engine(
+        make_url(database_url).set(drivername="postgresql+asyncpg"),
+        pool_size=options["writers"],
+        connect_args={"server_settings": {"search_path": options["schema"]}},
+    )
+    AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+    batches = asyncio.Queue(maxsize=options["writers"] * 2)
+    latencies = []
+    generating = 0.0
+
+    async def write():
+        while (batch := await batches.get()) is not None:
+            start = time.perf_counter()
+            async with AsyncSessionLocal() as session:
+                await session.run_sync(write_messages_bulk, batch)
+            latencies.append(time.perf_counter() - start)
+
+    writers = [asyncio.create_task(write()) for _ in range(options["writers"])]
+    start = time.perf_counter()
+    stream = chunks(
+        generate_messages(options["messages"], **options["stream"]), options["batch_size"]
+    )
+    while True:
+        generated = time.perf_counter()
+        batch = next(stream, None)
+        generating += time.perf_counter() - generated
+        if batch is None:
+            break
+        await batches.put(batch)
+    for _ in writers:
+        await batches.put(None)
+    await asyncio.gather(*writers)
+    elapsed = time.perf_counter() - start - generating
+    await async_engine.dispose()
+    return latencies, elapsed
+
+
+def run_async(engine, options):
+    return asyncio.run(_run_async(options["database_url"], options))
+
+
+RUNNERS = {"arbitrary": run_arbitrary, "bulk": run_bulk, "copy": run_copy, "async": run_async}
+
+
+def run_path(path, options, results):
+    """Runs one write path on empty tables, in its own process, and reports its measurements."""
+    engine = create_engine(
+        options["database_url"], connect_args={"options": f"-csearch_path={options['schema']}"}
+    )
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            connection.execute(text(f'TRUNCATE "{table.name}"'))
+    latencies, elapsed = RUNNERS[path](engine, options)
+    tables = {schema.model_class.__table__ for schema in TIER_SCHEMAS.values()}
+    with engine.connect() as connection:
+        rows = sum(
+            connection.execute(select(func.count()).select_from(table)).scalar()
+            for table in tables
+        )
+    engine.dispose()
+    latencies.sort()
+    results.put(
+        {
+            "path": path,
+            "messages": rows,
+            "seconds": elapsed,
+            "messages_per_sec": rows / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": latencies[-1] * 1000,
+            # ru_maxrss is in KiB on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+    )
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def regressions(results, baseline, max_regression):
+    """Returns a line for every path that got slower than its baseline by more than allowed."""
+    found = []
+    previous = {entry["path"]: entry for entry in baseline["paths"]}
+    for entry in results["paths"]:
+        before = previous.get(entry["path"])
+        if before is None:
+            continue
+        if entry["messages_per_sec"] < before["messages_per_sec"] * (1 - max_regression):
+            found.append(
+                f"{entry['path']}: {entry['messages_per_sec']:,.0f} msg/s, "
+                f"was {before['messages_per_sec']:,.0f}"
+            )
+        if entry["p99_ms"] > before["p99_ms"] * (1 + max_regression):
+            found.append(
+                f"{entry['path']}: p99 {entry['p99_ms']:.1f} ms, was {before['p99_ms']:.1f} ms"
+            )
+    return found
+
+
+@click.command()
+@click.option(
+    "--database-url", default=lambda: os.getenv("DATABASE_URL"), show_default="$DATABASE_URL"
+)
+@click.option("--messages", type=click.IntRange(min=1), default=100_000, show_default=True)
+@click.option("--detectors", type=click.IntRange(min=1), default=50, show_default=True)
+@click.option(
+    "--heartbeat-rate-hz",
+    type=click.FloatRange(min=0, min_open=True),
+    default=1.0,
+    show_default=True,
+    help="Heartbeats per detector per second",
+)
+@click.option(
+    "--alert-rate-hz",
+    type=click.FloatRange(min=0),
+    default=0.05,
+    show_default=True,
+    help="Coincidence, significance, timing and retraction messages per detector per second",
+)
+@click.option("--timing-series-length", type=click.IntRange(min=1), default=100, show_default=True)
+@click.option("--batch-size", type=click.IntRange(min=1), default=1_000, show_default=True)
+@click.option(
+    "--writers", type=click.IntRange(min=1), default=4, show_default=True, help="Async writers"
+)
+@click.option(
+    "--single-row-limit",
+    type=click.IntRange(min=1),
+    default=20_000,
+    show_default=True,
+    help="Messages written by the 'arbitrary' path, which is much slower than the others",
+)
+@click.option(
+    "--path", "paths", multiple=True, type=click.Choice(PATHS), help="Defaults to all paths"
+)
+@click.option(
+    "--schema", default="snews_ingest_benchmark", show_default=True, help="Scratch schema"
+)
+@click.option("--output", type=click.Path(), default=None, help="Write the results as JSON")
+@click.option(
+    "--baseline", type=click.Path(exists=True), default=None, help="Results to compare with"
+)
+@click.option(
+    "--max-regression",
+    type=click.FloatRange(min=0),
+    default=0.1,
+    show_default=True,
+    help="Allowed loss of throughput or p99 latency against --baseline, as a fraction",
+)
+def main(
+    database_url, messages, detectors, heartbeat_rate_hz, alert_rate_hz, timing_series_length,
+    batch_size, writers, single_row_limit, paths, schema, output, baseline, max_regression
+):
+    options = {
+        "database_url": database_url,
+        "schema": schema,
+        "messages": messages,
+        "single_row_limit": min(single_row_limit, messages),
+        "batch_size": batch_size,
+        "writers": writers,
+        "stream": {
+            "detectors": detectors,
+            "heartbeat_rate_hz": heartbeat_rate_hz,
+            "alert_rate_hz": alert_rate_hz,
+            "timing_series_length": timing_series_length,
+        },
+    }
+    admin_engine = create_engine(database_url)
+    with admin_engine.begin() as connection:
+        connection.execute(text(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE'))
+        connection.execute(text(f'CREATE SCHEMA "{schema}"'))
+    engine = create_engine(database_url, connect_args={"options": f"-csearch_path={schema}"})
+    Base.metadata.create_all(engine)
+    engine.dispose()
+
+    # spawn, so that each path's peak RSS is measured in a fresh process
+    context = multiprocessing.get_context("spawn")
+    measured = []
+    try:
+        for path in paths or PATHS:
+            click.echo(f"Writing with '{path}'...")
+            queue = context.Queue()
+            process = context.Process(target=run_path, args=(path, options, queue))
+            process.start()
+            measured.append(queue.get())
+            process.join()
+    finally:
+        with admin_engine.begin() as connection:
+            connection.execute(text(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE'))
+
+    results = {
+        "revision": git_revision(),
+        "time": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "orjson": orjson is not None,
+        "options": {key: value for key, value in options.items() if key != "database_url"},
+        "paths": measured,
+    }
+    click.echo(
+        f"\n{'path':<12}{'messages':>10}{'msg/s':>12}{'p50 (ms)':>11}{'p99 (ms)':>11}"
+        f"{'peak RSS (MB)':>15}"
+    )
+    for entry in measured:
+        click.echo(
+            f"{entry['path']:<12}{entry['messages']:>10}{entry['messages_per_sec']:>12,.0f}"
+            f"{entry['p50_ms']:>11.2f}{entry['p99_ms']:>11.2f}{entry['peak_rss_mb']:>15.0f}"
+        )
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    if baseline:
+        with open(baseline) as f:
+            found = regressions(results, json.load(f), max_regression)
+        for line in found:
+            click.secho(f"Regression: {line}", fg="red")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
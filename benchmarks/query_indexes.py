@@ -0,0 +1,183 @@
+"""
+Query latency of the archive tables before and after the secondary indexes.
+
+Fills `cached_heartbeats` and `coincidence_tier_archive` with synthetic rows in
+a scratch schema, times the queries dashboards and analyses run against them,
+builds the indexes declared in `snews_db.database.models` with
+`create_indexes_concurrently`, then times the same queries again.
+
+    python benchmarks/query_indexes.py --rows 10000000 --output index_benchmark.json
+
+The scratch schema is dropped afterwards unless `--keep` is given.
+"""
+import json
+import os
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+import click
+from sqlalchemy import create_engine, text
+from sqlalchemy.schema import CreateTable
+
+from snews_db.database.models import CachedHeartbeats, CoincidenceTierArchive
+from snews_db.database.migrations import create_indexes_concurrently
+
+START_TIME = datetime(2024, 1, 1)
+START_TIME_UTC = START_TIME.replace(tzinfo=timezone.utc)
+
+QUERIES = {
+    "heartbeats_for_detector_in_hour": (
+        "SELECT * FROM cached_heartbeats "
+        "WHERE detector_name = :detector AND received_time_utc BETWEEN :start AND :stop",
+        lambda rows, detectors: {
+            "detector": "Detector7",
+            "start": START_TIME + timedelta(seconds=rows // detectors // 2),
+            "stop": START_TIME + timedelta(seconds=rows // detectors // 2 + 3600),
+        },
+    ),
+    "latest_heartbeat_for_detector": (
+        "SELECT * FROM cached_heartbeats WHERE detector_name = :detector "
+        "ORDER BY received_time_utc DESC LIMIT 1",
+        lambda rows, detectors: {"detector": "Detector7"},
+    ),
+    "heartbeat_by_uuid": (
+        "SELECT * FROM cached_heartbeats WHERE message_uuid = :uuid",
+        lambda rows, detectors: {"uuid": f"uuid-{rows // 3}"},
+    ),
+    "coincidence_around_neutrino_time": (
+        "SELECT * FROM coincidence_tier_archive "
+        "WHERE neutrino_time_utc BETWEEN :start AND :stop",
+        lambda rows, detectors: {
+            "start": START_TIME_UTC + timedelta(seconds=rows // 2 - 10),
+            "stop": START_TIME_UTC + timedelta(seconds=rows // 2 + 10),
+        },
+    ),
+    "coincidence_for_detector_in_day": (
+        "SELECT * FROM coincidence_tier_archive "
+        "WHERE detector_name = :detector AND received_time_utc BETWEEN :start AND :stop",
+        lambda rows, detectors: {
+            "detector": "Detector7",
+            "start": START_TIME + timedelta(seconds=rows // 2),
+            "stop": START_TIME + timedelta(seconds=rows // 2 + 86400),
+        },
+    ),
+}
+
+
+def populate(connection, rows, detectors):
+    """Generates the synthetic rows server side, one heartbeat per detector per second."""
+    connection.execute(
+        text(
+            "INSERT INTO cached_heartbeats (message_id, message_uuid, received_time_utc, "
+            "machine_time_utc, detector_name, detector_status, is_test) "
+            "SELECT 'hb-' || g, 'uuid-' || g, "
+            ":start + (g / :detectors) * interval '1 second', "
+            ":start + (g / :detectors) * interval '1 second' - interval '50 milliseconds', "
+            "'Detector' || (g % :detectors), "
+            "CASE WHEN g % 97 = 0 THEN 'OFF' ELSE 'ON' END, 0 "
+            "FROM generate_series(0, :rows - 1) AS g"
+        ),
+        {"start": START_TIME, "rows": rows, "detectors": detectors},
+    )
+    # one coincidence message per second, spread over the detectors
+    connection.execute(
+        text(
+            "INSERT INTO coincidence_tier_archive (message_id, message_uuid, received_time_utc, "
+            "detector_name, machine_time_utc, neutrino_time_utc, p_val, is_test, is_firedrill) "
+            "SELECT 'coinc-' || g, 'uuid-' || g, :start + g * interval '1 second', "
+            "'Detector' || (g % :detectors), "
+            ":start_utc + g * interval '1 second', "
+            ":start_utc + g * interval '1 second' - interval '2 seconds', "
+            "random(), 0, 0 "
+            "FROM generate_series(0, :rows - 1) AS g"
+        ),
+        {"start": START_TIME, "start_utc": START_TIME_UTC, "rows": rows, "detectors": detectors},
+    )
+    connection.execute(text("ANALYZE cached_heartbeats"))
+    connection.execute(text("ANALYZE coincidence_tier_archive"))
+
+
+def time_queries(engine, rows, detectors, repeat):
+    """Returns the median wall time in milliseconds of each query."""
+    timings = {}
+    with engine.connect() as connection:
+        for name, (sql, make_params) in QUERIES.items():
+            statement = text(sql)
+            params = make_params(rows, detectors)
+            connection.execute(statement, params).fetchall()  # warm up the cache
+            samples = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                connection.execute(statement, params).fetchall()
+                samples.append((time.perf_counter() - start) * 1000)
+            timings[name] = statistics.median(samples)
+    return timings
+
+
+@click.command()
+@click.option("--database-url", default=lambda: os.getenv("DATABASE_URL"), show_default="$DATABASE_URL")
+@click.option("--rows", type=int, default=10_000_000, show_default=True, help="Rows per table")
+@click.option("--detectors", type=int, default=50, show_default=True)
+@click.option("--repeat", type=int, default=5, show_default=True, help="Timed runs per query")
+@click.option("--schema", default="snews_index_benchmark", show_default=True, help="Scratch schema")
+@click.option("--output", type=click.Path(), default=None, help="Write the results as JSON")
+@click.option("--keep/--no-keep", default=False, help="Keep the scratch schema afterwards")
+def main(database_url, rows, detectors, repeat, schema, output, keep):
+    admin_engine = create_engine(database_url)
+    with admin_engine.begin() as connection:
+        connection.execute(text(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE'))
+        connection.execute(text(f'CREATE SCHEMA "{schema}"'))
+    engine = create_engine(database_url, connect_args={"options": f"-csearch_path={schema}"})
+
+    try:
+        with engine.begin() as connection:
+            for model in (CachedHeartbeats, CoincidenceTierArchive):
+                # CreateTable leaves out the indexes so that we can time the bare table first
+                connection.execute(CreateTable(model.__table__))
+            click.echo(f"Generating {rows} rows per table...")
+            start = time.perf_counter()
+            populate(connection, rows, detectors)
+            click.echo(f"  done in {time.perf_counter() - start:.1f}s")
+
+        before = time_queries(engine, rows, detectors, repeat)
+
+        click.echo("Building indexes concurrently...")
+        start = time.perf_counter()
+        built = create_indexes_concurrently(
+            engine, tables=[CachedHeartbeats.__tablename__, CoincidenceTierArchive.__tablename__]
+        )
+        index_build_sec = time.perf_counter() - start
+        click.echo(f"  built {len(built)} indexes in {index_build_sec:.1f}s")
+        with engine.begin() as connection:
+            connection.execute(text("ANALYZE cached_heartbeats"))
+            connection.execute(text("ANALYZE coincidence_tier_archive"))
+
+        after = time_queries(engine, rows, detectors, repeat)
+    finally:
+        if not keep:
+            with admin_engine.begin() as connection:
+                connection.execute(text(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE'))
+
+    click.echo(f"\n{'query':<36}{'before (ms)':>14}{'after (ms)':>14}{'speedup':>10}")
+    for name in QUERIES:
+        click.echo(
+            f"{name:<36}{before[name]:>14.2f}{after[name]:>14.2f}{before[name] / after[name]:>9.0f}x"
+        )
+
+    if output:
+        results = {
+            "rows_per_table": rows,
+            "detectors": detectors,
+            "index_build_sec": index_build_sec,
+            "indexes": built,
+            "queries": {
+                name: {"before_ms": before[name], "after_ms": after[name]} for name in QUERIES
+            },
+        }
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,37 @@
 import os
-import json
-from datetime import datetime
+import time
+from datetime import datetime, timedelta, timezone
 
 import click
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
 from snews_db.utils import db_utils
 from snews_db.database.models import Base
-from snews_db.db_operations import write_arbitrary_message
-from snews import messages
+from snews_db.database.migrations import (
+    convert_text_columns,
+    create_indexes_concurrently,
+    delete_duplicate_messages,
+)
+from snews_db.database.partitions import (
+    INTERVALS,
+    PARTITIONED_TABLES,
+    create_partitions,
+    detach_partitions,
+    partition_table,
+)
+from snews_db.bulk_loader import load_messages
+from snews_db.coincidence import find_coincidences, load_signals
+from snews_db.copy_loader import copy_messages, iter_jsonl
+from snews_db.dead_letters import reprocess_dead_letters
+from snews_db.export import EXPORT_TABLES, export_table
+from snews_db.heartbeat_rollup import rollup_heartbeats
+from snews_db.metrics import ListenerMetrics
+from snews_db.profiling import PROFILE_MODES, IngestProfiler
 
 from dotenv import load_dotenv
+from snews_db.async_listener import AsyncDBKafkaListener
 from snews_db.kafka_listener import DBKafkaListener
+from snews_db.workers import run_workers
 load_dotenv()
 
 
@@ -37,13 +59,168 @@ def main(ctx, env):
     show_default="False",
     help="Whether to use firedrill brokers or default ones",
 )
-def listen_to_detectors(firedrill):
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=None,
+    show_default="1, or 100 in async mode",
+    help="Number of messages written per database transaction (1 writes each message on arrival)",
+)
+@click.option(
+    "--batch-timeout-ms",
+    type=click.IntRange(min=1),
+    default=1000,
+    show_default=True,
+    help="Longest time in milliseconds a message waits for its batch to fill before being written",
+)
+@click.option(
+    "--dedup-cache-size",
+    type=click.IntRange(min=0),
+    default=100_000,
+    show_default=True,
+    help="Number of recent message UUIDs remembered to drop redeliveries early (0 disables)",
+)
+@click.option(
+    "--mode",
+    type=click.Choice(["sync", "async"]),
+    default="sync",
+    show_default=True,
+    help="'async' consumes and writes in separate stages joined by a bounded queue",
+)
+@click.option(
+    "--writers",
+    type=click.IntRange(min=1),
+    default=2,
+    show_default=True,
+    help="Number of concurrent database writers (async mode)",
+)
+@click.option(
+    "--queue-size",
+    type=click.IntRange(min=1),
+    default=10_000,
+    show_default=True,
+    help="Maximum number of messages waiting to be written before consumption pauses (async mode)",
+)
+@click.option(
+    "--stats-interval",
+    type=click.IntRange(min=0),
+    default=60,
+    show_default=True,
+    help="Seconds between queue depth, latency and per-worker throughput reports, 0 disables them",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of listener processes sharing the topic's partitions (requires --group-id)",
+)
+@click.option(
+    "--group-id",
+    type=str,
+    default=None,
+    envvar="DB_LISTENER_GROUP_ID",
+    help="Kafka consumer group of the listeners, under which read offsets are committed; on "
+    "SCiMMA brokers it must start with your hop username followed by '-'",
+)
+@click.option(
+    "--dead-letters/--no-dead-letters",
+    default=True,
+    show_default=True,
+    help="Keep messages that cannot be decoded or written in the dead_letters table",
+)
+@click.option(
+    "--spool",
+    "spool_path",
+    type=click.Path(dir_okay=False),
+    default=None,
+    envvar="DB_LISTENER_SPOOL",
+    help="Local SQLite file that takes the messages while the database is unavailable and is "
+    "drained into it once it recovers (each worker uses its own file)",
+)
+@click.option(
+    "--metrics-port",
+    type=click.IntRange(min=0, max=65535),
+    default=None,
+    envvar="DB_LISTENER_METRICS_PORT",
+    help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics (worker N uses PORT+N)",
+)
+@click.option(
+    "--slow-statement-ms",
+    type=click.FloatRange(min=0),
+    default=250,
+    show_default=True,
+    help="Log SQL statements that take longer than this many milliseconds",
+)
+@click.option(
+    "--slow-statement-sample-rate",
+    type=click.FloatRange(min=0, max=1),
+    default=1.0,
+    show_default=True,
+    help="Fraction of the slow SQL statements logged (all of them are counted in the metrics)",
+)
+@click.option(
+    "--profile",
+    "profile_path",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Profile the first --profile-messages messages, then write PATH.folded (or PATH.prof) "
+    "and a summary to PATH.txt (worker N uses PATH-N)",
+)
+@click.option(
+    "--profile-messages",
+    type=click.IntRange(min=1),
+    default=1_000,
+    show_default=True,
+    help="Number of messages profiled",
+)
+@click.option(
+    "--profile-mode",
+    type=click.Choice(PROFILE_MODES),
+    default="sample",
+    show_default=True,
+    help="Sample the stacks of every thread (flamegraph) or trace the consuming thread's calls "
+    "with cProfile",
+)
+def listen_to_detectors(
+    firedrill, batch_size, batch_timeout_ms, dedup_cache_size, mode, writers, queue_size,
+    stats_interval, workers, group_id, dead_letters, spool_path, metrics_port,
+    slow_statement_ms, slow_statement_sample_rate, profile_path, profile_messages, profile_mode
+):
     """Initiate Coincidence Decider"""
 
+    if workers > 1 and group_id is None:
+        raise click.UsageError("--workers needs a --group-id to share the topic's partitions")
     # HOST = gethostname()
-    message_runner = DBKafkaListener(firedrill=firedrill)
+    if batch_size is None:
+        batch_size = 100 if mode == "async" else 1
+    listener_options = dict(
+        firedrill=firedrill,
+        batch_size=batch_size,
+        batch_timeout_ms=batch_timeout_ms,
+        dedup_cache_size=dedup_cache_size,
+        group_id=group_id,
+        dead_letters=dead_letters,
+        spool_path=spool_path,
+        metrics_port=metrics_port,
+        slow_statement_ms=slow_statement_ms,
+        slow_statement_sample_rate=slow_statement_sample_rate,
+        profile_path=profile_path,
+        profile_messages=profile_messages,
+        profile_mode=profile_mode,
+    )
+    if mode == "async":
+        listener_class = AsyncDBKafkaListener
+        listener_options.update(
+            writers=writers, queue_size=queue_size, stats_interval_s=stats_interval
+        )
+    else:
+        listener_class = DBKafkaListener
     try:
-        message_runner.run_db_listener()
+        if workers > 1:
+            run_workers(listener_class, listener_options, workers, stats_interval_s=stats_interval)
+        else:
+            listener_class(**listener_options).run_db_listener()
     except KeyboardInterrupt:
         pass
     except Exception as e:
@@ -53,41 +230,476 @@ def listen_to_detectors(firedrill):
 
 
 @main.command()
-@click.argument('json_file', type=click.Path(exists=True))
-def store_message(json_file):
-    """Parse a SNEWS message from JSON file and store it in the database"""
+@click.argument("sources", nargs=-1, required=True)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=1_000,
+    show_default=True,
+    help="Number of messages written per database transaction",
+)
+@click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of processes parsing and validating files. Defaults to the number of CPUs",
+)
+@click.option(
+    "--checkpoint",
+    "checkpoint_path",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="JSON file recording what is stored; rerunning with it skips what it holds",
+)
+@click.option(
+    "--progress-interval",
+    type=click.FloatRange(min=0),
+    default=5,
+    show_default=True,
+    help="Seconds between two progress lines",
+)
+@click.option(
+    "--profile",
+    "profile_path",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Profile the first --profile-messages messages, then write PATH.folded (or PATH.prof) "
+    "and a summary to PATH.txt",
+)
+@click.option(
+    "--profile-messages",
+    type=click.IntRange(min=1),
+    default=1_000,
+    show_default=True,
+    help="Number of messages profiled",
+)
+@click.option(
+    "--profile-mode",
+    type=click.Choice(PROFILE_MODES),
+    default="sample",
+    show_default=True,
+    help="Sample the stacks of every thread (flamegraph) or trace the consuming thread's calls "
+    "with cProfile",
+)
+def store_message(
+    sources, batch_size, jobs, checkpoint_path, progress_interval, profile_path,
+    profile_messages, profile_mode
+):
+    """Store SNEWS messages from JSON files, directories, globs or JSON Lines ('-' for stdin)"""
+    engine = create_engine(os.getenv("DATABASE_URL"))
+    Base.metadata.create_all(bind=engine)
+    start = time.monotonic()
+    next_report = start + progress_interval
+    metrics = profiler = None
+    if profile_path is not None:
+        metrics = ListenerMetrics()
+        profiler = IngestProfiler(
+            profile_path, messages=profile_messages, mode=profile_mode, metrics=metrics
+        )
+    profiled = 0
+
+    def report_profile():
+        click.secho(
+            f"Profile of {profiler.recorded} messages written to "
+            f"{', '.join(profiler.report_paths)}"
+        )
+
+    def report(totals):
+        nonlocal next_report, profiled
+        if profiler is not None:
+            stored = totals["written"] + totals["rejected"]
+            if profiler.record(stored - profiled):
+                report_profile()
+            profiled = stored
+        if time.monotonic() < next_report:
+            return
+        next_report = time.monotonic() + progress_interval
+        rate = totals["written"] / (time.monotonic() - start)
+        click.secho(
+            f"{totals['parsed']} files or chunks parsed, {totals['written']} messages stored "
+            f"({rate:.0f} msg/s), {totals['invalid'] + totals['rejected']} failed"
+        )
+
+    def report_error(location, error):
+        click.secho(f"Error storing {location}: {error}", fg="red")
+
+    if profiler is not None:
+        profiler.start()
+    try:
+        totals = load_messages(
+            sources,
+            sessionmaker(bind=engine),
+            batch_size=batch_size,
+            jobs=jobs,
+            checkpoint_path=checkpoint_path,
+            on_progress=report,
+            on_error=report_error,
+            metrics=metrics,
+        )
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    finally:
+        if profiler is not None and profiler.stop():
+            report_profile()
+    failed = totals["invalid"] + totals["rejected"]
+    click.secho(
+        f"Stored {totals['written']} messages in {time.monotonic() - start:.1f}s"
+        + (f", {failed} failed" if failed else ""),
+        fg="red" if failed else "green",
+    )
+
+
+@main.command()
+@click.argument('jsonl_file', type=click.Path(exists=True))
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=10_000,
+    show_default=True,
+    help="Number of rows per table sent in each COPY",
+)
+def backfill(jsonl_file, chunk_size):
+    """Stream SNEWS message dicts from a JSON Lines file into the database with COPY"""
+    engine = create_engine(os.getenv("DATABASE_URL"))
+    Base.metadata.create_all(bind=engine)
+
+    def report(message, error):
+        click.secho(f"Skipped message {message.get('uuid')}: {error}", fg="red")
+
+    with Session(engine) as session:
+        written = copy_messages(session, iter_jsonl(jsonl_file), chunk_size=chunk_size, on_error=report)
+    click.secho(f"Copied {written} rows into the database", fg="green")
+
+
+@main.command("reprocess-dead-letters")
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=500,
+    show_default=True,
+    help="Number of dead letters written per transaction",
+)
+@click.option(
+    "--tier",
+    "tiers",
+    multiple=True,
+    help="Only reprocess messages of this tier (can be repeated). Defaults to all tiers",
+)
+def reprocess_dead_letters_command(batch_size, tiers):
+    """Write the messages kept in dead_letters again, e.g. after a fix is deployed"""
+    engine = create_engine(os.getenv("DATABASE_URL"))
+    Base.metadata.create_all(bind=engine)
+    counts = reprocess_dead_letters(
+        sessionmaker(bind=engine), batch_size=batch_size, tiers=list(tiers) or None
+    )
+    click.secho(
+        f"Wrote {counts['written']} dead letters, {counts['failed']} still fail",
+        fg="green" if not counts["failed"] else "yellow",
+    )
+
+
+@main.command()
+@click.option(
+    "--table",
+    "tables",
+    multiple=True,
+    help="Only index this table (can be repeated). Defaults to all tables",
+)
+def create_indexes(tables):
+    """Build missing secondary indexes on live tables without blocking writes"""
+    engine = create_engine(os.getenv("DATABASE_URL"))
     try:
-        # Read and parse JSON file
-        with open(json_file, 'r') as f:
-            message_data = json.load(f)
+        built = create_indexes_concurrently(engine, tables=list(tables) or None)
+    except ValueError as e:
+        click.secho(f"{e} (see `snews_db deduplicate-messages`)", fg="red")
+        return
+    if built:
+        click.secho(f"Built indexes: {', '.join(built)}", fg="green")
+    else:
+        click.secho("All indexes already exist", fg="green")
+
+
+@main.command()
+@click.option(
+    "--table",
+    "tables",
+    multiple=True,
+    help="Only clean this table (can be repeated). Defaults to all tier tables",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=10_000,
+    show_default=True,
+    help="Maximum number of rows deleted per transaction",
+)
+def deduplicate_messages(tables, batch_size):
+    """Delete rows whose message_uuid is already stored, keeping the oldest one"""
+    engine = create_engine(os.getenv("DATABASE_URL"))
+    deleted = delete_duplicate_messages(engine, tables=list(tables) or None, batch_size=batch_size)
+    for table_name, count in deleted.items():
+        click.secho(f"{table_name}: deleted {count} duplicate rows", fg="green")
 
-        # Create messages using snews library
-        snews_messages = messages.create_messages(**message_data)
 
-        # Create database session and tables
-        db = SessionLocal()
+@main.command()
+@click.option(
+    "--table",
+    "tables",
+    multiple=True,
+    help="Only convert this table (can be repeated). Defaults to all tier tables",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=5_000,
+    show_default=True,
+    help="Number of rows converted per transaction",
+)
+def convert_columns(tables, batch_size):
+    """
+    Convert times, p_values and timing_series stored as text to native column types
+
+    Stop the listener first: it writes native types, which the text columns reject.
+    """
+    engine = create_engine(os.getenv("DATABASE_URL"))
+    try:
+        converted = convert_text_columns(
+            engine, tables=list(tables) or None, batch_size=batch_size
+        )
+    except ValueError as e:
+        click.secho(f"{e} (see `snews_db deduplicate-messages`)", fg="red")
+        return
+    if not converted:
+        click.secho("No text columns left to convert", fg="green")
+    for table_name, count in converted.items():
+        click.secho(f"{table_name}: converted {count} rows", fg="green")
+
+
+@main.command()
+@click.option(
+    "--table",
+    "tables",
+    multiple=True,
+    type=click.Choice(PARTITIONED_TABLES),
+    help="Only partition this table (can be repeated). Defaults to all tier tables",
+)
+@click.option(
+    "--interval",
+    type=click.Choice(INTERVALS),
+    default="month",
+    show_default=True,
+    help="Range of received_time_utc held by each partition",
+)
+@click.option(
+    "--ahead",
+    type=click.IntRange(min=1),
+    default=3,
+    show_default=True,
+    help="Number of partitions to create after the current one",
+)
+def partition_tables(tables, interval, ahead):
+    """Convert tier tables to tables partitioned by received_time_utc"""
+    engine = create_engine(os.getenv("DATABASE_URL"))
+    for table_name in tables or PARTITIONED_TABLES:
         try:
-            # Create all tables if they don't exist
-            Base.metadata.create_all(bind=engine)
-
-            # Write each message to the database
-            for message in snews_messages:
-                # Convert message to dict format expected by write_arbitrary_message
-                message_dict = message.model_dump()
-                # Add tier information
-                message_dict['tier'] = message.tier
-                write_arbitrary_message(db, message_dict)
-            click.secho("Successfully stored all messages in database", fg="green")
-        except Exception as e:
-            db.rollback()
-            click.secho(f"Error storing messages in database: {str(e)}", fg="red")
-        finally:
-            db.close()
-
-    except json.JSONDecodeError:
-        click.secho("Error: Invalid JSON file", fg="red")
-    except Exception as e:
-        click.secho(f"Error processing message: {str(e)}", fg="red")
+            converted = partition_table(engine, table_name, interval=interval, ahead=ahead)
+        except ValueError as e:
+            click.secho(str(e), fg="red")
+            continue
+        if converted:
+            click.secho(f"{table_name}: partitioned by {interval}", fg="green")
+        else:
+            click.secho(f"{table_name}: already partitioned", fg="green")
+
+
+@main.command()
+@click.option(
+    "--ahead",
+    type=click.IntRange(min=0),
+    default=3,
+    show_default=True,
+    help="Number of partitions to have after the current one",
+)
+@click.option(
+    "--detach-older-than-days",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Detach the partitions holding only rows received before this many days ago",
+)
+@click.option(
+    "--drop/--no-drop",
+    default=False,
+    show_default=True,
+    help="Drop the detached partitions instead of keeping them as standalone tables",
+)
+def maintain_partitions(ahead, detach_older_than_days, drop):
+    """Create upcoming partitions and detach old ones (run daily, e.g. from cron)"""
+    engine = create_engine(os.getenv("DATABASE_URL"))
+    for name in create_partitions(engine, ahead=ahead):
+        click.secho(f"Created partition {name}", fg="green")
+    if detach_older_than_days is not None:
+        older_than = datetime.now(timezone.utc) - timedelta(days=detach_older_than_days)
+        for table_name, names in detach_partitions(engine, older_than, drop=drop).items():
+            action = "Dropped" if drop else "Detached"
+            click.secho(f"{table_name}: {action} {', '.join(names)}", fg="green")
+
+
+@main.command("rollup-heartbeats")
+@click.option(
+    "--older-than-hours",
+    type=click.FloatRange(min=0, min_open=True),
+    default=24,
+    show_default=True,
+    help="Roll up and delete raw heartbeats received before this many hours ago",
+)
+@click.option(
+    "--delete-batch-size",
+    type=click.IntRange(min=1),
+    default=10_000,
+    show_default=True,
+    help="Number of raw heartbeats from which a transaction stops adding minutes",
+)
+def rollup_heartbeats_command(older_than_hours, delete_batch_size):
+    """Downsample old heartbeats into per-minute summaries and delete the raw rows"""
+    engine = create_engine(os.getenv("DATABASE_URL"))
+    Base.metadata.create_all(bind=engine)
+    result = rollup_heartbeats(
+        engine,
+        older_than=timedelta(hours=older_than_hours),
+        delete_batch_size=delete_batch_size,
+    )
+    click.secho(
+        f"Wrote {result['minutes']} detector minutes and deleted {result['deleted']} "
+        f"heartbeats received before {result['watermark']} ({result['late']} written late)",
+        fg="green",
+    )
+
+
+@main.command()
+@click.option(
+    "--table",
+    "tables",
+    multiple=True,
+    type=click.Choice(sorted(EXPORT_TABLES)),
+    help="Only export this table (can be repeated). Defaults to all tier tables",
+)
+@click.option(
+    "--output-dir",
+    type=click.Path(file_okay=False),
+    default=".",
+    show_default=True,
+    help="Directory the Parquet files (one per table) are written to",
+)
+@click.option(
+    "--start",
+    type=click.DateTime(),
+    default=None,
+    help="Only export rows received at or after this UTC time",
+)
+@click.option(
+    "--end",
+    type=click.DateTime(),
+    default=None,
+    help="Only export rows received before this UTC time",
+)
+@click.option("--detector", default=None, help="Only export the rows of this detector")
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=50_000,
+    show_default=True,
+    help="Number of rows fetched and written to Parquet at a time",
+)
+def export(tables, output_dir, start, end, detector, chunk_size):
+    """Stream tier tables, filtered by received time or detector, into Parquet files"""
+    engine = create_engine(os.getenv("DATABASE_URL"))
+    Base.metadata.create_all(bind=engine)
+    os.makedirs(output_dir, exist_ok=True)
+    for table_name in tables or sorted(EXPORT_TABLES):
+        path = os.path.join(output_dir, f"{table_name}.parquet")
+        count = export_table(
+            engine,
+            table_name,
+            path,
+            start=start,
+            end=end,
+            detector_name=detector,
+            chunk_size=chunk_size,
+        )
+        click.secho(f"{table_name}: exported {count} rows to {path}", fg="green")
+
+
+@main.command("find-coincidences")
+@click.option(
+    "--window-sec",
+    type=click.FloatRange(min=0, min_open=True),
+    default=10,
+    show_default=True,
+    help="Length of the coincidence window, in seconds",
+)
+@click.option(
+    "--min-detectors",
+    type=click.IntRange(min=1),
+    default=2,
+    show_default=True,
+    help="Minimum number of distinct detectors in a window",
+)
+@click.option(
+    "--start",
+    type=click.DateTime(),
+    default=None,
+    help="Only use neutrino times at or after this UTC time",
+)
+@click.option(
+    "--end",
+    type=click.DateTime(),
+    default=None,
+    help="Only use neutrino times before this UTC time",
+)
+@click.option(
+    "--include-timing/--no-include-timing",
+    default=False,
+    show_default=True,
+    help="Also use the neutrino times of timing tier messages",
+)
+@click.option(
+    "--test/--no-test",
+    "is_test",
+    default=None,
+    help="Only use test (or non-test) messages. Defaults to both",
+)
+@click.option(
+    "--firedrill/--no-firedrill",
+    "is_firedrill",
+    default=None,
+    help="Only use firedrill (or non-firedrill) coincidence messages. Defaults to both",
+)
+def find_coincidences_command(
+    window_sec, min_detectors, start, end, include_timing, is_test, is_firedrill
+):
+    """Search the archived neutrino times for coincidences of several detectors"""
+    engine = create_engine(os.getenv("DATABASE_URL"))
+    signals = load_signals(
+        engine,
+        start=start,
+        end=end,
+        include_timing=include_timing,
+        is_test=is_test,
+        is_firedrill=is_firedrill,
+    )
+    coincidences = find_coincidences(
+        signals, timedelta(seconds=window_sec), min_detectors=min_detectors
+    )
+    for coincidence in coincidences:
+        click.echo(
+            f"{coincidence.start.isoformat()} to {coincidence.end.isoformat()}: "
+            f"{', '.join(coincidence.detector_names)}"
+        )
+    click.secho(
+        f"Found {len(coincidences)} coincidences of at least {min_detectors} detectors "
+        f"in {len(signals)} neutrino times",
+        fg="green",
+    )
 
 
 if __name__ == "__main__":
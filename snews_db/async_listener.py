@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import statistics
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import click
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from snews_db.db_operations import is_transient_error, write_messages_bulk
+from snews_db.kafka_listener import DBKafkaListener
+
+# Setup logger
+log = logging.getLogger(__name__)
+
+
+class StageStats:
+    """
+    Latency samples of one pipeline stage, in milliseconds.
+
+    Only the most recent `window` samples are kept, so the statistics
+    describe the current behaviour of the listener.
+    """
+
+    def __init__(self, window=1000):
+        self._samples = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, latency_ms):
+        self._samples.append(latency_ms)
+        self.count += 1
+
+    def snapshot(self):
+        samples = sorted(self._samples)
+        if not samples:
+            return {"count": self.count}
+        return {
+            "count": self.count,
+            "mean_ms": statistics.fmean(samples),
+            "p50_ms": samples[len(samples) // 2],
+            "p99_ms": samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+            "max_ms": samples[-1],
+        }
+
+
+class AsyncDBKafkaListener(DBKafkaListener):
+    """
+    Listener whose Kafka consumption and database writes run as separate stages.
+
+    A consumer thread reads the topic (the hop stream is blocking) and hands
+    each message to the asyncio event loop, where it is put on a bounded
+    queue. `writers` writer tasks take batches of up to `batch_size`
+    messages from the queue and write them through SQLAlchemy's async engine
+    (asyncpg), so one slow write does not stop consumption and several
+    batches can be in flight. When the queue is full the consumer blocks,
+    which applies backpressure to Kafka instead of buffering without bound.
+    Kafka offsets advance as batches commit; if a batch fails, the consumer
+    rereads from the last checkpoint.
+
+    Queue depth and the latency of both stages (time spent queued, time to
+    write a batch) are available from `stats()` and logged every
+    `stats_interval_s` seconds.
+
+    Args:
+        firedrill: Whether to use the firedrill observation topic.
+        batch_size: Maximum number of messages written per transaction.
+        batch_timeout_ms: Longest time a writer waits for its batch to fill.
+        dedup_cache_size: Number of recent message uuids remembered to drop
+                          redeliveries (0 disables it).
+        writers: Number of concurrent writer tasks.
+        queue_size: Maximum number of messages waiting to be written.
+        stats_interval_s: Seconds between two stats log lines (0 disables them).
+        group_id: Kafka consumer group shared with other listeners, if any.
+        dead_letters: Whether to keep messages that cannot be decoded or
+                      written in dead_letters.
+        spool_path: Optional SQLite file taking the messages while the
+                    database is unavailable (see `MessageSpool`).
+        metrics_port: Optional local port serving the listener's metrics
+                      (see `ListenerMetrics`).
+        slow_statement_ms: Duration from which SQL statements are logged as slow.
+        slow_statement_sample_rate: Fraction of the slow statements logged.
+        profile_path: Optional path prefix of a profile of the first
+                      `profile_messages` messages (see `IngestProfiler`).
+        profile_messages: Number of messages profiled.
+        profile_mode: 'sample' or 'cprofile'.
+    """
+
+    def __init__(
+        self,
+        firedrill=False,
+        batch_size=100,
+        batch_timeout_ms=1000,
+        dedup_cache_size=100_000,
+        writers=2,
+        queue_size=10_000,
+        stats_interval_s=60,
+        group_id=None,
+        dead_letters=True,
+        spool_path=None,
+        metrics_port=None,
+        slow_statement_ms=250,
+        slow_statement_sample_rate=1.0,
+        profile_path=None,
+        profile_messages=1000,
+        profile_mode="sample",
+    ):
+        super().__init__(
+            firedrill=firedrill,
+            batch_size=batch_size,
+            batch_timeout_ms=batch_timeout_ms,
+            dedup_cache_size=dedup_cache_size,
+            group_id=group_id,
+            dead_letters=dead_letters,
+            spool_path=spool_path,
+            metrics_port=metrics_port,
+            slow_statement_ms=slow_statement_ms,
+            slow_statement_sample_rate=slow_statement_sample_rate,
+            profile_path=profile_path,
+            profile_messages=profile_messages,
+            profile_mode=profile_mode,
+        )
+        self.writers = writers
+        self.queue_size = queue_size
+        self.stats_interval_s = stats_interval_s
+        self.queue = None
+        self._loop = None
+        self._write_failure = None
+        self.queue_wait = StageStats()
+        self.write_latency = StageStats()
+        self.written = 0
+
+    def stats(self):
+        """Returns the queue depth, the latency of both stages and the state of the spool."""
+        return {
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "queue_size": self.queue_size,
+            "written": self.written,
+            "queue_wait": self.queue_wait.snapshot(),
+            "write": self.write_latency.snapshot(),
+            "spool": self.spool.stats() if self.spool is not None else None,
+        }
+
+    def run_db_listener(self):
+        self.retriable_error_count = 0
+        asyncio.run(self._run())
+
+    async def _run(self):
+        # tables, partitions and the status cache are set up with the sync engine
+        db_engine, _ = self._prepare_database()
+        db_engine.dispose()
+        async_engine = create_async_engine(
+            make_url(self.database_url).set(drivername="postgresql+asyncpg"),
+            pool_size=self.writers,
+        )
+        self._log_slow_statements(async_engine.sync_engine)
+        self._start_metrics_server()
+        AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+        loop = self._loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        consumer_stopped = asyncio.Event()
+
+        def enqueue(snews_message, on_written):
+            failure, self._write_failure = self._write_failure, None
+            if failure is not None:
+                raise failure
+            # blocks the consumer thread while the queue is full
+            asyncio.run_coroutine_threadsafe(
+                self.queue.put((snews_message, on_written, time.monotonic())), loop
+            ).result()
+
+        def consume():
+            try:
+                self._consume(enqueue)
+            finally:
+                self._stop_profile()
+                loop.call_soon_threadsafe(consumer_stopped.set)
+
+        tasks = [
+            asyncio.create_task(self._write_batches(AsyncSessionLocal), name=f"writer-{n}")
+            for n in range(self.writers)
+        ]
+        if self.stats_interval_s:
+            tasks.append(asyncio.create_task(self._log_stats(), name="stats"))
+        # daemon, so that a consumer blocked on Kafka does not keep the process alive
+        threading.Thread(target=consume, name="snews-db-consumer", daemon=True).start()
+        try:
+            await consumer_stopped.wait()
+            # write what is still queued before stopping
+            await self.queue.join()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await async_engine.dispose()
+            self._close_spool()
+            self._stop_partition_maintenance()
+            self._stop_metrics_server()
+            # the consumer thread may still be blocked on Kafka
+            self._stop_profile()
+
+    def _queue_depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def _reset_writes(self):
+        super()._reset_writes()
+        self._write_failure = None
+
+    def _drain_writes(self):
+        # called from the consumer thread
+        if self.queue is not None:
+            asyncio.run_coroutine_threadsafe(self.queue.join(), self._loop).result()
+
+    async def _next_batch(self):
+        """Waits for a message, then for more until the batch is full or has waited long enough."""
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.batch_timeout_ms / 1000
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _write_batches(self, AsyncSessionLocal):
+        while True:
+            batch = await self._next_batch()
+            dequeued = time.monotonic()
+            for _, _, enqueued in batch:
+                self.queue_wait.add((dequeued - enqueued) * 1000)
+            messages = [snews_message for snews_message, _, _ in batch]
+            try:
+                if self._spool(messages):
+                    results = [None] * len(messages)
+                else:
+                    async with AsyncSessionLocal() as session:
+                        results = await session.run_sync(
+                            write_messages_bulk,
+                            messages,
+                            status_cache=self.latest_statuses,
+                            dead_letter=self.dead_letters,
+                            metrics=self.metrics,
+                        )
+            except Exception as e:
+                if is_transient_error(e):
+                    self.metrics.errors.inc(kind="transient")
+                if self._spool(messages, e):
+                    results = [None] * len(messages)
+                else:
+                    # the consumer rereads the batch from the last checkpoint
+                    click.secho(
+                        f"{datetime.utcnow().isoformat()} Error writing a batch of "
+                        f"{len(messages)} messages: {e}\n",
+                        fg="red",
+                    )
+                    self._write_failure = e
+                    continue
+            finally:
+                self.write_latency.add((time.monotonic() - dequeued) * 1000)
+                for _ in batch:
+                    self.queue.task_done()
+            for (snews_message, on_written, _), error in zip(batch, results):
+                if error is None:
+                    self.written += 1
+                else:
+                    self._report_write_error(snews_message, error)
+                on_written()
+
+    async def _log_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval_s)
+            stats = self.stats()
+            click.secho(
+                f"{datetime.utcnow().isoformat()} "
+                f"queue {stats['queue_depth']}/{stats['queue_size']}, "
+                f"written {stats['written']}, "
+                f"queue wait p50 {stats['queue_wait'].get('p50_ms', 0):.1f} ms, "
+                f"write p50 {stats['write'].get('p50_ms', 0):.1f} ms "
+                f"p99 {stats['write'].get('p99_ms', 0):.1f} ms"
+                + (
+                    f", spool {stats['spool']['pending']} pending "
+                    f"({stats['spool']['size_bytes'] / 1e6:.1f} MB, "
+                    f"drained at {stats['spool']['drain_rate_per_sec']:.0f} msg/s)"
+                    if stats["spool"] is not None
+                    else ""
+                )
+            )
@@ -0,0 +1,248 @@
+import logging
+import threading
+import time
+
+from snews_db.db_operations import is_transient_error, write_messages_bulk
+
+# Setup logger
+log = logging.getLogger(__name__)
+
+
+class BatchWriter:
+    """
+    Buffers SNEWS messages and writes them to the database in batches.
+
+    A batch is flushed as one transaction (see `write_messages_bulk`) as soon
+    as it holds `max_batch_size` messages or its oldest message has waited
+    `max_batch_delay_ms` milliseconds, whichever comes first. A message that
+    cannot be written is dropped on its own and reported through `on_error`;
+    the rest of its batch is still committed.
+
+    A message may come with an `on_written` callback, called once its batch
+    has committed, e.g. to advance the consumer's Kafka offsets. If a whole
+    batch fails (e.g. the database is unreachable), no callback of the
+    batch is called and the batch stays buffered. The background thread
+    retries it every `retry_interval_s` seconds, so it is written even if no
+    other message arrives, and the next `add` raises the error, so the
+    caller can also reread the messages (or `discard` them) instead.
+
+    Args:
+        session_factory: A callable returning a new SQLAlchemy session
+                         (e.g. a `sessionmaker`).
+        max_batch_size: Number of buffered messages that triggers a flush.
+        max_batch_delay_ms: Longest time a message may wait in the buffer.
+        on_error: Called as `on_error(message, exception)` for every dropped
+                  message. Defaults to logging the error.
+        status_cache: Optional `LatestStatusCache` kept up to date with the
+                      heartbeats and retractions written.
+        dead_letter: Whether dropped messages are also stored in dead_letters,
+                     in the transaction of their batch.
+        spool: Optional `MessageSpool` that takes the batches while the
+               database is unavailable, instead of failing them.
+        metrics: Optional `ListenerMetrics` of the writes.
+        retry_interval_s: Seconds between two background attempts to write a
+                          failed batch.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        max_batch_size=500,
+        max_batch_delay_ms=1000,
+        on_error=None,
+        status_cache=None,
+        dead_letter=False,
+        spool=None,
+        metrics=None,
+        retry_interval_s=5,
+    ):
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be at least 1, got {max_batch_size}")
+        self.session_factory = session_factory
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay_ms = max_batch_delay_ms
+        self.on_error = on_error or self._log_error
+        self.status_cache = status_cache
+        self.dead_letter = dead_letter
+        self.spool = spool
+        self.metrics = metrics
+        self.retry_interval_s = retry_interval_s
+
+        self._buffer = []
+        self._oldest = None  # monotonic time at which the oldest buffered message arrived
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._timer = None
+        self._failure = None  # error of a batch flushed in the background
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # a failed final flush is logged by close and must not hide the error raised in the block
+        self.close(raise_errors=exc_type is None)
+
+    def start(self):
+        """Starts the background thread that enforces `max_batch_delay_ms`."""
+        if self._timer is None:
+            self._timer = threading.Thread(
+                target=self._flush_on_timeout, name="snews-db-batch-writer", daemon=True
+            )
+            self._timer.start()
+
+    def close(self, raise_errors=True):
+        """
+        Stops the background thread and flushes whatever is still buffered.
+
+        If the final flush fails, the error is logged with the number of
+        messages left unwritten.
+
+        Args:
+            raise_errors: Whether the error of the final flush is raised, e.g.
+                          not while another exception is already propagating.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._timer is not None:
+            self._timer.join()
+            self._timer = None
+        try:
+            self.flush()
+        except Exception as e:
+            log.error(
+                f"Error flushing message batch on close, {len(self)} messages not written: {e}"
+            )
+            if raise_errors:
+                raise
+
+    def add(self, message: dict, on_written=None):
+        """
+        Buffers a message, flushing the buffer if it is now full.
+
+        Args:
+            message: The message dict, as accepted by `write_messages_bulk`.
+            on_written: Called without arguments once the message's batch has
+                        committed, including when the message itself was dropped.
+
+        Raises:
+            Exception: The error of a batch that failed in the background since
+                       the last call.
+        """
+        with self._condition:
+            failure, self._failure = self._failure, None
+            if failure is not None:
+                raise failure
+            if not self._buffer:
+                self._oldest = time.monotonic()
+                self._condition.notify_all()
+            self._buffer.append((message, on_written))
+            is_full = len(self._buffer) >= self.max_batch_size
+        if is_full:
+            self.flush()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._buffer)
+
+    def discard(self):
+        """Drops the buffered messages and any background failure, e.g. before rereading them."""
+        with self._condition:
+            self._buffer = []
+            self._oldest = None
+            self._failure = None
+
+    def flush(self):
+        """
+        Writes all buffered messages in a single transaction.
+
+        If the transaction fails, the messages stay buffered to be written
+        by a later flush.
+
+        Returns:
+            The number of messages written.
+        """
+        with self._flush_lock:
+            with self._condition:
+                batch, self._buffer = self._buffer, []
+                oldest, self._oldest = self._oldest, None
+            if not batch:
+                return 0
+            messages = [message for message, _ in batch]
+            try:
+                results = self._write(messages)
+            except Exception:
+                with self._condition:
+                    self._buffer = batch + self._buffer
+                    self._oldest = oldest
+                raise
+
+            failed = 0
+            for message, error in zip(messages, results):
+                if error is not None:
+                    failed += 1
+                    self.on_error(message, error)
+            for _, on_written in batch:
+                if on_written is not None:
+                    on_written()
+            return len(batch) - failed
+
+    def _write(self, messages):
+        if self.spool is not None and self.spool.active:
+            # keep spooling until the backlog is drained
+            self.spool.append(messages)
+            results = [None] * len(messages)
+        else:
+            try:
+                with self.session_factory() as session:
+                    results = write_messages_bulk(
+                        session,
+                        messages,
+                        status_cache=self.status_cache,
+                        dead_letter=self.dead_letter,
+                        metrics=self.metrics,
+                    )
+            except Exception as e:
+                if self.metrics is not None and is_transient_error(e):
+                    self.metrics.errors.inc(kind="transient")
+                spool_usable = self.spool is not None and self.spool.failure is None
+                if not spool_usable or not is_transient_error(e):
+                    raise
+                self.spool.append(messages)
+                results = [None] * len(messages)
+        return results
+
+    def _flush_on_timeout(self):
+        delay = self.max_batch_delay_ms / 1000
+        while True:
+            with self._condition:
+                while not self._closed:
+                    if self._oldest is None:
+                        self._condition.wait()
+                        continue
+                    remaining = self._oldest + delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                log.error(
+                    f"Error flushing message batch, retrying in {self.retry_interval_s} s: {e}"
+                )
+                with self._condition:
+                    self._failure = e
+                    if not self._closed:
+                        self._condition.wait(self.retry_interval_s)
+            else:
+                with self._condition:
+                    # the failed batch is written, the caller need not reread it
+                    self._failure = None
+
+    @staticmethod
+    def _log_error(message, error):
+        log.error(f"Dropped message {message.get('uuid')} from batch: {error}")
@@ -0,0 +1,293 @@
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+from pydantic import TypeAdapter
+from snews.models.messages import create_messages
+
+from snews_db.db_operations import write_messages_bulk
+from snews_db.decoding import loads_json
+
+# Setup logger
+log = logging.getLogger(__name__)
+
+# Lines of a JSON Lines source parsed by one worker task
+CHUNK_LINES = 1000
+# Suffixes of the files picked up from a directory
+MESSAGE_FILE_SUFFIXES = (".json", ".jsonl")
+# Reads an is_test flag the way the message models do
+_IS_TEST = TypeAdapter(bool | None)
+
+
+class LoadUnit(NamedTuple):
+    """A JSON file, or a chunk of lines of a JSON Lines source, parsed as one task."""
+
+    source: str
+    first_line: int | None = None  # None for a JSON file
+    lines: tuple = ()
+
+    @property
+    def is_file(self):
+        return self.first_line is None
+
+
+class ParsedUnit(NamedTuple):
+    source: str
+    first_line: int | None
+    line_count: int
+    messages: list
+    errors: list  # (location, error text) pairs
+
+
+class LoadCheckpoint:
+    """
+    Records which sources a bulk load has written, so that a rerun resumes after them.
+
+    JSON files are recorded once all their messages are committed, and JSON
+    Lines sources by the number of leading lines committed. The checkpoint
+    is saved to `path` (atomically) after every batch; without a path it is
+    only kept in memory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.files = set()
+        self.lines = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.files = set(saved.get("files", []))
+            self.lines = dict(saved.get("lines", {}))
+
+    def is_done(self, source):
+        return source in self.files
+
+    def lines_done(self, source):
+        return self.lines.get(source, 0)
+
+    def mark(self, parsed: ParsedUnit):
+        if parsed.first_line is None:
+            self.files.add(parsed.source)
+        else:
+            self.lines[parsed.source] = parsed.first_line + parsed.line_count
+
+    def save(self):
+        if self.path is None:
+            return
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump({"files": sorted(self.files), "lines": self.lines}, f)
+        os.replace(temporary, self.path)
+
+
+def expand_sources(arguments):
+    """
+    Expands directories and glob patterns into the files they hold, in a stable order.
+
+    Directories are searched recursively for `MESSAGE_FILE_SUFFIXES` files.
+    '-' stands for JSON Lines read from standard input.
+
+    Raises:
+        ValueError: If an argument matches no file.
+    """
+    seen = set()
+    for argument in arguments:
+        if argument == "-":
+            matches = ["-"]
+        elif os.path.isdir(argument):
+            matches = sorted(
+                path
+                for path in glob.glob(os.path.join(argument, "**", "*"), recursive=True)
+                if path.endswith(MESSAGE_FILE_SUFFIXES) and os.path.isfile(path)
+            )
+        elif glob.has_magic(argument):
+            matches = sorted(
+                path for path in glob.glob(argument, recursive=True) if os.path.isfile(path)
+            )
+        else:
+            matches = [argument]
+        if not matches:
+            raise ValueError(f"No message files match '{argument}'")
+        for path in matches:
+            if path not in seen:
+                seen.add(path)
+                yield path
+
+
+def _line_units(source, lines, skip):
+    chunk = []
+    first_line = skip
+    for number, line in enumerate(lines):
+        if number < skip:
+            continue
+        chunk.append(line)
+        if len(chunk) == CHUNK_LINES:
+            yield LoadUnit(source, first_line, tuple(chunk))
+            first_line += len(chunk)
+            chunk = []
+    if chunk:
+        yield LoadUnit(source, first_line, tuple(chunk))
+
+
+def iter_units(arguments, checkpoint=None):
+    """Yields the parse tasks of the sources, leaving out what the checkpoint holds."""
+    checkpoint = checkpoint or LoadCheckpoint()
+    for source in expand_sources(arguments):
+        if source == "-":
+            yield from _line_units(source, sys.stdin, checkpoint.lines_done(source))
+        elif source.endswith(".jsonl"):
+            with open(source) as f:
+                yield from _line_units(source, f, checkpoint.lines_done(source))
+        elif not checkpoint.is_done(source):
+            yield LoadUnit(source)
+
+
+def parse_unit(unit: LoadUnit):
+    """
+    Reads and validates the messages of a task with the SNEWS message models.
+
+    Each JSON object (a JSON file holds one or a list of them, a JSON Lines
+    source one per line) is passed to `create_messages`, like the messages
+    published by the SNEWS tools. The models reject live messages whose
+    neutrino or start time is not within the past 48 hours, which archived
+    messages never are, so objects are validated as test messages (the only
+    checks that differ) and keep their own `is_test` flag.
+
+    Returns:
+        A `ParsedUnit` with the message dicts and the objects that failed.
+    """
+    records = []
+    errors = []
+    if unit.is_file:
+        try:
+            with open(unit.source) as f:
+                data = json.load(f)
+            for message_data in data if isinstance(data, list) else [data]:
+                records.append((unit.source, message_data))
+        except (OSError, ValueError) as e:
+            errors.append((unit.source, f"{type(e).__name__}: {e}"))
+    else:
+        for number, line in enumerate(unit.lines, start=unit.first_line + 1):
+            if not line.strip():
+                continue
+            try:
+                records.append((f"{unit.source}:{number}", loads_json(line)))
+            except ValueError as e:
+                errors.append((f"{unit.source}:{number}", f"{type(e).__name__}: {e}"))
+
+    messages = []
+    for location, message_data in records:
+        try:
+            is_test = _IS_TEST.validate_python(message_data.get("is_test", False))
+            for message in create_messages(**dict(message_data, is_test=True)):
+                snews_message = message.model_dump()
+                snews_message["tier"] = message.tier
+                snews_message["is_test"] = is_test
+                messages.append(snews_message)
+        except Exception as e:
+            errors.append((location, f"{type(e).__name__}: {e}"))
+    return ParsedUnit(unit.source, unit.first_line, len(unit.lines), messages, errors)
+
+
+def _parse_in_order(units, jobs):
+    if jobs == 1:
+        yield from map(parse_unit, units)
+        return
+    # spawn, so no worker inherits database connections
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+        # a bounded window keeps long JSON Lines streams from being read up front
+        pending = deque()
+        for unit in units:
+            pending.append(executor.submit(parse_unit, unit))
+            if len(pending) >= jobs * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def load_messages(
+    arguments,
+    session_factory,
+    batch_size=1000,
+    jobs=None,
+    checkpoint_path=None,
+    on_progress=None,
+    on_error=None,
+    dead_letter=False,
+    metrics=None,
+):
+    """
+    Validates and stores SNEWS messages from many files in batched transactions.
+
+    JSON files, directories, glob patterns and JSON Lines sources ('-' for
+    standard input) are parsed and validated in `jobs` processes, and their
+    messages written `batch_size` at a time with `write_messages_bulk`, in
+    the order of the sources. With a `checkpoint_path`, what is committed is
+    recorded after every batch, and a rerun with the same checkpoint skips it.
+
+    Args:
+        arguments: Paths, directories, glob patterns or '-'.
+        session_factory: A callable returning a new SQLAlchemy session.
+        batch_size: Number of messages written per transaction.
+        jobs: Number of parsing processes. Defaults to the number of CPUs.
+        checkpoint_path: Optional JSON file recording the progress of the load.
+        on_progress: Called with the running totals after every batch.
+        on_error: Called as `on_error(location, error)` for every object that
+                  failed validation or was rejected by the database.
+        dead_letter: Whether messages the database rejects are stored in
+                     dead_letters.
+        metrics: Optional `ListenerMetrics` timing the write stages and
+                 counting the messages written.
+
+    Returns:
+        The totals: files or chunks of lines 'parsed', messages 'written',
+        'invalid' objects and messages 'rejected' by the database.
+
+    Raises:
+        ValueError: If an argument matches no file.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    on_error = on_error or (lambda location, error: log.error(f"{location}: {error}"))
+    checkpoint = LoadCheckpoint(checkpoint_path)
+    totals = {"parsed": 0, "written": 0, "invalid": 0, "rejected": 0}
+    batch = []
+    parsed_units = []
+
+    def flush():
+        if batch:
+            with session_factory() as session:
+                results = write_messages_bulk(
+                    session, batch, dead_letter=dead_letter, metrics=metrics
+                )
+            for snews_message, error in zip(batch, results):
+                if error is None:
+                    totals["written"] += 1
+                else:
+                    totals["rejected"] += 1
+                    on_error(snews_message.get("uuid"), str(error))
+        for parsed in parsed_units:
+            checkpoint.mark(parsed)
+        checkpoint.save()
+        batch.clear()
+        parsed_units.clear()
+        if on_progress is not None:
+            on_progress(dict(totals))
+
+    for parsed in _parse_in_order(iter_units(arguments, checkpoint), jobs):
+        totals["parsed"] += 1
+        for location, error in parsed.errors:
+            totals["invalid"] += 1
+            on_error(location, error)
+        batch.extend(parsed.messages)
+        parsed_units.append(parsed)
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    return totals
@@ -0,0 +1,195 @@
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
+
+import numpy as np
+from sqlalchemy import BigInteger, cast, extract, literal, select, union_all
+
+from snews_db.database.models import CoincidenceTierArchive, TimeTierArchive
+from snews_db.db_operations import to_naive_utc
+
+# Setup logger
+log = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class Signals(NamedTuple):
+    """Archived neutrino times, sorted, as parallel arrays."""
+
+    # microseconds since the epoch (the precision of PostgreSQL timestamps)
+    times: np.ndarray
+    # index of each signal's detector in detector_names
+    detectors: np.ndarray
+    detector_names: np.ndarray
+    # id of each signal's row in its table
+    ids: np.ndarray
+    # table of each signal's row
+    tables: np.ndarray
+
+    def __len__(self):
+        return len(self.times)
+
+
+class Coincidence(NamedTuple):
+    start: datetime
+    end: datetime
+    detector_names: tuple
+    # (table, id) of the signals in the window, oldest first
+    rows: tuple
+
+
+def _times_from(model_class, start, end, is_test, is_firedrill):
+    table = model_class.__table__
+    statement = select(
+        cast(extract("epoch", table.c.neutrino_time_utc) * 1_000_000, BigInteger),
+        table.c.detector_name,
+        table.c.id,
+        literal(table.name),
+    ).where(table.c.neutrino_time_utc.is_not(None))
+    if start is not None:
+        statement = statement.where(table.c.neutrino_time_utc >= start)
+    if end is not None:
+        statement = statement.where(table.c.neutrino_time_utc < end)
+    if is_test is not None:
+        statement = statement.where(table.c.is_test == int(is_test))
+    if is_firedrill is not None and "is_firedrill" in table.c:
+        statement = statement.where(table.c.is_firedrill == int(is_firedrill))
+    return statement
+
+
+def load_signals(
+    engine,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    include_timing: bool = False,
+    is_test: bool | None = None,
+    is_firedrill: bool | None = None,
+    chunk_size: int = 100_000,
+) -> Signals:
+    """
+    Reads the neutrino times of the archive into sorted NumPy arrays.
+
+    Times are converted to integer microseconds by PostgreSQL and streamed
+    `chunk_size` rows at a time through a server-side cursor, so only the
+    arrays are held in memory.
+
+    Args:
+        engine: The SQLAlchemy engine of the database.
+        start: Only signals with a neutrino time at or after this time (naive
+               UTC or timezone-aware).
+        end: Only signals with a neutrino time before this time.
+        include_timing: Whether to add the neutrino times of time_tier_archive
+                        to those of coincidence_tier_archive.
+        is_test: Only test (True) or non-test (False) messages. Defaults to both.
+        is_firedrill: Only firedrill (True) or non-firedrill (False) messages.
+                      Timing tier messages carry no firedrill flag and are
+                      not filtered on it.
+        chunk_size: Number of rows fetched from the server at a time.
+    """
+    start, end = (
+        None if moment is None else to_naive_utc(moment).replace(tzinfo=timezone.utc)
+        for moment in (start, end)
+    )
+    models = [CoincidenceTierArchive] + ([TimeTierArchive] if include_timing else [])
+    statement = union_all(
+        *(_times_from(model, start, end, is_test, is_firedrill) for model in models)
+    )
+
+    times, names, ids, tables = [], [], [], []
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=chunk_size).execute(
+            statement
+        )
+        for rows in result.partitions():
+            chunk_times, chunk_names, chunk_ids, chunk_tables = zip(*rows)
+            times.append(np.array(chunk_times, dtype=np.int64))
+            names.append(np.array(chunk_names, dtype=object))
+            ids.append(np.array(chunk_ids, dtype=np.int64))
+            tables.append(np.array(chunk_tables, dtype=object))
+    if not times:
+        empty = np.array([], dtype=np.int64)
+        return Signals(empty, empty, np.array([], dtype=object), empty, np.array([], dtype=object))
+
+    times = np.concatenate(times)
+    order = np.argsort(times, kind="stable")
+    detector_names, detectors = np.unique(
+        np.concatenate(names)[order].astype(str), return_inverse=True
+    )
+    log.info(f"Loaded {len(times)} neutrino times of {len(detector_names)} detectors")
+    return Signals(
+        times[order],
+        detectors,
+        detector_names,
+        np.concatenate(ids)[order],
+        np.concatenate(tables)[order],
+    )
+
+
+def window_ends(signals: Signals, window_us: int) -> np.ndarray:
+    """Returns, for each signal, the index after the last signal within `window_us` of it."""
+    return np.searchsorted(signals.times, signals.times + window_us, side="right")
+
+
+def count_detectors_in_windows(signals: Signals, ends: np.ndarray) -> np.ndarray:
+    """
+    Counts the distinct detectors in the window opened by each signal.
+
+    The window of signal i holds signals i to ends[i] - 1. With the running
+    count of a detector's signals, the detector is present in a window if
+    its count grows between the window's two ends, so each detector costs
+    a few passes over the arrays and no Python loop runs over the signals.
+
+    Returns:
+        The number of distinct detectors in each signal's window.
+    """
+    counts = np.zeros(len(signals), dtype=np.int32)
+    running = np.zeros(len(signals) + 1, dtype=np.int64)
+    for detector in range(len(signals.detector_names)):
+        np.cumsum(signals.detectors == detector, out=running[1:])
+        counts += running[ends] > running[:-1]
+    return counts
+
+
+def find_coincidences(signals: Signals, window: timedelta, min_detectors: int = 2) -> list:
+    """
+    Finds every window of `window` length holding signals of at least `min_detectors` detectors.
+
+    As in the SNEWS coincidence logic, each window starts at a signal. A
+    window is only reported if it is not contained in the previously reported
+    one, so a burst of signals yields its distinct coincidences rather than
+    one per signal.
+
+    Args:
+        signals: The signals, as returned by `load_signals`.
+        window: Length of the coincidence window.
+        min_detectors: Minimum number of distinct detectors in a window.
+
+    Returns:
+        The `Coincidence`s, oldest first.
+    """
+    if len(signals) == 0:
+        return []
+    window_us = window // timedelta(microseconds=1)
+    ends = window_ends(signals, window_us)
+    counts = count_detectors_in_windows(signals, ends)
+    starts = np.flatnonzero(counts >= min_detectors)
+    # window ends never decrease, so a window is new if it ends after the previous one
+    keep = np.ones(len(starts), dtype=bool)
+    keep[1:] = ends[starts[1:]] > ends[starts[:-1]]
+
+    coincidences = []
+    for first in starts[keep]:
+        last = ends[first]
+        detectors = np.unique(signals.detectors[first:last])
+        coincidences.append(
+            Coincidence(
+                start=EPOCH + timedelta(microseconds=int(signals.times[first])),
+                end=EPOCH + timedelta(microseconds=int(signals.times[last - 1])),
+                detector_names=tuple(signals.detector_names[detectors]),
+                rows=tuple(
+                    zip(signals.tables[first:last].tolist(), signals.ids[first:last].tolist())
+                ),
+            )
+        )
+    return coincidences
@@ -0,0 +1,195 @@
+import csv
+import io
+import logging
+from datetime import datetime, timezone
+from typing import Iterable
+
+import psycopg2
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from snews_db.db_operations import is_transient_error
+from snews_db.decoding import decode_row, loads_json
+
+# Setup logger
+log = logging.getLogger(__name__)
+
+# Marker of a NULL value in the CSV sent to COPY
+COPY_NULL = "\\N"
+
+
+class _CopyNull:
+    """Stands for None in a CSV row; QUOTE_NONNUMERIC takes it for a number, left unquoted."""
+
+    def __float__(self):
+        return float("nan")
+
+    def __str__(self):
+        return COPY_NULL
+
+
+_COPY_NULL = _CopyNull()
+
+
+class _CopyChunk:
+    """In-memory CSV buffer holding the pending rows of one archive table."""
+
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = columns
+        self.entries = []  # (message, values) pairs, kept to retry a rejected chunk row by row
+        self.buffer = io.StringIO()
+        # QUOTE_NONNUMERIC quotes every string, so only the unquoted NULL marker reads as
+        # NULL; it would write None as "", which COPY reads as an empty string
+        self.writer = csv.writer(self.buffer, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
+
+    def append(self, message, values):
+        self.writer.writerow([_to_copy_value(value) for value in values])
+        self.entries.append((message, values))
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def staging_table(self):
+        return f"{self.table.name}_copy_staging"
+
+    @property
+    def create_staging_sql(self):
+        # only the mapped columns, without the constraints of the archive table
+        return (
+            f"CREATE TEMP TABLE IF NOT EXISTS {self.staging_table} ON COMMIT DELETE ROWS AS "
+            f"SELECT {', '.join(self.columns)} FROM {self.table.name} WITH NO DATA"
+        )
+
+    @property
+    def copy_sql(self):
+        return (
+            f"COPY {self.staging_table} ({', '.join(self.columns)}) "
+            f"FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')"
+        )
+
+    @property
+    def merge_sql(self):
+        columns = ", ".join(self.columns)
+        return (
+            f"INSERT INTO {self.table.name} ({columns}) "
+            f"SELECT {columns} FROM {self.staging_table} "
+            f"ON CONFLICT DO NOTHING"
+        )
+
+
+def copy_messages(
+    session: Session,
+    messages: Iterable[dict],
+    chunk_size: int = 10_000,
+    on_error=None,
+):
+    """
+    Streams SNEWS message dicts into the archive tables with COPY FROM STDIN.
+
+    Rows are mapped with `decode_row`, the same mapping used by the live
+    listener, and buffered as CSV per table. Whenever a table's buffer holds
+    `chunk_size` rows it is sent with a single COPY and committed, so memory
+    use is bounded by the chunk size no matter how many messages the iterable
+    yields. COPY cannot skip conflicting rows, so each chunk is copied into a
+    temporary staging table and moved into the archive table with
+    INSERT ... ON CONFLICT DO NOTHING: messages whose uuid is already stored
+    are skipped. If the database rejects a chunk, its rows are inserted one
+    by one under savepoints so that only the offending rows are lost.
+
+    Args:
+        session: The SQLAlchemy session object (on a psycopg2 engine).
+        messages: Any iterable of message dicts, each including its 'tier'.
+                  It is consumed lazily.
+        chunk_size: Number of rows per table sent in each COPY.
+        on_error: Called as `on_error(message, exception)` for every rejected
+                  message. Defaults to logging the error.
+
+    Returns:
+        The number of rows written, not counting skipped duplicates.
+    """
+    on_error = on_error or _log_error
+    received_time = datetime.now(timezone.utc)
+    chunks = {}
+    written = 0
+
+    for snews_message in messages:
+        try:
+            schema, values = decode_row(snews_message, received_time)
+        except Exception as e:
+            on_error(snews_message, e)
+            continue
+        chunk = chunks.get(schema.model_class)
+        if chunk is None:
+            chunk = chunks[schema.model_class] = _CopyChunk(
+                schema.model_class.__table__, schema.columns
+            )
+        chunk.append(snews_message, values)
+        if len(chunk) >= chunk_size:
+            written += _copy_chunk(session, chunk, on_error)
+            del chunks[schema.model_class]
+
+    for chunk in chunks.values():
+        written += _copy_chunk(session, chunk, on_error)
+    return written
+
+
+def _copy_chunk(session, chunk, on_error):
+    chunk.buffer.seek(0)
+    try:
+        with session.begin_nested():
+            cursor = session.connection().connection.cursor()
+            cursor.execute(chunk.create_staging_sql)
+            cursor.copy_expert(chunk.copy_sql, chunk.buffer)
+            cursor.execute(chunk.merge_sql)
+            written = cursor.rowcount
+    except psycopg2.Error as e:
+        if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            raise
+        log.warning(
+            f"COPY into {chunk.table.name} failed ({e.__class__.__name__}), "
+            f"retrying {len(chunk)} rows individually"
+        )
+        statement = insert(chunk.table).on_conflict_do_nothing()
+        written = 0
+        for snews_message, values in chunk.entries:
+            try:
+                with session.begin_nested():
+                    row = dict(zip(chunk.columns, values))
+                    written += session.execute(statement, row).rowcount
+            except SQLAlchemyError as row_error:
+                if is_transient_error(row_error):
+                    raise
+                on_error(snews_message, row_error)
+    session.commit()
+    log.info(f"Copied {written} rows into {chunk.table.name}")
+    return written
+
+
+def _to_copy_value(value):
+    if value is None:
+        return _COPY_NULL
+    if isinstance(value, list):
+        # PostgreSQL array literal, e.g. {0.1,NULL,0.25}
+        return "{" + ",".join("NULL" if item is None else repr(item) for item in value) + "}"
+    return value
+
+
+def iter_jsonl(path: str):
+    """
+    Lazily yields the message dicts stored one per line in a JSON Lines file.
+
+    Args:
+        path: Path of the JSON Lines file. Blank lines are skipped.
+    """
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield loads_json(line)
+
+
+def _log_error(message, error):
+    log.error(f"Skipped message {message.get('uuid')} during COPY: {error}")
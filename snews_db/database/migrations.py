@@ -0,0 +1,347 @@
+import logging
+
+from psycopg2.extras import execute_values
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from snews_db.database.models import Base
+from snews_db.decoding import parse_utc_datetime, to_float_list, to_ns_offsets
+
+# Setup logger
+log = logging.getLogger(__name__)
+
+# Indexes from earlier schema versions, dropped once their replacement is built
+SUPERSEDED_INDEXES = {
+    "sig_tier_archive": ["ix_sig_tier_archive_message_uuid"],
+    "time_tier_archive": ["ix_time_tier_archive_message_uuid"],
+    "coincidence_tier_archive": ["ix_coincidence_tier_archive_message_uuid"],
+    "cached_heartbeats": ["ix_cached_heartbeats_message_uuid"],
+    "retraction_tier_archive": ["ix_retraction_tier_archive_message_uuid"],
+}
+
+
+# Columns stored as text by earlier schema versions, with their typed replacement
+TEXT_COLUMNS = {
+    "sig_tier_archive": {"machine_time_utc": "timestamptz", "p_values": "float8[]"},
+    "time_tier_archive": {
+        "machine_time_utc": "timestamptz",
+        "neutrino_time_utc": "timestamptz",
+        "timing_series": "bigint[]",
+    },
+    "coincidence_tier_archive": {
+        "machine_time_utc": "timestamptz",
+        "neutrino_time_utc": "timestamptz",
+    },
+    "retraction_tier_archive": {"machine_time_utc": "timestamptz"},
+}
+
+
+def _table_exists(connection, name):
+    regclass = connection.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar()
+    return regclass is not None
+
+
+def _is_partitioned(connection, name):
+    relkind = connection.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"), {"name": name}
+    ).scalar()
+    return relkind == "p"
+
+
+def create_indexes_concurrently(engine, tables=None):
+    """
+    Builds the secondary indexes declared on the models without blocking writes.
+
+    Each index is built with CREATE INDEX CONCURRENTLY, which does not take a
+    lock that blocks INSERTs, so the listener can keep writing while a live
+    table is indexed. Indexes that already exist are skipped. An invalid
+    index left behind by an interrupted concurrent build is dropped and
+    rebuilt. Indexes listed in `SUPERSEDED_INDEXES` are dropped (also
+    concurrently) once the table's new indexes are in place.
+
+    Unique indexes cannot be built while the table holds duplicates, so run
+    `delete_duplicate_messages` first on tables written before message_uuid
+    became unique. Partitioned tables are skipped: their indexes are created
+    with the table by `snews_db.database.partitions`.
+
+    Args:
+        engine: The SQLAlchemy engine of the PostgreSQL database.
+        tables: Optional list of table names to restrict the migration to.
+
+    Returns:
+        The names of the indexes that were built.
+
+    Raises:
+        ValueError: If a unique index cannot be built because of duplicate rows.
+    """
+    built = []
+    # CONCURRENTLY cannot run inside a transaction block
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for table in Base.metadata.sorted_tables:
+            if tables is not None and table.name not in tables:
+                continue
+            if not _table_exists(connection, table.name):
+                log.info(f"Table {table.name} does not exist, skipping its indexes")
+                continue
+            if _is_partitioned(connection, table.name):
+                log.info(f"Table {table.name} is partitioned, skipping its indexes")
+                continue
+            for index in sorted(table.indexes, key=lambda i: i.name):
+                is_valid = connection.execute(
+                    text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+                    {"name": index.name},
+                ).scalar()
+                if is_valid:
+                    continue
+                if is_valid is False:
+                    log.warning(f"Dropping invalid index {index.name} left by an aborted build")
+                    connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"'))
+
+                unique = "UNIQUE " if index.unique else ""
+                columns = ", ".join(f'"{column.name}"' for column in index.columns)
+                log.info(f"Building index {index.name} on {table.name} ({columns})")
+                try:
+                    connection.execute(
+                        text(
+                            f'CREATE {unique}INDEX CONCURRENTLY "{index.name}" '
+                            f'ON "{table.name}" ({columns})'
+                        )
+                    )
+                except IntegrityError as e:
+                    # a failed concurrent build leaves an invalid index behind
+                    connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"'))
+                    raise ValueError(
+                        f"Cannot build unique index {index.name}: {table.name} holds duplicate "
+                        f"rows. Remove them with delete_duplicate_messages first."
+                    ) from e
+                built.append(index.name)
+
+            for name in SUPERSEDED_INDEXES.get(table.name, []):
+                connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+    return built
+
+
+def delete_duplicate_messages(engine, tables=None, batch_size=10_000):
+    """
+    Deletes rows whose message_uuid is already stored in an older row.
+
+    For every message_uuid the row with the lowest id is kept. Rows are
+    deleted in transactions of at most `batch_size` rows so that the table is
+    never locked for long.
+
+    Args:
+        engine: The SQLAlchemy engine of the PostgreSQL database.
+        tables: Optional list of table names to restrict the cleanup to.
+        batch_size: Maximum number of rows deleted per transaction.
+
+    Returns:
+        A dict mapping each table name to the number of rows deleted.
+    """
+    deleted = {}
+    for table in Base.metadata.sorted_tables:
+        # only archive tables keep one row per message (dead letters may repeat one)
+        if not any(index.unique and "message_uuid" in index.columns for index in table.indexes):
+            continue
+        if tables is not None and table.name not in tables:
+            continue
+        deleted[table.name] = 0
+        while True:
+            with engine.begin() as connection:
+                if not _table_exists(connection, table.name):
+                    break
+                count = connection.execute(
+                    text(
+                        f'DELETE FROM "{table.name}" WHERE id IN ('
+                        f'SELECT id FROM (SELECT id, row_number() OVER '
+                        f'(PARTITION BY message_uuid ORDER BY id) AS copy_number '
+                        f'FROM "{table.name}" WHERE message_uuid IS NOT NULL) AS copies '
+                        f'WHERE copy_number > 1 LIMIT :batch_size)'
+                    ),
+                    {"batch_size": batch_size},
+                ).rowcount
+            deleted[table.name] += count
+            if count < batch_size:
+                break
+        if deleted[table.name]:
+            log.info(f"Deleted {deleted[table.name]} duplicate rows from {table.name}")
+    return deleted
+
+
+def _column_type(connection, table_name, column_name):
+    return connection.execute(
+        text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_schema = current_schema() "
+            "AND table_name = :table AND column_name = :column"
+        ),
+        {"table": table_name, "column": column_name},
+    ).scalar()
+
+
+def _convert_values(table_name, row, columns):
+    """Converts one row's text values with the converters of the write path."""
+    converted = {}
+    for column in columns:
+        value = row[column]
+        try:
+            if column == "p_values":
+                converted[column] = to_float_list(value, column)
+            elif column == "timing_series":
+                # earlier versions stored timestamps; the reference time is the neutrino time
+                start_time_utc = parse_utc_datetime(row["neutrino_time_utc"], "neutrino_time_utc")
+                converted["start_time_utc"] = start_time_utc
+                converted[column] = to_ns_offsets(value, start_time_utc, column)
+            else:
+                converted[column] = parse_utc_datetime(value, column)
+        except ValueError:
+            log.warning(
+                f"{table_name} row {row['id']}: cannot convert {column}={value!r}, storing NULL"
+            )
+            converted[column] = None
+    return converted
+
+
+def _convert_batch(connection, table_name, columns, last_id, batch_size):
+    selected = list(columns)
+    if "timing_series" in columns and "neutrino_time_utc" not in selected:
+        selected.append("neutrino_time_utc")
+    rows = connection.execute(
+        text(
+            f'SELECT id, {", ".join(selected)} FROM "{table_name}" '
+            f"WHERE id > :last_id ORDER BY id LIMIT :batch_size"
+        ),
+        {"last_id": last_id, "batch_size": batch_size},
+    ).mappings().all()
+    if not rows:
+        return last_id, 0
+
+    targets = {column: f"{column}__typed" for column in columns}
+    types = dict(TEXT_COLUMNS[table_name])
+    if "timing_series" in columns:
+        targets["start_time_utc"] = "start_time_utc"
+        types["start_time_utc"] = "timestamptz"
+    values = []
+    for row in rows:
+        converted = _convert_values(table_name, row, columns)
+        values.append((row["id"], *(converted.get(column) for column in targets)))
+
+    assignments = ", ".join(f'"{target}" = v."{column}"' for column, target in targets.items())
+    cursor = connection.connection.cursor()
+    execute_values(
+        cursor,
+        f'UPDATE "{table_name}" AS t SET {assignments} '
+        f'FROM (VALUES %s) AS v(id, {", ".join(targets)}) WHERE t.id = v.id',
+        values,
+        template="(%s, " + ", ".join(f"%s::{types[column]}" for column in targets) + ")",
+        page_size=len(values),
+    )
+    return rows[-1]["id"], len(rows)
+
+
+def convert_text_columns(engine, tables=None, batch_size=5_000):
+    """
+    Converts the time, p-value and timing series columns stored as text to native types.
+
+    Earlier schema versions stored times as ISO strings, `p_values` as JSON
+    text and `timing_series` as the Python repr of a list of timestamps. For
+    each table in `TEXT_COLUMNS` still holding text, a typed column is added
+    next to each text column and filled in id order, `batch_size` rows per
+    transaction, with the converters of the write path. Timing series become
+    ns offsets from the neutrino time, which is also stored as
+    `start_time_utc`. Values that cannot be converted become NULL and are
+    logged. Rows written meanwhile are caught up under a short SHARE ROW
+    EXCLUSIVE lock, in which the text columns are dropped and the typed ones
+    renamed in their place. Finally the indexes on converted columns are
+    rebuilt concurrently.
+
+    `cached_heartbeats.machine_time_utc` is already a timestamp; it is only
+    changed to timestamptz, which needs no table rewrite when done in UTC.
+
+    The listener must be stopped meanwhile: it writes the native types
+    (e.g. `p_values` as a float8[]), which a column still stored as text
+    rejects.
+
+    Args:
+        engine: The SQLAlchemy engine of the PostgreSQL database.
+        tables: Optional list of table names to restrict the migration to.
+        batch_size: Number of rows converted per transaction.
+
+    Returns:
+        A dict mapping each converted table name to its number of rows.
+    """
+    converted = {}
+    for table_name, column_types in TEXT_COLUMNS.items():
+        if tables is not None and table_name not in tables:
+            continue
+        with engine.begin() as connection:
+            if not _table_exists(connection, table_name):
+                continue
+            columns = [
+                column
+                for column in column_types
+                if _column_type(connection, table_name, column) in ("text", "character varying")
+            ]
+            if not columns:
+                continue
+            for column in columns:
+                connection.execute(
+                    text(
+                        f'ALTER TABLE "{table_name}" '
+                        f'ADD COLUMN IF NOT EXISTS "{column}__typed" {column_types[column]}'
+                    )
+                )
+            if "timing_series" in columns:
+                connection.execute(
+                    text(
+                        f'ALTER TABLE "{table_name}" '
+                        f"ADD COLUMN IF NOT EXISTS start_time_utc timestamptz"
+                    )
+                )
+
+        log.info(f"Converting {', '.join(columns)} of {table_name}")
+        last_id, count = 0, 0
+        while True:
+            with engine.begin() as connection:
+                last_id, batch_count = _convert_batch(
+                    connection, table_name, columns, last_id, batch_size
+                )
+            count += batch_count
+            if batch_count < batch_size:
+                break
+
+        with engine.begin() as connection:
+            connection.execute(text(f'LOCK TABLE "{table_name}" IN SHARE ROW EXCLUSIVE MODE'))
+            while True:
+                last_id, batch_count = _convert_batch(
+                    connection, table_name, columns, last_id, batch_size
+                )
+                count += batch_count
+                if batch_count < batch_size:
+                    break
+            for column in columns:
+                connection.execute(text(f'ALTER TABLE "{table_name}" DROP COLUMN "{column}"'))
+                connection.execute(
+                    text(
+                        f'ALTER TABLE "{table_name}" '
+                        f'RENAME COLUMN "{column}__typed" TO "{column}"'
+                    )
+                )
+        log.info(f"Converted {count} rows of {table_name}")
+        converted[table_name] = count
+
+    with engine.begin() as connection:
+        if (
+            _table_exists(connection, "cached_heartbeats")
+            and _column_type(connection, "cached_heartbeats", "machine_time_utc")
+            == "timestamp without time zone"
+        ):
+            connection.execute(text("SET LOCAL TimeZone = 'UTC'"))
+            connection.execute(
+                text(
+                    "ALTER TABLE cached_heartbeats ALTER COLUMN machine_time_utc TYPE timestamptz"
+                )
+            )
+            converted["cached_heartbeats"] = 0
+
+    create_indexes_concurrently(engine, tables=list(converted))
+    return converted
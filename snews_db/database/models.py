@@ -1,7 +1,10 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float, BigInteger
+from sqlalchemy import (
+    create_engine, Column, Integer, String, DateTime, Float, BigInteger, Index, LargeBinary, Text
+)
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Identity
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 
 Base = declarative_base()
 
@@ -25,15 +28,24 @@ class AllMessages(Base):
 
 class SigTierArchive(Base):
     __tablename__ = "sig_tier_archive"
+    __table_args__ = (
+        Index(
+            "ix_sig_tier_archive_detector_name_received_time_utc",
+            "detector_name",
+            "received_time_utc",
+        ),
+        Index("ix_sig_tier_archive_received_time_utc", "received_time_utc"),
+        Index("uq_sig_tier_archive_message_uuid", "message_uuid", unique=True),
+    )
 
     id = Column(Integer, autoincrement=True, primary_key=True)
     message_id = Column(String)
     message_uuid = Column(String)
     received_time_utc = Column(DateTime)
     detector_name = Column(String)
-    machine_time_utc = Column(String)
+    machine_time_utc = Column(DateTime(timezone=True))
     p_val = Column(Float)
-    p_values = Column(String)
+    p_values = Column(ARRAY(Float))
     t_bin_width_sec = Column(Float)
     is_test = Column(Integer)
 
@@ -47,15 +59,26 @@ class SigTierArchive(Base):
 
 class TimeTierArchive(Base):
     __tablename__ = "time_tier_archive"
+    __table_args__ = (
+        Index(
+            "ix_time_tier_archive_detector_name_received_time_utc",
+            "detector_name",
+            "received_time_utc",
+        ),
+        Index("ix_time_tier_archive_neutrino_time_utc", "neutrino_time_utc"),
+        Index("uq_time_tier_archive_message_uuid", "message_uuid", unique=True),
+    )
 
     id = Column(Integer, autoincrement=True, primary_key=True)
     message_id = Column(String)
     message_uuid = Column(String)
     received_time_utc = Column(DateTime)
     detector_name = Column(String)
-    machine_time_utc = Column(String)
-    neutrino_time_utc = Column(String)
-    timing_series = Column(String)
+    machine_time_utc = Column(DateTime(timezone=True))
+    neutrino_time_utc = Column(DateTime(timezone=True))
+    start_time_utc = Column(DateTime(timezone=True))
+    # ns offsets from start_time_utc
+    timing_series = Column(ARRAY(BigInteger))
     is_test = Column(Integer)
 
     def __repr__(self):
@@ -68,14 +91,23 @@ class TimeTierArchive(Base):
 
 class CoincidenceTierArchive(Base):
     __tablename__ = "coincidence_tier_archive"
+    __table_args__ = (
+        Index("ix_coincidence_tier_archive_neutrino_time_utc", "neutrino_time_utc"),
+        Index(
+            "ix_coincidence_tier_archive_detector_name_received_time_utc",
+            "detector_name",
+            "received_time_utc",
+        ),
+        Index("uq_coincidence_tier_archive_message_uuid", "message_uuid", unique=True),
+    )
 
     id = Column(Integer, autoincrement=True, primary_key=True)
     message_id = Column(String)
     message_uuid = Column(String)
     received_time_utc = Column(DateTime)
     detector_name = Column(String)
-    machine_time_utc = Column(String)
-    neutrino_time_utc = Column(String)
+    machine_time_utc = Column(DateTime(timezone=True))
+    neutrino_time_utc = Column(DateTime(timezone=True))
     p_val = Column(Float)
     is_test = Column(Integer)
     is_firedrill = Column(Integer)
@@ -89,12 +121,21 @@ class CoincidenceTierArchive(Base):
 
 class CachedHeartbeats(Base):
     __tablename__ = "cached_heartbeats"
+    __table_args__ = (
+        Index(
+            "ix_cached_heartbeats_detector_name_received_time_utc",
+            "detector_name",
+            "received_time_utc",
+        ),
+        Index("ix_cached_heartbeats_received_time_utc", "received_time_utc"),
+        Index("uq_cached_heartbeats_message_uuid", "message_uuid", unique=True),
+    )
 
     id = Column(Integer, autoincrement=True, primary_key=True)
     message_id = Column(String)
     message_uuid = Column(String)
     received_time_utc = Column(DateTime)
-    machine_time_utc = Column(DateTime)
+    machine_time_utc = Column(DateTime(timezone=True))
     detector_name = Column(String)
     detector_status = Column(String)
     is_test = Column(Integer)
@@ -107,12 +148,21 @@ class CachedHeartbeats(Base):
 
 class RetractionTierArchive(Base):
     __tablename__ = "retraction_tier_archive"
+    __table_args__ = (
+        Index(
+            "ix_retraction_tier_archive_detector_name_received_time_utc",
+            "detector_name",
+            "received_time_utc",
+        ),
+        Index("uq_retraction_tier_archive_message_uuid", "message_uuid", unique=True),
+    )
+
     id = Column(Integer, autoincrement=True, primary_key=True)
     message_id = Column(String)
     message_uuid = Column(String)
     received_time_utc = Column(DateTime)
     detector_name = Column(String)
-    machine_time_utc = Column(String)
+    machine_time_utc = Column(DateTime(timezone=True))
     detector_status = Column(String)
     is_test = Column(Integer)
 
@@ -122,6 +172,101 @@ class RetractionTierArchive(Base):
             f"received_time_utc='{self.received_time_utc}'"
         )
 
+class DetectorLatestStatus(Base):
+    """Latest heartbeat or retraction status of each detector, kept up to date on write."""
+
+    __tablename__ = "detector_latest_status"
+
+    detector_name = Column(String, primary_key=True)
+    detector_status = Column(String)
+    # tier of the message that set the status, Heartbeat or Retraction
+    tier = Column(String)
+    message_uuid = Column(String)
+    machine_time_utc = Column(DateTime(timezone=True))
+    received_time_utc = Column(DateTime)
+
+    def __repr__(self):
+        return (
+            f"<DetectorLatestStatus(detector='{self.detector_name}', "
+            f"status='{self.detector_status}', received_time_utc='{self.received_time_utc}')>"
+        )
+
+class MessageUuidLedger(Base):
+    """message_uuid of each row of a partitioned archive table, checked before every insert."""
+
+    __tablename__ = "message_uuid_ledger"
+
+    table_name = Column(String, primary_key=True)
+    message_uuid = Column(String, primary_key=True)
+    # received_time_utc of the row, i.e. of the partition holding it
+    received_time_utc = Column(DateTime)
+
+    def __repr__(self):
+        return (
+            f"<MessageUuidLedger(table='{self.table_name}', uuid='{self.message_uuid}', "
+            f"received_time_utc='{self.received_time_utc}')>"
+        )
+
+class HeartbeatMinuteSummary(Base):
+    """Heartbeats of one detector in one minute, rolled up from cached_heartbeats."""
+
+    __tablename__ = "heartbeat_minute_summary"
+
+    detector_name = Column(String, primary_key=True)
+    # start of the minute of received_time_utc
+    minute = Column(DateTime, primary_key=True)
+    heartbeat_count = Column(Integer)
+    # changes of detector_status, including from the previous minute's last status
+    status_transitions = Column(Integer)
+    last_status = Column(String)
+    # received_time_utc of the heartbeat that gave last_status
+    last_received_time_utc = Column(DateTime)
+    # received_time_utc - machine_time_utc, in seconds
+    min_latency_sec = Column(Float)
+    max_latency_sec = Column(Float)
+    mean_latency_sec = Column(Float)
+
+    def __repr__(self):
+        return (
+            f"<HeartbeatMinuteSummary(detector='{self.detector_name}', "
+            f"minute='{self.minute}', count={self.heartbeat_count})>"
+        )
+
+class RollupWatermark(Base):
+    """Time up to which a rollup job has processed its source table."""
+
+    __tablename__ = "rollup_watermarks"
+
+    name = Column(String, primary_key=True)
+    watermark = Column(DateTime)
+
+    def __repr__(self):
+        return f"<RollupWatermark(name='{self.name}', watermark='{self.watermark}')>"
+
+class DeadLetter(Base):
+    """A message the listener could not decode or write, kept to be reprocessed."""
+
+    __tablename__ = "dead_letters"
+
+    id = Column(Integer, Identity(), primary_key=True)
+    received_time_utc = Column(DateTime)
+    tier = Column(String)
+    message_uuid = Column(String)
+    # the decoded message, or NULL if the payload could not be decoded
+    payload = Column(JSONB)
+    # the Kafka payload, kept when it could not be decoded
+    raw_payload = Column(LargeBinary)
+    error_type = Column(String)
+    error = Column(Text)
+    attempts = Column(Integer, default=1)
+    last_attempt_utc = Column(DateTime)
+
+    def __repr__(self):
+        return (
+            f"<DeadLetter(id={self.id}, tier='{self.tier}', "
+            f"message_uuid='{self.message_uuid}', error_type='{self.error_type}')>"
+        )
+
 def create_db_engine(database_url):
     return create_engine(database_url)
 
@@ -0,0 +1,555 @@
+import logging
+import re
+import threading
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+
+from snews_db.database.models import Base, MessageUuidLedger
+from snews_db.database.migrations import _is_partitioned, _table_exists
+from snews_db.db_operations import to_naive_utc
+
+# Setup logger
+log = logging.getLogger(__name__)
+
+# Tables that can be range partitioned by received_time_utc
+PARTITIONED_TABLES = [
+    "sig_tier_archive",
+    "time_tier_archive",
+    "coincidence_tier_archive",
+    "cached_heartbeats",
+    "retraction_tier_archive",
+]
+INTERVALS = ("day", "month")
+# Seconds between two checks of a running listener that its upcoming partitions exist
+MAINTENANCE_INTERVAL_S = 3600
+
+# Trigger skipping the rows of a partitioned table whose message_uuid is in the ledger
+LEDGER_TRIGGER = "message_uuid_ledger_check"
+_LEDGER_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION skip_ledgered_message_uuid() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF NEW.message_uuid IS NULL THEN
+        RETURN NEW;
+    END IF;
+    INSERT INTO {MessageUuidLedger.__tablename__} (table_name, message_uuid, received_time_utc)
+    VALUES (TG_ARGV[0], NEW.message_uuid, NEW.received_time_utc)
+    ON CONFLICT DO NOTHING;
+    IF FOUND THEN
+        RETURN NEW;
+    END IF;
+    -- already stored, possibly under another received_time_utc: skip the row
+    RETURN NULL;
+END
+$$
+"""
+
+_PARTITION_SUFFIX = re.compile(r"_p\d{4}_\d{2}(_\d{2})?$")
+_PARTITION_BOUND = re.compile(r"FROM \((.+)\) TO \((.+)\)")
+
+
+def _utc_now():
+    # received_time_utc is a naive UTC timestamp
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def partition_bounds(moment: datetime, interval: str):
+    """
+    Returns the [start, end) range of the partition holding a moment.
+
+    Args:
+        moment: A naive UTC (or timezone-aware) datetime.
+        interval: The partition size, 'day' or 'month'.
+
+    Returns:
+        The start and end of the partition as naive UTC datetimes.
+    """
+    moment = to_naive_utc(moment)
+    if interval == "day":
+        start = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+        return start, start + timedelta(days=1)
+    if interval == "month":
+        start = moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        return start, (start + timedelta(days=32)).replace(day=1)
+    raise ValueError(f"Unknown partition interval '{interval}', expected one of {INTERVALS}")
+
+
+def partition_name(table_name: str, start: datetime, interval: str):
+    """Returns the name of the partition starting at `start`, e.g. cached_heartbeats_p2024_05."""
+    return f"{table_name}_p{start.strftime('%Y_%m_%d' if interval == 'day' else '%Y_%m')}"
+
+
+def _parse_bound(bound):
+    if bound == "MINVALUE":
+        return None
+    return datetime.fromisoformat(bound.strip("'"))
+
+
+def _partitions(connection, table_name):
+    """Returns (name, start, end) of the partitions of a table, oldest first."""
+    rows = connection.execute(
+        text(
+            "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) "
+            "FROM pg_inherits JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = to_regclass(:table)"
+        ),
+        {"table": table_name},
+    ).all()
+    partitions = []
+    for name, bound in rows:
+        start, end = _PARTITION_BOUND.search(bound).groups()
+        partitions.append((name, _parse_bound(start), _parse_bound(end)))
+    return sorted(partitions, key=lambda partition: partition[2])
+
+
+def _interval_of(table_name, partitions):
+    for name, _, _ in reversed(partitions):
+        match = _PARTITION_SUFFIX.search(name)
+        if match:
+            return "day" if match.group(1) else "month"
+    raise ValueError(f"Cannot tell the partition interval of {table_name} from its partitions")
+
+
+def _parent_indexes(table_name):
+    """
+    Returns (name, unique, columns) of the indexes declared on a model.
+
+    Unique indexes of a partitioned table must include the partition key,
+    so received_time_utc is appended to them (message_uuid is then kept
+    unique by the ledger, see `ensure_uuid_ledger`).
+    """
+    indexes = []
+    for index in sorted(Base.metadata.tables[table_name].indexes, key=lambda i: i.name):
+        columns = [column.name for column in index.columns]
+        if index.unique and "received_time_utc" not in columns:
+            columns.append("received_time_utc")
+        indexes.append((index.name, index.unique, columns))
+    return indexes
+
+
+def _fill_ledger(connection, table_name, after_id=None, source=None):
+    """
+    Adds the message_uuids of a table's rows (with an id above `after_id`) to the ledger.
+
+    With a `source`, e.g. a partition about to be attached, the rows are read
+    from it but recorded under `table_name`.
+    """
+    condition = "message_uuid IS NOT NULL" + ("" if after_id is None else " AND id > :after_id")
+    connection.execute(
+        text(
+            f"INSERT INTO {MessageUuidLedger.__tablename__} "
+            f"(table_name, message_uuid, received_time_utc) "
+            f'SELECT :table, message_uuid, min(received_time_utc) FROM "{source or table_name}" '
+            f"WHERE {condition} GROUP BY message_uuid ON CONFLICT DO NOTHING"
+        ),
+        {"table": table_name, "after_id": after_id},
+    )
+
+
+def _prune_ledger(connection, table_name, start, end):
+    """Removes from the ledger the message_uuids of a table's rows received in [start, end)."""
+    if not _table_exists(connection, MessageUuidLedger.__tablename__):
+        return
+    condition = "received_time_utc < :end"
+    if start is not None:
+        condition += " AND received_time_utc >= :start"
+    connection.execute(
+        text(
+            f"DELETE FROM {MessageUuidLedger.__tablename__} "
+            f"WHERE table_name = :table AND {condition}"
+        ),
+        {"table": table_name, "start": start, "end": end},
+    )
+
+
+def _has_ledger_trigger(connection, table_name):
+    return connection.execute(
+        text(
+            "SELECT EXISTS (SELECT 1 FROM pg_trigger "
+            "WHERE tgrelid = to_regclass(:table) AND tgname = :trigger)"
+        ),
+        {"table": table_name, "trigger": LEDGER_TRIGGER},
+    ).scalar()
+
+
+def _create_ledger_trigger(connection, table_name):
+    connection.execute(text(_LEDGER_FUNCTION))
+    connection.execute(
+        text(
+            f'CREATE TRIGGER {LEDGER_TRIGGER} BEFORE INSERT ON "{table_name}" '
+            f"FOR EACH ROW EXECUTE FUNCTION skip_ledgered_message_uuid('{table_name}')"
+        )
+    )
+
+
+def ensure_uuid_ledger(connection, table_name):
+    """
+    Makes a partitioned table skip rows whose message_uuid it already holds.
+
+    The unique index of a partitioned table must include received_time_utc,
+    which is the time of each write, so it does not catch a redelivery. A
+    trigger instead records the message_uuid of every row in the
+    (unpartitioned) `message_uuid_ledger`, in the inserting transaction, and
+    skips the row if it is already there, like ON CONFLICT DO NOTHING would.
+    Installing it on a table partitioned without it first fills the ledger
+    from the table's rows, with writes blocked meanwhile.
+
+    Args:
+        connection: A connection inside a transaction.
+        table_name: A partitioned archive table.
+
+    Returns:
+        True if the trigger was installed, False if it already was.
+    """
+    if _has_ledger_trigger(connection, table_name):
+        return False
+    MessageUuidLedger.__table__.create(connection, checkfirst=True)
+    connection.execute(text(f'LOCK TABLE "{table_name}" IN SHARE ROW EXCLUSIVE MODE'))
+    _fill_ledger(connection, table_name)
+    _create_ledger_trigger(connection, table_name)
+    log.info(f"Installed the message_uuid ledger check on {table_name}")
+    return True
+
+
+def _has_index(connection, table_name, unique, columns):
+    return connection.execute(
+        text(
+            "SELECT EXISTS (SELECT 1 FROM pg_index AS i "
+            "WHERE i.indrelid = to_regclass(:table) AND i.indisunique = :unique "
+            "AND i.indisvalid AND i.indpred IS NULL AND i.indexprs IS NULL "
+            "AND ARRAY(SELECT a.attname::text FROM unnest(i.indkey::int2[]) "
+            "WITH ORDINALITY AS k(attnum, position) JOIN pg_attribute AS a "
+            "ON a.attrelid = i.indrelid AND a.attnum = k.attnum ORDER BY k.position) "
+            "= CAST(:columns AS text[]))"
+        ),
+        {"table": table_name, "unique": unique, "columns": columns},
+    ).scalar()
+
+
+def _create_partitions(connection, table_name, interval, start, stop):
+    """Creates the partitions of a table covering [start, stop)."""
+    created = []
+    while start < stop:
+        end = partition_bounds(start, interval)[1]
+        name = partition_name(table_name, start, interval)
+        connection.execute(
+            text(
+                f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{table_name}" '
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            )
+        )
+        log.info(f"Created partition {name} for [{start}, {end})")
+        created.append(name)
+        start = end
+    return created
+
+
+def _horizon(interval, ahead):
+    """Returns the end of the partition `ahead` intervals after the current one."""
+    end = partition_bounds(_utc_now(), interval)[1]
+    for _ in range(ahead):
+        end = partition_bounds(end, interval)[1]
+    return end
+
+
+def partition_table(engine, table_name: str, interval: str = "month", ahead: int = 3):
+    """
+    Converts an archive table to a table range partitioned by received_time_utc.
+
+    The existing table is not rewritten: it becomes the partition holding all
+    rows received before the end of the current interval (tomorrow's interval
+    for a conversion just before midnight or month end), and new partitions
+    are created from there on. Before the swap, a CHECK constraint proving
+    the range of the old table is validated and the indexes of the
+    partitioned table are built on it concurrently, so that the swap itself
+    only holds an exclusive lock for as long as a few catalog updates take.
+
+    PostgreSQL requires the unique indexes of a partitioned table to hold the
+    partition key, so message_uuid is only unique together with
+    received_time_utc there, which does not catch a redelivery received at
+    another time. Redeliveries are skipped by the message_uuid ledger
+    instead (see `ensure_uuid_ledger`), filled from the existing rows here.
+
+    Args:
+        engine: The SQLAlchemy engine of the PostgreSQL database.
+        table_name: The table to partition, one of `PARTITIONED_TABLES`.
+        interval: The partition size, 'day' or 'month'.
+        ahead: Number of partitions to create after the current one.
+
+    Returns:
+        True if the table was converted, False if it was already partitioned.
+
+    Raises:
+        ValueError: If the table or interval is unknown, or the table holds
+                    rows without received_time_utc.
+    """
+    if table_name not in PARTITIONED_TABLES:
+        raise ValueError(f"Table '{table_name}' cannot be partitioned")
+    if interval not in INTERVALS:
+        raise ValueError(f"Unknown partition interval '{interval}', expected one of {INTERVALS}")
+
+    legacy = f"{table_name}_legacy"
+    check = f"{legacy}_received_time_utc_check"
+    cutoff = partition_bounds(_utc_now() + timedelta(days=1), interval)[1]
+    indexes = _parent_indexes(table_name)
+
+    # everything that can take long runs without blocking the writers
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        if not _table_exists(connection, table_name):
+            raise ValueError(f"Table '{table_name}' does not exist")
+        if _is_partitioned(connection, table_name):
+            log.info(f"Table {table_name} is already partitioned")
+            return False
+        has_null_times = connection.execute(
+            text(f'SELECT EXISTS (SELECT 1 FROM "{table_name}" WHERE received_time_utc IS NULL)')
+        ).scalar()
+        if has_null_times:
+            raise ValueError(
+                f"Table '{table_name}' holds rows without received_time_utc, "
+                f"which cannot be placed in a partition"
+            )
+
+        connection.execute(text(f'ALTER TABLE "{table_name}" DROP CONSTRAINT IF EXISTS "{check}"'))
+        connection.execute(
+            text(
+                f'ALTER TABLE "{table_name}" ADD CONSTRAINT "{check}" CHECK '
+                f"(received_time_utc IS NOT NULL AND received_time_utc < '{cutoff.isoformat()}') "
+                f"NOT VALID"
+            )
+        )
+        connection.execute(text(f'ALTER TABLE "{table_name}" VALIDATE CONSTRAINT "{check}"'))
+
+        # the bulk of the ledger is filled without blocking writes, the rest under the lock
+        MessageUuidLedger.__table__.create(connection, checkfirst=True)
+        filled_id = connection.execute(text(f'SELECT max(id) FROM "{table_name}"')).scalar()
+        _fill_ledger(connection, table_name)
+
+        for name, unique, columns in indexes:
+            if _has_index(connection, table_name, unique, columns):
+                continue
+            index_name = f"{legacy}_{'_'.join(columns)}"[:59] + ("_key" if unique else "_idx")
+            log.info(f"Building index {index_name} on {table_name} ahead of partitioning")
+            connection.execute(
+                text(
+                    f'CREATE {"UNIQUE " if unique else ""}INDEX CONCURRENTLY IF NOT EXISTS '
+                    f'"{index_name}" ON "{table_name}" ({", ".join(columns)})'
+                )
+            )
+
+    with engine.begin() as connection:
+        connection.execute(text(f'LOCK TABLE "{table_name}" IN ACCESS EXCLUSIVE MODE'))
+        if filled_id is not None:
+            _fill_ledger(connection, table_name, after_id=filled_id)
+        connection.execute(text(f'ALTER TABLE "{table_name}" RENAME TO "{legacy}"'))
+        for name, _, _ in indexes:
+            if _table_exists(connection, name):
+                # free the model's index names for the partitioned table
+                suffix = name[3:].removeprefix(f"{table_name}_")
+                connection.execute(text(f'ALTER INDEX "{name}" RENAME TO "{legacy}_{suffix}"'))
+
+        connection.execute(
+            text(
+                f'CREATE TABLE "{table_name}" (LIKE "{legacy}" INCLUDING DEFAULTS) '
+                f"PARTITION BY RANGE (received_time_utc)"
+            )
+        )
+        # the old table may be dropped one day, the id sequence must outlive it
+        sequence = connection.execute(
+            text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": legacy}
+        ).scalar()
+        if sequence is not None:
+            connection.execute(text(f'ALTER SEQUENCE {sequence} OWNED BY "{table_name}".id'))
+        for name, unique, columns in indexes:
+            connection.execute(
+                text(
+                    f'CREATE {"UNIQUE " if unique else ""}INDEX "{name}" '
+                    f'ON "{table_name}" ({", ".join(columns)})'
+                )
+            )
+
+        connection.execute(
+            text(
+                f'ALTER TABLE "{table_name}" ATTACH PARTITION "{legacy}" '
+                f"FOR VALUES FROM (MINVALUE) TO ('{cutoff.isoformat()}')"
+            )
+        )
+        connection.execute(text(f'ALTER TABLE "{legacy}" DROP CONSTRAINT "{check}"'))
+        _create_ledger_trigger(connection, table_name)
+        stop = max(_horizon(interval, ahead), partition_bounds(cutoff, interval)[1])
+        _create_partitions(connection, table_name, interval, cutoff, stop)
+    log.info(f"Partitioned {table_name} by {interval}, rows before {cutoff} kept in {legacy}")
+    return True
+
+
+def create_partitions(engine, tables=None, ahead: int = 3):
+    """
+    Creates the upcoming partitions of the partitioned archive tables.
+
+    Rows can only be inserted into a partitioned table if a partition covers
+    their received_time_utc, so this should run regularly (the listener runs
+    it on start and then hourly, see `PartitionMaintainer`).
+    Partitions that already exist are left alone. The interval of each table
+    is taken from the names of its partitions. Tables partitioned before the
+    message_uuid ledger existed get it installed (see `ensure_uuid_ledger`).
+
+    Args:
+        engine: The SQLAlchemy engine of the PostgreSQL database.
+        tables: Optional list of table names to restrict the maintenance to.
+        ahead: Number of partitions to have after the current one.
+
+    Returns:
+        The names of the partitions that were created.
+    """
+    created = []
+    for table_name in PARTITIONED_TABLES:
+        if tables is not None and table_name not in tables:
+            continue
+        with engine.begin() as connection:
+            if not _table_exists(connection, table_name):
+                continue
+            if not _is_partitioned(connection, table_name):
+                continue
+            ensure_uuid_ledger(connection, table_name)
+            partitions = _partitions(connection, table_name)
+            interval = _interval_of(table_name, partitions)
+            start = partitions[-1][2]
+            created += _create_partitions(
+                connection, table_name, interval, start, _horizon(interval, ahead)
+            )
+    return created
+
+
+class PartitionMaintainer:
+    """
+    Creates the upcoming partitions of a running listener's tables from a background thread.
+
+    `create_partitions` runs every `interval_s` seconds, so a listener
+    running for longer than the partitions created on its start keeps
+    finding a partition for every row. Errors are logged and retried at
+    the next check.
+
+    Args:
+        engine: The SQLAlchemy engine of the PostgreSQL database.
+        interval_s: Seconds between two checks.
+        ahead: Number of partitions to have after the current one.
+    """
+
+    def __init__(self, engine, interval_s=MAINTENANCE_INTERVAL_S, ahead: int = 3):
+        self.engine = engine
+        self.interval_s = interval_s
+        self.ahead = ahead
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval_s):
+            try:
+                create_partitions(self.engine, ahead=self.ahead)
+            except Exception as e:
+                log.error(f"Error creating the upcoming partitions: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="snews-db-partitions", daemon=True
+            )
+            self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def detach_partitions(engine, older_than: datetime, tables=None, drop: bool = False):
+    """
+    Detaches the partitions holding only rows received before a given time.
+
+    Partitions are detached with DETACH PARTITION CONCURRENTLY (PostgreSQL
+    14+), which does not block writes to the rest of the table. A detached
+    partition is an ordinary table that can be archived and attached again
+    with `attach_partition`; with `drop=True` it is dropped instead, which is
+    how old rows are removed without a DELETE. Either way the message_uuids
+    of its rows are removed from the ledger, which so only grows with the
+    attached partitions.
+
+    Args:
+        engine: The SQLAlchemy engine of the PostgreSQL database.
+        older_than: Partitions whose range ends at or before this time are detached.
+        tables: Optional list of table names to restrict the maintenance to.
+        drop: Whether to drop the detached partitions.
+
+    Returns:
+        A dict mapping each table name to the names of its detached partitions.
+    """
+    older_than = to_naive_utc(older_than)
+    detached = {}
+    # CONCURRENTLY cannot run inside a transaction block
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for table_name in PARTITIONED_TABLES:
+            if tables is not None and table_name not in tables:
+                continue
+            if not _table_exists(connection, table_name):
+                continue
+            if not _is_partitioned(connection, table_name):
+                continue
+            for name, start, end in _partitions(connection, table_name):
+                if end > older_than:
+                    continue
+                connection.execute(
+                    text(f'ALTER TABLE "{table_name}" DETACH PARTITION "{name}" CONCURRENTLY')
+                )
+                _prune_ledger(connection, table_name, start, end)
+                if drop:
+                    connection.execute(text(f'DROP TABLE "{name}"'))
+                log.info(f"{'Dropped' if drop else 'Detached'} partition {name} of {table_name}")
+                detached.setdefault(table_name, []).append(name)
+    return detached
+
+
+def attach_partition(
+    engine, table_name: str, partition: str, start: datetime | None, end: datetime
+):
+    """
+    Attaches a table, e.g. a restored detached partition, as a partition of an archive table.
+
+    A CHECK constraint proving the range is validated first, without blocking
+    writes, so that attaching does not have to scan the table under lock.
+    The message_uuids of its rows are added to the ledger in the attaching
+    transaction, so that redeliveries of them are skipped again.
+
+    Args:
+        engine: The SQLAlchemy engine of the PostgreSQL database.
+        table_name: The partitioned archive table.
+        partition: The table to attach. It must have the archive table's columns.
+        start: The start of its received_time_utc range, None for no lower bound.
+        end: The (exclusive) end of its received_time_utc range.
+    """
+    end = to_naive_utc(end)
+    lower = "MINVALUE" if start is None else f"'{to_naive_utc(start).isoformat()}'"
+    condition = f"received_time_utc IS NOT NULL AND received_time_utc < '{end.isoformat()}'"
+    if start is not None:
+        condition += f" AND received_time_utc >= {lower}"
+    check = f"{partition}_received_time_utc_check"[:63]
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text(f'ALTER TABLE "{partition}" DROP CONSTRAINT IF EXISTS "{check}"'))
+        connection.execute(
+            text(
+                f'ALTER TABLE "{partition}" ADD CONSTRAINT "{check}" '
+                f"CHECK ({condition}) NOT VALID"
+            )
+        )
+        connection.execute(text(f'ALTER TABLE "{partition}" VALIDATE CONSTRAINT "{check}"'))
+    with engine.begin() as connection:
+        if _has_ledger_trigger(connection, table_name):
+            _fill_ledger(connection, table_name, source=partition)
+        connection.execute(
+            text(
+                f'ALTER TABLE "{table_name}" ATTACH PARTITION "{partition}" '
+                f"FOR VALUES FROM ({lower}) TO ('{end.isoformat()}')"
+            )
+        )
+        connection.execute(text(f'ALTER TABLE "{partition}" DROP CONSTRAINT "{check}"'))
+    log.info(f"Attached {partition} to {table_name}")
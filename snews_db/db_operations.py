@@ -1,3 +1,6 @@
+from sqlalchemy import and_, event, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import InterfaceError, OperationalError, SQLAlchemyError
 from sqlalchemy.orm import Session
 from .database.models import (
     AllMessages,
@@ -7,38 +10,73 @@ from .database.models import (
     # CoincidenceTierAlerts, # Assuming this is still commented out or removed
     CachedHeartbeats,
     RetractionTierArchive, # Added import if needed
+    DetectorLatestStatus,
+    DeadLetter,
 )
 from datetime import datetime # Added import for type hinting if needed
 import logging # Added for logging potential errors
 from sqlalchemy.ext.declarative import DeclarativeMeta # Import for type hinting model class
 from snews.models.messages import Tier
+from snews_db.metrics import time_stage
+from snews_db.decoding import (
+    TIER_SCHEMAS,
+    check_valid_date,
+    decode_row,
+    dumps_json,
+    loads_json,
+    parse_utc_datetime,
+    to_float_list,
+    to_ns_offsets,
+)
 from datetime import datetime, timezone
+import time
 
 # Setup logger
 log = logging.getLogger(__name__)
 
-def check_valid_date(date_string: str | None, field_name: str):
+# Most bind parameters in one statement; asyncpg (and the Postgres protocol) allow 32767
+MAX_BIND_PARAMETERS = 32767
+
+def to_naive_utc(moment: datetime):
+    """Converts a datetime to the naive UTC form stored in received_time_utc."""
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+def is_transient_error(error: Exception):
     """
-    Checks if the input string is a valid ISO 8601 date/datetime string.
+    Tells whether a write failed because of the database connection rather than the row.
 
-    Args:
-        date_string: The string to validate. Can be None.
-        field_name: The name of the field being checked (for error messages).
+    Such errors are raised instead of being reported per message, so callers
+    can retry or reread the messages instead of dropping them.
+    """
+    return isinstance(error, (OperationalError, InterfaceError)) or getattr(
+        error, "connection_invalidated", False
+    )
 
-    Raises:
-        ValueError: If the string is not None and not a valid ISO 8601 format.
+def _insert_unless_duplicate(
+    session: Session, model_class: DeclarativeMeta, commit: bool, **values
+):
     """
-    if date_string is None:
-        # Allow None if the database schema permits nullable dates
-        return
-    try:
-        # Attempt to parse using ISO 8601 format.
-        # Handle potential 'Z' timezone indicator by replacing it.
-        datetime.fromisoformat(str(date_string).replace('Z', '+00:00'))
-    except (ValueError, TypeError) as e:
-        error_message = f"Invalid date string format for field '{field_name}': '{date_string}'. Error: {e}"
-        log.error(error_message)
-        raise ValueError(error_message) from e
+    Inserts one archive row unless a row with the same message_uuid is stored.
+
+    The duplicate check is done by the database (INSERT ... ON CONFLICT DO
+    NOTHING on the unique message_uuid index), so it costs no extra query.
+    The conflict target is left out so that the same statement works on
+    partitioned tables, whose unique index also holds received_time_utc.
+
+    Returns:
+        The new entry, or None if the message was already stored.
+    """
+    new_entry = session.scalars(
+        insert(model_class)
+        .values(**values)
+        .on_conflict_do_nothing()
+        .returning(model_class)
+    ).one_or_none()
+    if commit:
+        session.commit()
+    return new_entry
 
 # --- AllMessages ---
 def add_all_message(
@@ -48,6 +86,7 @@ def add_all_message(
     message_type: str,
     message: str,
     expiration: str,
+    commit: bool = True,
 ):
     """Adds a generic message entry."""
 
@@ -60,7 +99,8 @@ def add_all_message(
         expiration=expiration,
     )
     session.add(new_message)
-    session.commit()
+    if commit:
+        session.commit()
     return new_message
 
 # --- SigTierArchive ---
@@ -70,17 +110,26 @@ def add_sig_tier_archive(
     message_uuid: str,
     received_time_utc: datetime,
     detector_name: str,
-    machine_time_utc: str | None, # Allow None based on schema/usage
+    machine_time_utc: str | datetime | None, # Allow None based on schema/usage
     p_val: float | None,
-    p_values: str, # Assuming this is a JSON string or similar representation
+    p_values: list[float] | str, # Legacy JSON text is accepted too
     t_bin_width_sec: float | None,
     is_test: int,
+    commit: bool = True,
 ):
-    """Adds a Significance Tier message archive entry."""
-    # Example usage: Check date strings before creating the object
-    check_valid_date(machine_time_utc, "machine_time_utc")
+    """
+    Adds a Significance Tier message archive entry.
 
-    new_entry = SigTierArchive(
+    Returns None without writing anything if its message_uuid is already stored.
+    """
+    # Convert once here so the driver gets typed values
+    machine_time_utc = parse_utc_datetime(machine_time_utc, "machine_time_utc")
+    p_values = to_float_list(p_values, "p_values")
+
+    return _insert_unless_duplicate(
+        session,
+        SigTierArchive,
+        commit,
         message_id=message_id,
         message_uuid=message_uuid,
         received_time_utc=received_time_utc, # Assumed to be a valid datetime object already
@@ -91,9 +140,6 @@ def add_sig_tier_archive(
         t_bin_width_sec=t_bin_width_sec,
         is_test=is_test,
     )
-    session.add(new_entry)
-    session.commit()
-    return new_entry
 
 # --- TimeTierArchive ---
 def add_time_tier_archive(
@@ -102,28 +148,40 @@ def add_time_tier_archive(
     message_uuid: str,
     received_time_utc: datetime,
     detector_name: str,
-    machine_time_utc: str | None,
-    neutrino_time_utc: str | None,
-    timing_series: str, # Assuming this is a JSON string or similar representation
+    machine_time_utc: str | datetime | None,
+    neutrino_time_utc: str | datetime | None,
+    timing_series: list[int] | list[str] | str, # ns offsets, or timestamps from older messages
     is_test: int,
+    start_time_utc: str | datetime | None = None,
+    commit: bool = True,
 ):
-    """Adds a Timing Tier message archive entry."""
-    check_valid_date(machine_time_utc, "machine_time_utc")
-    check_valid_date(neutrino_time_utc, "neutrino_time_utc")
+    """
+    Adds a Timing Tier message archive entry.
 
-    new_entry = TimeTierArchive(
+    The timing series is stored as ns offsets from `start_time_utc`, which
+    defaults to the neutrino time when the message has no start time.
+
+    Returns None without writing anything if its message_uuid is already stored.
+    """
+    machine_time_utc = parse_utc_datetime(machine_time_utc, "machine_time_utc")
+    neutrino_time_utc = parse_utc_datetime(neutrino_time_utc, "neutrino_time_utc")
+    start_time_utc = parse_utc_datetime(start_time_utc, "start_time_utc") or neutrino_time_utc
+    timing_series = to_ns_offsets(timing_series, start_time_utc)
+
+    return _insert_unless_duplicate(
+        session,
+        TimeTierArchive,
+        commit,
         message_id=message_id,
         message_uuid=message_uuid,
         received_time_utc=received_time_utc, # Assumed to be a valid datetime object already
         detector_name=detector_name,
         machine_time_utc=machine_time_utc,
         neutrino_time_utc=neutrino_time_utc,
+        start_time_utc=start_time_utc,
         timing_series=timing_series,
         is_test=is_test,
     )
-    session.add(new_entry)
-    session.commit()
-    return new_entry
 
 # --- CoincidenceTierArchive ---
 def add_coincidence_tier_archive(
@@ -132,17 +190,25 @@ def add_coincidence_tier_archive(
     message_uuid: str,
     received_time_utc: datetime,
     detector_name: str,
-    machine_time_utc: str | None,
-    neutrino_time_utc: str | None,
+    machine_time_utc: str | datetime | None,
+    neutrino_time_utc: str | datetime | None,
     p_val: float | None,
     is_test: int,
     is_firedrill: int,
+    commit: bool = True,
 ):
-    """Adds a Coincidence Tier message archive entry."""
-    check_valid_date(machine_time_utc, "machine_time_utc")
-    check_valid_date(neutrino_time_utc, "neutrino_time_utc")
+    """
+    Adds a Coincidence Tier message archive entry.
+
+    Returns None without writing anything if its message_uuid is already stored.
+    """
+    machine_time_utc = parse_utc_datetime(machine_time_utc, "machine_time_utc")
+    neutrino_time_utc = parse_utc_datetime(neutrino_time_utc, "neutrino_time_utc")
 
-    new_entry = CoincidenceTierArchive(
+    return _insert_unless_duplicate(
+        session,
+        CoincidenceTierArchive,
+        commit,
         message_id=message_id,
         message_uuid=message_uuid,
         received_time_utc=received_time_utc, # Assumed to be a valid datetime object already
@@ -153,9 +219,6 @@ def add_coincidence_tier_archive(
         is_test=is_test,
         is_firedrill=is_firedrill,
     )
-    session.add(new_entry)
-    session.commit()
-    return new_entry
 
 # --- CachedHeartbeats ---
 def add_cached_heartbeats(
@@ -163,15 +226,23 @@ def add_cached_heartbeats(
     message_id: str,
     message_uuid: str,
     received_time_utc: datetime,
-    machine_time_utc: str | None, # Changed type hint to datetime, assuming conversion happens before call
+    machine_time_utc: str | datetime | None,
     detector_name: str,
     detector_status: str,
     is_test: int,
+    commit: bool = True,
 ):
-    """Adds a Cached Heartbeat entry."""
+    """
+    Adds a Cached Heartbeat entry.
+
+    Returns None without writing anything if its message_uuid is already stored.
+    """
 
-    check_valid_date(machine_time_utc, "machine_time_utc")
-    new_entry = CachedHeartbeats(
+    machine_time_utc = parse_utc_datetime(machine_time_utc, "machine_time_utc")
+    return _insert_unless_duplicate(
+        session,
+        CachedHeartbeats,
+        commit,
         message_id=message_id,
         message_uuid=message_uuid,
         received_time_utc=received_time_utc, # Assumed to be a valid datetime object already
@@ -180,9 +251,6 @@ def add_cached_heartbeats(
         detector_status=detector_status,
         is_test=is_test,
     )
-    session.add(new_entry)
-    session.commit()
-    return new_entry
 
 # --- RetractionTierArchive ---
 def add_retraction_tier_archive(
@@ -191,14 +259,22 @@ def add_retraction_tier_archive(
     message_uuid: str,
     received_time_utc: datetime,
     detector_name: str,
-    machine_time_utc: str | None,
+    machine_time_utc: str | datetime | None,
     detector_status: str,
     is_test: int,
+    commit: bool = True,
 ):
-    """Adds a Retraction Tier message archive entry."""
-    check_valid_date(machine_time_utc, "machine_time_utc")
+    """
+    Adds a Retraction Tier message archive entry.
+
+    Returns None without writing anything if its message_uuid is already stored.
+    """
+    machine_time_utc = parse_utc_datetime(machine_time_utc, "machine_time_utc")
 
-    new_entry = RetractionTierArchive(
+    return _insert_unless_duplicate(
+        session,
+        RetractionTierArchive,
+        commit,
         message_id=message_id,
         message_uuid=message_uuid,
         received_time_utc=received_time_utc, # Assumed to be a valid datetime object already
@@ -207,9 +283,49 @@ def add_retraction_tier_archive(
         detector_status=detector_status,
         is_test=is_test,
     )
-    session.add(new_entry)
-    session.commit()
-    return new_entry
+
+# --- Time Range Queries ---
+def received_between(model_class: DeclarativeMeta, start: datetime, end: datetime):
+    """
+    Returns a filter on the rows of a table received in [start, end).
+
+    received_time_utc is a naive UTC timestamp, so the bounds are converted
+    to naive UTC first: comparing the column to timezone-aware values would
+    cast every row to timestamptz and keep PostgreSQL from pruning the
+    partitions of a partitioned table.
+
+    Args:
+        model_class: The SQLAlchemy model class of an archive table.
+        start: The start of the range, naive UTC or timezone-aware.
+        end: The (exclusive) end of the range, naive UTC or timezone-aware.
+    """
+    column = model_class.received_time_utc
+    return and_(column >= to_naive_utc(start), column < to_naive_utc(end))
+
+def get_received_between(
+    session: Session,
+    model_class: DeclarativeMeta,
+    start: datetime,
+    end: datetime,
+    detector_name: str | None = None,
+):
+    """
+    Returns the rows of a table received in [start, end), oldest first.
+
+    On a partitioned table only the partitions overlapping the range are
+    scanned.
+
+    Args:
+        session: The SQLAlchemy session object.
+        model_class: The SQLAlchemy model class of an archive table.
+        start: The start of the range, naive UTC or timezone-aware.
+        end: The (exclusive) end of the range, naive UTC or timezone-aware.
+        detector_name: Optional detector to restrict the rows to.
+    """
+    statement = select(model_class).where(received_between(model_class, start, end))
+    if detector_name is not None:
+        statement = statement.where(model_class.detector_name == detector_name)
+    return session.scalars(statement.order_by(model_class.received_time_utc)).all()
 
 # --- Generic Delete Operation ---
 def delete_all_from_table(session: Session, model_class: DeclarativeMeta):
@@ -259,60 +375,384 @@ def get_p_val(snews_message):
     else:
         return None
 
-def write_arbitrary_message(session: Session, snews_message: dict):
-    message_tier = snews_message['tier']
-    received_time = str(datetime.now(timezone.utc))
-    if message_tier == Tier.COINCIDENCE_TIER:
-        add_coincidence_tier_archive(session,
-                                        message_id=snews_message["id"],
-                                        message_uuid=snews_message["uuid"],
-                                        received_time_utc=received_time,
-                                        detector_name=snews_message["detector_name"],
-                                        machine_time_utc=get_machine_time(snews_message),
-                                        neutrino_time_utc=snews_message["neutrino_time_utc"],
-                                        p_val=get_p_val(snews_message),
-                                        is_test=int(snews_message["is_test"]),
-                                        is_firedrill=int(snews_message["is_firedrill"]))
-
-    elif message_tier == Tier.SIGNIFICANCE_TIER:
-        add_sig_tier_archive(session,
-                                message_id=snews_message["id"],
-                                message_uuid=snews_message["uuid"],
-                                received_time_utc=received_time,
-                                detector_name=snews_message["detector_name"],
-                                machine_time_utc=get_machine_time(snews_message),
-                                p_val=get_p_val(snews_message),
-                                p_values=snews_message["p_values"],
-                                t_bin_width_sec=float(snews_message["t_bin_width_sec"]),
-                                is_test=int(snews_message["is_test"]))
-
-    elif message_tier == Tier.HEART_BEAT:
-        add_cached_heartbeats(session,
-                                message_id=snews_message["id"],
-                                message_uuid=snews_message["uuid"],
-                                received_time_utc=received_time,
-                                machine_time_utc=get_machine_time(snews_message),
-                                detector_name=snews_message['detector_name'],
-                                detector_status=snews_message['detector_status'],
-                                is_test=int(snews_message["is_test"]))
-
-    elif message_tier == Tier.RETRACTION:
-        add_retraction_tier_archive(session,
-                                    message_id=snews_message["id"],
-                                    message_uuid=snews_message["uuid"],
-                                    received_time_utc=received_time,
-                                    detector_name=snews_message["detector_name"],
-                                    machine_time_utc=get_machine_time(snews_message),
-                                    detector_status=snews_message["detector_status"],
-                                    is_test=int(snews_message["is_test"]))
-
-    elif message_tier == Tier.TIMING_TIER:
-        add_time_tier_archive(session,
-                                message_id=snews_message["id"],
-                                message_uuid=snews_message["uuid"],
-                                received_time_utc=received_time,
-                                detector_name=snews_message["detector_name"],
-                                machine_time_utc=get_machine_time(snews_message),
-                                neutrino_time_utc= get_neutrino_time_utc(snews_message), # snews_message["neutrino_time_utc"],
-                                timing_series=str(snews_message["timing_series"]),
-                                is_test=int(snews_message["is_test"]))
+def write_arbitrary_message(
+    session: Session, snews_message: dict, commit: bool = True, status_cache=None, metrics=None
+):
+    """
+    Writes a SNEWS message dict to the archive table matching its tier.
+
+    Args:
+        session: The SQLAlchemy session object.
+        snews_message: The message as a dict, including its 'tier'.
+        commit: Whether to commit right away. Pass False to leave the row
+                uncommitted so that several messages can share one
+                transaction.
+        status_cache: Optional `LatestStatusCache` kept up to date with the
+                      heartbeats and retractions written.
+        metrics: Optional `ListenerMetrics` timing the validate, insert and
+                 commit stages and counting the message.
+
+    The row is built from the tier's schema in `snews_db.decoding.TIER_SCHEMAS`,
+    like in the bulk, COPY and async writers. A message whose uuid is already
+    stored in its tier's table is skipped. Heartbeats and retractions also
+    update the detector's row in detector_latest_status, in the same
+    transaction.
+
+    Raises:
+        ValueError: If the tier is unknown or a field cannot be converted.
+    """
+    try:
+        with time_stage(metrics, "validate"):
+            schema, values = decode_row(snews_message, to_naive_utc(datetime.now(timezone.utc)))
+    except Exception:
+        if metrics is not None:
+            metrics.errors.inc(kind="invalid")
+        raise
+    try:
+        with time_stage(metrics, "insert"):
+            entry = _insert_unless_duplicate(
+                session, schema.model_class, False, **dict(zip(schema.columns, values))
+            )
+            if entry is not None:
+                row = {
+                    column.key: getattr(entry, column.key) for column in entry.__table__.columns
+                }
+                status = latest_status_from_row(type(entry), row)
+                if status is not None:
+                    upsert_latest_statuses(session, [status], status_cache)
+        if commit:
+            with time_stage(metrics, "commit"):
+                session.commit()
+    except SQLAlchemyError as e:
+        if metrics is not None and not is_transient_error(e):
+            metrics.errors.inc(kind="rejected")
+        raise
+    if metrics is not None:
+        metrics.messages_written.inc(tier=TIER_NAMES[schema.model_class])
+
+
+# Tier name of each archive table
+TIER_NAMES = {schema.model_class: Tier(tier).value for tier, schema in TIER_SCHEMAS.items()}
+# Tiers whose messages carry a detector status
+STATUS_TIERS = {
+    schema.model_class: Tier(tier).value
+    for tier, schema in TIER_SCHEMAS.items()
+    if "detector_status" in schema.columns
+}
+
+def latest_status_from_row(model_class: DeclarativeMeta, row: dict):
+    """
+    Returns the detector_latest_status values set by an archive row.
+
+    Args:
+        model_class: The model class of the archive table.
+        row: The column values of the row.
+
+    Returns:
+        A dict of detector_latest_status columns, or None if the row's tier
+        carries no detector status.
+    """
+    tier = STATUS_TIERS.get(model_class)
+    if tier is None:
+        return None
+    return {
+        "detector_name": row["detector_name"],
+        "detector_status": row["detector_status"],
+        "tier": tier,
+        "message_uuid": row["message_uuid"],
+        "machine_time_utc": row["machine_time_utc"],
+        "received_time_utc": to_naive_utc(row["received_time_utc"]),
+    }
+
+
+def _apply_statuses_on_commit(session):
+    if session.in_nested_transaction():
+        return
+    for status_cache, status in session.info.pop("pending_statuses", []):
+        status_cache.update(status)
+
+
+def _discard_pending_statuses(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("pending_statuses", None)
+
+
+def _update_cache_on_commit(session, status_cache, statuses):
+    """Records statuses in `status_cache` once the session's transaction commits."""
+    if not session.info.get("status_listeners"):
+        event.listen(session, "after_commit", _apply_statuses_on_commit)
+        # a rollback ends the transaction without committing it
+        event.listen(session, "after_transaction_end", _discard_pending_statuses)
+        session.info["status_listeners"] = True
+    session.info.setdefault("pending_statuses", []).extend(
+        (status_cache, status) for status in statuses
+    )
+
+
+def upsert_latest_statuses(session: Session, statuses: list[dict], status_cache=None):
+    """
+    Mirrors the newest of the given statuses of each detector to detector_latest_status.
+
+    All detectors are written with one INSERT ... ON CONFLICT DO UPDATE,
+    which only replaces a stored status by a more recently received one, so
+    concurrent writers cannot move a detector back in time. The upsert runs
+    under a savepoint: if it fails, the error is logged and the rest of the
+    transaction is kept, since the archive rows matter more than the mirror.
+
+    Args:
+        session: The SQLAlchemy session object.
+        statuses: Dicts as returned by `latest_status_from_row`, oldest
+                  first: of two statuses received at the same time, the
+                  later one wins.
+        status_cache: Optional `LatestStatusCache` to update once the
+                      transaction commits. Statuses older than the cached
+                      ones are not written.
+    """
+    newest = {}
+    for status in statuses:
+        known = newest.get(status["detector_name"])
+        if known is None or known["received_time_utc"] <= status["received_time_utc"]:
+            newest[status["detector_name"]] = status
+    if status_cache is not None:
+        newest = {
+            name: status for name, status in newest.items()
+            if not status_cache.is_outdated(status)
+        }
+    if not newest:
+        return
+
+    # a fixed row order keeps concurrent upserts from deadlocking
+    statement = insert(DetectorLatestStatus).values([newest[name] for name in sorted(newest)])
+    statement = statement.on_conflict_do_update(
+        index_elements=["detector_name"],
+        set_={
+            column: statement.excluded[column]
+            for column in ("detector_status", "tier", "message_uuid", "machine_time_utc",
+                           "received_time_utc")
+        },
+        where=DetectorLatestStatus.received_time_utc <= statement.excluded.received_time_utc,
+    )
+    try:
+        with session.begin_nested():
+            session.execute(statement)
+    except SQLAlchemyError as e:
+        if is_transient_error(e):
+            raise
+        log.error(f"Error updating the latest status of {', '.join(sorted(newest))}: {e}")
+        return
+    if status_cache is not None:
+        _update_cache_on_commit(session, status_cache, newest.values())
+
+def get_latest_statuses(session: Session):
+    """
+    Returns the latest status of every detector, by detector name.
+
+    This reads the small detector_latest_status table instead of searching
+    the heartbeat history.
+    """
+    rows = session.scalars(
+        select(DetectorLatestStatus).order_by(DetectorLatestStatus.detector_name)
+    )
+    return {row.detector_name: row for row in rows}
+
+
+def message_to_row(snews_message: dict, received_time_utc):
+    """
+    Maps a SNEWS message dict onto a row of the archive table for its tier.
+
+    Uses the same field mapping and conversions as `write_arbitrary_message`
+    (see `snews_db.decoding.decode_row`).
+
+    Args:
+        snews_message: The message as a dict, including its 'tier'.
+        received_time_utc: The time the message was received.
+
+    Returns:
+        A `(model_class, row)` tuple where `row` is a dict of column values.
+
+    Raises:
+        ValueError: If the tier is unknown or a field cannot be converted.
+    """
+    schema, values = decode_row(snews_message, received_time_utc)
+    return schema.model_class, dict(zip(schema.columns, values))
+
+def write_messages_bulk(
+    session: Session,
+    messages: list[dict],
+    commit: bool = True,
+    status_cache=None,
+    dead_letter: bool = False,
+    received_times: list[datetime] | None = None,
+    metrics=None,
+):
+    """
+    Writes many SNEWS message dicts with one multi-row INSERT per archive table.
+
+    Messages are grouped by tier and inserted through SQLAlchemy Core, without
+    creating an ORM object per row; a batch with more values than
+    `MAX_BIND_PARAMETERS` is split across INSERTs. Messages whose uuid is
+    already stored are skipped by the database (ON CONFLICT DO NOTHING) and
+    count as written. If the database rejects a table's insert, its rows are
+    retried one by one under savepoints so that only the offending rows are
+    lost. The newest heartbeat or retraction of each detector then updates
+    detector_latest_status in a single upsert.
+
+    Args:
+        session: The SQLAlchemy session object.
+        messages: The messages as dicts, each including its 'tier'.
+        commit: Whether to commit once all tables are written.
+        status_cache: Optional `LatestStatusCache` kept up to date with the
+                      heartbeats and retractions written.
+        dead_letter: Whether to store the rejected messages in dead_letters,
+                     in the same transaction as the written ones.
+        received_times: Optional time each message was received. Defaults to now.
+        metrics: Optional `ListenerMetrics` timing the validate, insert and
+                 commit stages and counting the messages written and rejected.
+
+    Returns:
+        A list with one entry per message, in input order: None if the
+        message was written, otherwise the exception that rejected it.
+    """
+    results = [None] * len(messages)
+    # naive like the received_time_utc column, which strict drivers (asyncpg) require
+    received_time = to_naive_utc(datetime.now(timezone.utc))
+
+    rows_by_model = {}
+    with time_stage(metrics, "validate"):
+        for index, snews_message in enumerate(messages):
+            if received_times is not None:
+                received_time = to_naive_utc(received_times[index])
+            try:
+                model_class, row = message_to_row(snews_message, received_time)
+            except Exception as e:
+                results[index] = e
+                continue
+            rows_by_model.setdefault(model_class, []).append((index, row))
+    if metrics is not None and any(results):
+        metrics.errors.inc(sum(error is not None for error in results), kind="invalid")
+
+    insert_started = time.perf_counter()
+    for model_class, indexed_rows in rows_by_model.items():
+        table = model_class.__table__
+        statement = insert(table).on_conflict_do_nothing()
+        rows = [row for _, row in indexed_rows]
+        # one INSERT for the whole batch, unless its parameters would exceed the limit
+        page_size = max(1, min(len(rows), MAX_BIND_PARAMETERS // len(table.columns)))
+        try:
+            with session.begin_nested():
+                session.execute(
+                    statement.execution_options(insertmanyvalues_page_size=page_size),
+                    rows,
+                )
+        except SQLAlchemyError as e:
+            if is_transient_error(e):
+                raise
+            log.warning(
+                f"Bulk insert into {table.name} failed ({e.__class__.__name__}), "
+                f"retrying {len(rows)} rows individually"
+            )
+            for index, row in indexed_rows:
+                try:
+                    with session.begin_nested():
+                        session.execute(statement, row)
+                except SQLAlchemyError as row_error:
+                    if is_transient_error(row_error):
+                        raise
+                    results[index] = row_error
+
+    # in input order, so that of two statuses received at the same time the later one wins
+    statuses = sorted(
+        (index, latest_status_from_row(model_class, row))
+        for model_class, indexed_rows in rows_by_model.items()
+        if model_class in STATUS_TIERS
+        for index, row in indexed_rows
+        if results[index] is None
+    )
+    if statuses:
+        upsert_latest_statuses(session, [status for _, status in statuses], status_cache)
+
+    if dead_letter:
+        rejected = [
+            dead_letter_row(error, snews_message=snews_message)
+            for snews_message, error in zip(messages, results)
+            if error is not None
+        ]
+        if rejected:
+            add_dead_letters(session, rejected)
+    if metrics is not None:
+        metrics.stage_duration.observe(time.perf_counter() - insert_started, stage="insert")
+
+    if commit:
+        with time_stage(metrics, "commit"):
+            session.commit()
+    if metrics is not None:
+        for model_class, indexed_rows in rows_by_model.items():
+            written = sum(results[index] is None for index, _ in indexed_rows)
+            if written:
+                metrics.messages_written.inc(written, tier=TIER_NAMES[model_class])
+            if written < len(indexed_rows):
+                metrics.errors.inc(len(indexed_rows) - written, kind="rejected")
+    return results
+
+
+def dead_letter_row(
+    error: Exception,
+    snews_message: dict | None = None,
+    raw_payload: bytes | str | None = None,
+    received_time_utc: datetime | None = None,
+):
+    """
+    Returns the dead_letters values of a message that could not be decoded or written.
+
+    Args:
+        error: The exception that rejected the message.
+        snews_message: The decoded message, if it could be decoded.
+        raw_payload: The Kafka payload, kept when the message could not be decoded.
+        received_time_utc: The time the message was received. Defaults to now.
+
+    Returns:
+        A dict of dead_letters columns.
+    """
+    now = to_naive_utc(datetime.now(timezone.utc))
+    tier = uuid = payload = None
+    if snews_message is not None:
+        tier = snews_message.get("tier")
+        tier = getattr(tier, "value", tier)
+        uuid = snews_message.get("uuid")
+        # a JSON-compatible copy, as messages may hold datetimes or NumPy values
+        payload = loads_json(dumps_json(snews_message))
+    if isinstance(raw_payload, str):
+        raw_payload = raw_payload.encode()
+    return {
+        "received_time_utc": (
+            to_naive_utc(received_time_utc) if received_time_utc is not None else now
+        ),
+        "tier": str(tier) if tier is not None else None,
+        "message_uuid": str(uuid) if uuid is not None else None,
+        "payload": payload,
+        "raw_payload": raw_payload if payload is None else None,
+        "error_type": type(error).__name__,
+        "error": str(error),
+        "attempts": 1,
+        "last_attempt_utc": now,
+    }
+
+
+def add_dead_letters(session: Session, rows: list[dict]):
+    """
+    Stores messages that could not be decoded or written, with one INSERT.
+
+    The insert runs under a savepoint: if it fails, the error is logged and
+    the rest of the transaction is kept.
+
+    Args:
+        session: The SQLAlchemy session object.
+        rows: Dicts as returned by `dead_letter_row`.
+    """
+    try:
+        with session.begin_nested():
+            session.execute(insert(DeadLetter), rows)
+    except SQLAlchemyError as e:
+        if is_transient_error(e):
+            raise
+        log.error(f"Error storing {len(rows)} dead letters: {e}")
@@ -0,0 +1,95 @@
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import delete, select, update
+
+from snews_db.database.models import DeadLetter
+from snews_db.db_operations import to_naive_utc, write_messages_bulk
+from snews_db.decoding import decode_payload
+
+# Setup logger
+log = logging.getLogger(__name__)
+
+
+def _decode_dead_letter(row):
+    if row.payload is not None:
+        return row.payload
+    snews_message = decode_payload(row.raw_payload)
+    if snews_message is None:
+        raise ValueError("The payload does not hold a SNEWS message")
+    return snews_message
+
+
+def reprocess_dead_letters(session_factory, batch_size=500, tiers=None, status_cache=None):
+    """
+    Writes the messages stored in dead_letters again, e.g. after a fix is deployed.
+
+    Dead letters are read in id order, `batch_size` at a time, and each batch
+    is written with `write_messages_bulk` under the time the messages were
+    first received. Messages that are written (or were stored meanwhile) are
+    deleted from dead_letters in the same transaction; the others stay, with
+    their new error and one more attempt counted. Rows are locked while they
+    are processed, so concurrent runs skip each other's batches.
+
+    Args:
+        session_factory: A callable returning a new SQLAlchemy session.
+        batch_size: Number of dead letters written per transaction.
+        tiers: Optional list of tier names to restrict the reprocessing to.
+        status_cache: Optional `LatestStatusCache` kept up to date with the
+                      heartbeats and retractions written.
+
+    Returns:
+        A dict with the number of dead letters 'written' and still 'failed'.
+    """
+    counts = {"written": 0, "failed": 0}
+    last_id = 0
+    while True:
+        with session_factory() as session:
+            query = select(DeadLetter).where(DeadLetter.id > last_id)
+            if tiers is not None:
+                query = query.where(DeadLetter.tier.in_(tiers))
+            rows = session.scalars(
+                query.order_by(DeadLetter.id).limit(batch_size).with_for_update(skip_locked=True)
+            ).all()
+            if not rows:
+                return counts
+            last_id = rows[-1].id
+
+            results = {}
+            decoded = []
+            for row in rows:
+                try:
+                    decoded.append((row, _decode_dead_letter(row)))
+                except Exception as e:
+                    results[row.id] = e
+            written = write_messages_bulk(
+                session,
+                [snews_message for _, snews_message in decoded],
+                commit=False,
+                status_cache=status_cache,
+                received_times=[row.received_time_utc for row, _ in decoded],
+            )
+            for (row, _), error in zip(decoded, written):
+                results[row.id] = error
+
+            done = [row_id for row_id, error in results.items() if error is None]
+            if done:
+                session.execute(delete(DeadLetter).where(DeadLetter.id.in_(done)))
+            now = to_naive_utc(datetime.now(timezone.utc))
+            for row_id, error in results.items():
+                if error is None:
+                    continue
+                session.execute(
+                    update(DeadLetter)
+                    .where(DeadLetter.id == row_id)
+                    .values(
+                        attempts=DeadLetter.attempts + 1,
+                        error_type=type(error).__name__,
+                        error=str(error),
+                        last_attempt_utc=now,
+                    )
+                )
+            session.commit()
+        counts["written"] += len(done)
+        counts["failed"] += len(results) - len(done)
+        log.info(f"Reprocessed dead letters up to id {last_id}: {counts}")
@@ -0,0 +1,557 @@
+import ast
+import importlib
+import io
+import json
+import logging
+import pickle
+from datetime import date, datetime, timedelta, timezone
+from enum import EnumMeta
+from functools import lru_cache, partial
+from typing import Callable, NamedTuple
+
+import numpy as np
+from snews.models.messages import Tier
+
+from snews_db.database.models import (
+    CachedHeartbeats,
+    CoincidenceTierArchive,
+    RetractionTierArchive,
+    SigTierArchive,
+    TimeTierArchive,
+)
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+# Setup logger
+log = logging.getLogger(__name__)
+
+# Classes a pickled message may refer to, as (module, qualified name) pairs
+PICKLE_CLASSES = frozenset({
+    ("snews.models.messages", "HeartbeatMessage"),
+    ("snews.models.messages", "RetractionMessage"),
+    ("snews.models.messages", "TimingTierMessage"),
+    ("snews.models.messages", "SignificanceTierMessage"),
+    ("snews.models.messages", "CoincidenceTierMessage"),
+    ("snews.models.messages", "Tier"),
+    ("datetime", "datetime"),
+    ("datetime", "timezone"),
+    ("datetime", "timedelta"),
+    # pydantic pickles the names of the fields set as a set (a global before protocol 4)
+    ("builtins", "set"),
+})
+
+# Number of distinct timestamp strings whose parsed value is remembered
+TIMESTAMP_CACHE_SIZE = 4096
+
+
+class _ModelFields:
+    """Stands in for a pickled pydantic model, keeping only its field values."""
+
+    __slots__ = ("fields",)
+
+    def __setstate__(self, state):
+        # pydantic models pickle their fields under '__dict__' and extra fields apart
+        self.fields = dict(state["__dict__"])
+        if state.get("__pydantic_extra__"):
+            self.fields.update(state["__pydantic_extra__"])
+
+
+class _MessageUnpickler(pickle.Unpickler):
+    """
+    Unpickler that only accepts SNEWS message models and plain data.
+
+    Models are not rebuilt: their field values are read into `_ModelFields`,
+    so no model (or any other) code runs while decoding.
+    """
+
+    _classes = {}  # (module, name) -> class, shared by all instances
+
+    def find_class(self, module, name):
+        if module == "__builtin__":
+            # the Python 2 name of builtins, used by protocols 2 and 3
+            module = "builtins"
+        found = self._classes.get((module, name))
+        if found is not None:
+            return found
+        # attribute paths ('a.b') and dunders would reach past the allowed classes
+        if "." in name or "__" in name or (module, name) not in PICKLE_CLASSES:
+            raise pickle.UnpicklingError(f"Refusing to unpickle {module}.{name} from a message")
+        found = getattr(importlib.import_module(module), name)
+        if isinstance(found, type) and hasattr(found, "model_fields"):
+            found = _ModelFields
+        elif isinstance(found, EnumMeta):
+            # members are pickled as a call of their class with their value
+            found = found._value2member_map_.__getitem__
+        self._classes[(module, name)] = found
+        return found
+
+
+def loads_json(payload: bytes | str):
+    """Parses a JSON payload, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def dumps_json(value) -> bytes:
+    """
+    Serializes a message dict to JSON, with orjson when it is installed.
+
+    Datetimes become ISO 8601 text, NumPy arrays lists and enums their value.
+    """
+    if orjson is not None:
+        return orjson.dumps(value, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(value, default=_json_default).encode()
+
+
+def decode_payload(payload):
+    """
+    Turns the content of a Kafka message into a SNEWS message dict.
+
+    JSON payloads are parsed directly. Pickled payloads are only unpickled
+    if they hold SNEWS message models (see `PICKLE_CLASSES`), and the
+    model's field values are read from the pickle without rebuilding the
+    model or calling `model_dump()`, as the messages hold no nested models.
+
+    Args:
+        payload: The message content: pickled bytes, JSON bytes or text, or
+                 an already parsed dict.
+
+    Returns:
+        The message dict, or None if the payload is not a message.
+
+    Raises:
+        ValueError: If the payload cannot be decoded.
+        pickle.UnpicklingError: If a pickled payload refers to other classes.
+    """
+    if isinstance(payload, dict):
+        return payload
+    if isinstance(payload, bytes) and payload[:1] == b"\x80":
+        # pickle protocol 2 or later
+        decoded = _MessageUnpickler(io.BytesIO(payload)).load()
+        if isinstance(decoded, _ModelFields):
+            return decoded.fields
+        return decoded if isinstance(decoded, dict) else None
+    if isinstance(payload, (bytes, str)):
+        decoded = loads_json(payload)
+        return decoded if isinstance(decoded, dict) else None
+    return None
+
+
+def check_valid_date(date_string: str | None, field_name: str):
+    """
+    Checks if the input string is a valid ISO 8601 date/datetime string.
+
+    Args:
+        date_string: The string to validate. Can be None.
+        field_name: The name of the field being checked (for error messages).
+
+    Returns:
+        The parsed UTC datetime, or None if `date_string` is None.
+
+    Raises:
+        ValueError: If the string is not None and not a valid ISO 8601 format.
+    """
+    return parse_utc_datetime(date_string, field_name)
+
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def _parse_utc_text(text: str) -> datetime:
+    # datetime.fromisoformat accepts the 'Z' suffix and nanoseconds since Python 3.11;
+    # datetimes are immutable, so callers can share the cached values
+    parsed = datetime.fromisoformat(text)
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def parse_utc_datetime(date_value: str | datetime | None, field_name: str):
+    """
+    Parses an ISO 8601 date/datetime into a timezone-aware UTC datetime.
+
+    Values without a timezone are taken to be UTC. Datetime objects are only
+    normalized to UTC. Precision beyond microseconds is truncated. The most
+    recently parsed strings are cached (see `TIMESTAMP_CACHE_SIZE`), as the
+    same time often appears in many messages.
+
+    Args:
+        date_value: The string or datetime to parse. Can be None.
+        field_name: The name of the field being parsed (for error messages).
+
+    Returns:
+        The UTC datetime, or None if `date_value` is None.
+
+    Raises:
+        ValueError: If the value is not a valid ISO 8601 format.
+    """
+    if date_value is None:
+        # Allow None if the database schema permits nullable dates
+        return None
+    if isinstance(date_value, datetime):
+        if date_value.tzinfo is None:
+            return date_value.replace(tzinfo=timezone.utc)
+        return date_value.astimezone(timezone.utc)
+    try:
+        return _parse_utc_text(str(date_value))
+    except (ValueError, TypeError) as e:
+        error_message = (
+            f"Invalid date string format for field '{field_name}': '{date_value}'. Error: {e}"
+        )
+        log.error(error_message)
+        raise ValueError(error_message) from e
+
+
+def to_float_list(values, field_name: str):
+    """
+    Converts a series of numbers to a list of floats for a float8[] column.
+
+    Args:
+        values: A list of numbers, or its JSON (or Python repr) text as stored
+                by earlier versions. Can be None.
+        field_name: The name of the field being converted (for error messages).
+
+    Returns:
+        The list of floats, or None if `values` is None.
+
+    Raises:
+        ValueError: If the values are not a flat series of numbers.
+    """
+    if values is None:
+        return None
+    try:
+        if isinstance(values, str):
+            values = json.loads(values)
+        return [float(value) for value in values]
+    except (ValueError, TypeError) as e:
+        error_message = f"Invalid number series for field '{field_name}': '{values}'. Error: {e}"
+        log.error(error_message)
+        raise ValueError(error_message) from e
+
+
+def to_ns_offsets(
+    timing_series, start_time_utc: datetime | None, field_name: str = "timing_series"
+):
+    """
+    Converts a timing series to integer nanosecond offsets for a bigint[] column.
+
+    Integer entries are already offsets in ns (the current SNEWS format) and
+    are kept as they are. Timestamp entries (older messages) are converted to
+    their offset from `start_time_utc`. A series made only of UTC timestamps
+    (or a NumPy datetime64 array) is converted at once as a datetime64[ns]
+    array, keeping nanoseconds; other timestamps are parsed one by one, to
+    microsecond precision.
+
+    Args:
+        timing_series: A list of ns offsets or ISO 8601 timestamps, or its
+                       Python repr as stored by earlier versions. Can be None.
+        start_time_utc: The reference time of the offsets.
+        field_name: The name of the field being converted (for error messages).
+
+    Returns:
+        The list of offsets, or None if `timing_series` is None.
+
+    Raises:
+        ValueError: If an entry is neither an integer nor a valid timestamp,
+                    or timestamps are given without a reference time.
+    """
+    if timing_series is None:
+        return None
+    if isinstance(timing_series, str):
+        try:
+            timing_series = ast.literal_eval(timing_series)
+        except (ValueError, SyntaxError) as e:
+            raise ValueError(
+                f"Invalid timing series for field '{field_name}': '{timing_series}'"
+            ) from e
+    if isinstance(timing_series, np.ndarray):
+        if timing_series.dtype.kind in "iu":
+            return timing_series.astype(np.int64).tolist()
+        if timing_series.dtype.kind == "M":
+            return _datetime64_offsets(timing_series, start_time_utc, field_name)
+    elif timing_series and all(type(value) is str for value in timing_series):
+        offsets = _timestamp_offsets(timing_series, start_time_utc, field_name)
+        if offsets is not None:
+            return offsets
+    offsets = []
+    for value in timing_series:
+        if isinstance(value, (int, np.integer)) and not isinstance(value, bool):
+            offsets.append(int(value))
+            continue
+        if start_time_utc is None:
+            raise ValueError(
+                f"Field '{field_name}' holds timestamps but no reference time is given"
+            )
+        offset = parse_utc_datetime(value, field_name) - start_time_utc
+        offsets.append(offset // timedelta(microseconds=1) * 1000)
+    return offsets
+
+
+def _timestamp_offsets(timestamps, start_time_utc, field_name):
+    # NumPy only parses timestamps without a timezone: drop the UTC designator
+    # and leave timestamps with an explicit UTC offset to the per-value path
+    texts = np.array(timestamps)
+    texts = np.where(np.char.endswith(texts, "Z"), np.char.rstrip(texts, "Z"), texts)
+    time_parts = np.char.partition(texts, "T")[:, 2]
+    if (np.char.find(time_parts, "+") >= 0).any() or (np.char.find(time_parts, "-") >= 0).any():
+        return None
+    try:
+        stamps = texts.astype("datetime64[ns]")
+    except ValueError:
+        # let the per-value path report the invalid entry
+        return None
+    return _datetime64_offsets(stamps, start_time_utc, field_name)
+
+
+def _datetime64_offsets(stamps, start_time_utc, field_name):
+    if start_time_utc is None:
+        raise ValueError(f"Field '{field_name}' holds timestamps but no reference time is given")
+    if np.isnat(stamps).any():
+        raise ValueError(f"Field '{field_name}' holds an invalid timestamp")
+    start = np.datetime64(start_time_utc.astimezone(timezone.utc).replace(tzinfo=None), "ns")
+    return (stamps.astype("datetime64[ns]") - start).astype(np.int64).tolist()
+
+
+def _optional_float(value):
+    return float(value) if value is not None else None
+
+
+class TierField(NamedTuple):
+    """
+    How one column of a tier's archive row is read from a message.
+
+    Attributes:
+        column: The column name.
+        keys: The message keys holding the value, tried in order. Empty for
+              the time the message was received.
+        convert: Optional function applied to the value.
+        reference: Optional earlier column whose value is passed to `convert`
+                   as a second argument (e.g. the start of a timing series).
+        default: Optional earlier column whose value is used when the value
+                 is None.
+        required: Whether a message without any of the `keys` is rejected.
+                  Otherwise the value is None.
+    """
+
+    column: str
+    keys: tuple = ()
+    convert: Callable | None = None
+    reference: str | None = None
+    default: str | None = None
+    required: bool = True
+
+
+class TierSchema(NamedTuple):
+    """The archive table of a tier and how a message of that tier maps onto its row."""
+
+    model_class: type
+    columns: tuple
+    build_row: Callable
+    fields: tuple = ()
+
+
+def _field_reader(field):
+    """Returns a function reading the raw value of `field` from a message."""
+    keys = field.keys
+    if len(keys) == 1 and field.required:
+        key = keys[0]
+        return lambda message: message[key]
+    if len(keys) == 1:
+        key = keys[0]
+        return lambda message: message.get(key)
+    label = field.column.removesuffix("_utc").replace("_", " ")
+
+    def read(message):
+        for key in keys:
+            if key in message:
+                return message[key]
+        if field.required:
+            raise ValueError(f"No {label} key found in message")
+        return None
+
+    return read
+
+
+def make_row_builder(fields, name="build_row"):
+    """
+    Makes a function building the row tuple of a tier from a message.
+
+    The reader, converter and related columns of every field are resolved
+    once here, so building a row only runs them in column order.
+
+    Args:
+        fields: The `TierField`s of the row, in column order.
+        name: The name of the returned function.
+
+    Returns:
+        A function `(message, received_time_utc) -> tuple`.
+
+    Raises:
+        ValueError: If a field refers to a column that does not precede it.
+    """
+    positions = {}
+    steps = []
+    for n, field in enumerate(fields):
+        for related in (field.reference, field.default):
+            if related is not None and related not in positions:
+                raise ValueError(f"Field '{field.column}' refers to unknown column '{related}'")
+        steps.append((
+            _field_reader(field) if field.keys else None,
+            field.convert,
+            positions.get(field.reference),
+            positions.get(field.default),
+        ))
+        positions[field.column] = n
+    steps = tuple(steps)
+
+    def build_row(message, received_time_utc):
+        values = []
+        for read, convert, reference, default in steps:
+            value = received_time_utc if read is None else read(message)
+            if convert is not None:
+                value = convert(value) if reference is None else convert(value, values[reference])
+            if value is None and default is not None:
+                value = values[default]
+            values.append(value)
+        return tuple(values)
+
+    build_row.__name__ = build_row.__qualname__ = name
+    return build_row
+
+
+# Tier name -> schema; Tier is a str enum, so plain tier names find their schema too
+TIER_SCHEMAS = {}
+
+
+def register_tier(tier, model_class, fields):
+    """
+    Declares how the messages of a tier are written to its archive table.
+
+    Every writer (single-row, bulk, COPY and async) builds its rows from the
+    registered schema, so a tier or field added here is handled by all of them.
+
+    Args:
+        tier: The `Tier` of the messages.
+        model_class: The model class of the tier's archive table.
+        fields: The `TierField`s of the table's columns.
+
+    Returns:
+        The registered `TierSchema`.
+    """
+    fields = tuple(fields)
+    schema = TierSchema(
+        model_class,
+        tuple(field.column for field in fields),
+        make_row_builder(fields, name=f"build_{model_class.__tablename__}_row"),
+        fields,
+    )
+    TIER_SCHEMAS[tier] = schema
+    return schema
+
+
+COMMON_FIELDS = (
+    TierField("message_id", ("id",)),
+    TierField("message_uuid", ("uuid",)),
+    TierField("received_time_utc"),
+    TierField("detector_name", ("detector_name",)),
+    TierField(
+        "machine_time_utc",
+        ("machine_time", "machine_time_utc"),
+        convert=partial(parse_utc_datetime, field_name="machine_time_utc"),
+    ),
+    TierField("is_test", ("is_test",), convert=int),
+)
+
+COMMON_COLUMNS = tuple(field.column for field in COMMON_FIELDS)
+
+register_tier(
+    Tier.HEART_BEAT,
+    CachedHeartbeats,
+    COMMON_FIELDS + (TierField("detector_status", ("detector_status",)),),
+)
+register_tier(
+    Tier.RETRACTION,
+    RetractionTierArchive,
+    COMMON_FIELDS + (TierField("detector_status", ("detector_status",)),),
+)
+register_tier(
+    Tier.COINCIDENCE_TIER,
+    CoincidenceTierArchive,
+    COMMON_FIELDS + (
+        TierField(
+            "neutrino_time_utc",
+            ("neutrino_time_utc",),
+            convert=partial(parse_utc_datetime, field_name="neutrino_time_utc"),
+        ),
+        TierField("p_val", ("p_val",), convert=_optional_float),
+        TierField("is_firedrill", ("is_firedrill",), convert=int),
+    ),
+)
+register_tier(
+    Tier.SIGNIFICANCE_TIER,
+    SigTierArchive,
+    COMMON_FIELDS + (
+        TierField("p_val", ("p_val",), convert=_optional_float),
+        TierField(
+            "p_values", ("p_values",), convert=partial(to_float_list, field_name="p_values")
+        ),
+        TierField("t_bin_width_sec", ("t_bin_width_sec",), convert=float),
+    ),
+)
+register_tier(
+    Tier.TIMING_TIER,
+    TimeTierArchive,
+    COMMON_FIELDS + (
+        TierField(
+            "neutrino_time_utc",
+            ("neutrino_time_utc", "neutrino_time", "sent_time_utc"),
+            convert=partial(parse_utc_datetime, field_name="neutrino_time_utc"),
+        ),
+        TierField(
+            "start_time_utc",
+            ("start_time_utc",),
+            convert=partial(parse_utc_datetime, field_name="start_time_utc"),
+            default="neutrino_time_utc",
+            required=False,
+        ),
+        TierField(
+            "timing_series", ("timing_series",), convert=to_ns_offsets, reference="start_time_utc"
+        ),
+    ),
+)
+
+
+def decode_row(snews_message: dict, received_time_utc):
+    """
+    Maps a SNEWS message dict onto a row tuple of its tier's archive table.
+
+    Produces the same values as `message_to_row`, as a tuple ordered like
+    the `columns` of the tier's `TierSchema`.
+
+    Args:
+        snews_message: The message as a dict, including its 'tier'.
+        received_time_utc: The time the message was received.
+
+    Returns:
+        A `(schema, values)` tuple.
+
+    Raises:
+        ValueError: If the tier is unknown or a field cannot be converted.
+        KeyError: If a required field is missing.
+    """
+    schema = TIER_SCHEMAS.get(snews_message["tier"])
+    if schema is None:
+        raise ValueError(f"Unknown message tier: '{snews_message['tier']}'")
+    return schema, schema.build_row(snews_message, received_time_utc)
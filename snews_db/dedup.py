@@ -0,0 +1,56 @@
+import threading
+from collections import OrderedDict
+
+
+class RecentMessageCache:
+    """
+    Remembers the keys of the most recently handled messages.
+
+    The listener uses it to drop Kafka redeliveries before they reach the
+    database. The unique message_uuid indexes stay the actual guarantee
+    against duplicates; the cache only saves the round trip for the
+    duplicates it still remembers. Once `capacity` keys are stored, the least
+    recently seen key is forgotten.
+
+    Args:
+        capacity: Maximum number of keys to remember.
+    """
+
+    def __init__(self, capacity=100_000):
+        if capacity < 1:
+            raise ValueError(f"capacity must be at least 1, got {capacity}")
+        self.capacity = capacity
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check_and_add(self, key):
+        """
+        Records a key, telling whether it was already known.
+
+        Args:
+            key: Any hashable identifying the message, e.g. `(tier, uuid)`.
+
+        Returns:
+            True if the key was already in the cache, False if it was added.
+        """
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                return True
+            self._keys[key] = None
+            if len(self._keys) > self.capacity:
+                self._keys.popitem(last=False)
+            return False
+
+    def discard(self, key):
+        """Forgets a key, e.g. because the message it stands for failed to be written."""
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._keys
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys)
@@ -0,0 +1,129 @@
+import logging
+import os
+from datetime import datetime
+
+from sqlalchemy import BigInteger, Boolean, DateTime, Float, Integer, select
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from snews_db.db_operations import to_naive_utc
+from snews_db.decoding import TIER_SCHEMAS
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover - pyarrow is optional
+    pyarrow = None
+
+# Setup logger
+log = logging.getLogger(__name__)
+
+# Tables that can be exported, by name: the archive table of every registered tier
+EXPORT_TABLES = {
+    schema.model_class.__tablename__: schema.model_class.__table__
+    for schema in TIER_SCHEMAS.values()
+}
+
+
+def _arrow_type(column_type):
+    """Returns the Arrow type of a column's values, e.g. list<double> for p_values."""
+    if isinstance(column_type, ARRAY):
+        return pyarrow.list_(_arrow_type(column_type.item_type))
+    if isinstance(column_type, DateTime):
+        # received_time_utc is stored as naive UTC, the other times as timestamptz
+        return pyarrow.timestamp("us", tz="UTC")
+    if isinstance(column_type, (Integer, BigInteger)):
+        return pyarrow.int64()
+    if isinstance(column_type, Float):
+        return pyarrow.float64()
+    if isinstance(column_type, Boolean):
+        return pyarrow.bool_()
+    return pyarrow.string()
+
+
+def arrow_schema(table):
+    """Returns the Arrow schema of the Parquet files exported from a table."""
+    if pyarrow is None:
+        raise ImportError("Exporting to Parquet requires pyarrow (pip install snews-db[parquet])")
+    return pyarrow.schema(
+        [pyarrow.field(column.name, _arrow_type(column.type)) for column in table.columns]
+    )
+
+
+def export_table(
+    engine,
+    table_name: str,
+    path: str,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    detector_name: str | None = None,
+    chunk_size: int = 50_000,
+):
+    """
+    Streams the rows of an archive table into a Parquet file.
+
+    Rows are read oldest first through a server-side cursor, `chunk_size`
+    at a time, and each chunk is written as one row group, so memory stays
+    bounded whatever the size of the table. p_values and timing_series
+    become list columns of float64 and int64 (nanosecond offsets from
+    start_time_utc), and times are UTC timestamps. The file is written
+    next to `path` and renamed once complete.
+
+    Args:
+        engine: The SQLAlchemy engine of the database.
+        table_name: One of `EXPORT_TABLES`.
+        path: The Parquet file to write.
+        start: Only export rows received at or after this time (naive UTC or
+               timezone-aware).
+        end: Only export rows received before this time.
+        detector_name: Only export the rows of this detector.
+        chunk_size: Number of rows fetched and written at a time.
+
+    Returns:
+        The number of rows exported.
+
+    Raises:
+        ValueError: If the table cannot be exported.
+        ImportError: If pyarrow is not installed.
+    """
+    table = EXPORT_TABLES.get(table_name)
+    if table is None:
+        raise ValueError(f"Cannot export table {table_name}")
+    schema = arrow_schema(table)
+
+    statement = select(*table.columns)
+    if start is not None:
+        statement = statement.where(table.c.received_time_utc >= to_naive_utc(start))
+    if end is not None:
+        statement = statement.where(table.c.received_time_utc < to_naive_utc(end))
+    if detector_name is not None:
+        statement = statement.where(table.c.detector_name == detector_name)
+    statement = statement.order_by(table.c.received_time_utc, table.c.id)
+
+    exported = 0
+    temporary = f"{path}.tmp"
+    try:
+        with engine.connect() as connection, pyarrow.parquet.ParquetWriter(
+            temporary, schema, compression="zstd"
+        ) as writer:
+            result = connection.execution_options(
+                stream_results=True, yield_per=chunk_size
+            ).execute(statement)
+            for rows in result.partitions():
+                columns = list(zip(*rows))
+                writer.write_table(
+                    pyarrow.Table.from_arrays(
+                        [
+                            pyarrow.array(values, type=field.type)
+                            for values, field in zip(columns, schema)
+                        ],
+                        schema=schema,
+                    )
+                )
+                exported += len(rows)
+                log.debug(f"Exported {exported} rows of {table_name}")
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    os.replace(temporary, path)
+    return exported
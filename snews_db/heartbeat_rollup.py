@@ -0,0 +1,229 @@
+import logging
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+
+from snews_db.database.models import HeartbeatMinuteSummary, RollupWatermark
+
+# Setup logger
+log = logging.getLogger(__name__)
+
+WATERMARK_NAME = HeartbeatMinuteSummary.__tablename__
+
+# Deletes the raw heartbeats received in [start, stop) and summarizes exactly those rows,
+# one row per detector and minute, returning the number of minutes and of rows.
+# A minute already in the summary (e.g. heartbeats written late) is merged, not overwritten,
+# and keeps its last status unless the merged rows were received after it.
+ROLLUP_SQL = f"""
+WITH deleted AS (
+    DELETE FROM cached_heartbeats
+    WHERE received_time_utc >= :start AND received_time_utc < :stop
+    RETURNING id, detector_name, received_time_utc, machine_time_utc, detector_status
+),
+raw AS (
+    SELECT
+        detector_name,
+        date_trunc('minute', received_time_utc) AS minute,
+        received_time_utc,
+        id,
+        detector_status,
+        EXTRACT(EPOCH FROM (received_time_utc AT TIME ZONE 'UTC') - machine_time_utc)
+            AS latency_sec,
+        lag(detector_status) OVER (
+            PARTITION BY detector_name ORDER BY received_time_utc, id
+        ) AS previous_status
+    FROM deleted
+),
+seeded AS (
+    SELECT
+        raw.*,
+        COALESCE(
+            previous_status,
+            (
+                SELECT last_status FROM {HeartbeatMinuteSummary.__tablename__} AS summary
+                WHERE summary.detector_name = raw.detector_name AND summary.minute <= raw.minute
+                ORDER BY summary.minute DESC LIMIT 1
+            )
+        ) AS seeded_previous_status
+    FROM raw
+),
+written AS (
+INSERT INTO {HeartbeatMinuteSummary.__tablename__} AS summary (
+    detector_name, minute, heartbeat_count, status_transitions, last_status,
+    last_received_time_utc, min_latency_sec, max_latency_sec, mean_latency_sec
+)
+SELECT
+    detector_name,
+    minute,
+    count(*),
+    count(*) FILTER (
+        WHERE seeded_previous_status IS NOT NULL
+        AND seeded_previous_status IS DISTINCT FROM detector_status
+    ),
+    (array_agg(detector_status ORDER BY received_time_utc DESC, id DESC))[1],
+    max(received_time_utc),
+    min(latency_sec),
+    max(latency_sec),
+    avg(latency_sec)
+FROM seeded
+GROUP BY detector_name, minute
+ON CONFLICT (detector_name, minute) DO UPDATE SET
+    heartbeat_count = summary.heartbeat_count + EXCLUDED.heartbeat_count,
+    status_transitions = summary.status_transitions + EXCLUDED.status_transitions,
+    last_status = CASE
+        WHEN summary.last_received_time_utc IS NULL
+            OR EXCLUDED.last_received_time_utc >= summary.last_received_time_utc
+        THEN EXCLUDED.last_status
+        ELSE summary.last_status
+    END,
+    last_received_time_utc = GREATEST(
+        summary.last_received_time_utc, EXCLUDED.last_received_time_utc
+    ),
+    min_latency_sec = LEAST(summary.min_latency_sec, EXCLUDED.min_latency_sec),
+    max_latency_sec = GREATEST(summary.max_latency_sec, EXCLUDED.max_latency_sec),
+    mean_latency_sec = COALESCE(
+        (summary.mean_latency_sec * summary.heartbeat_count
+         + EXCLUDED.mean_latency_sec * EXCLUDED.heartbeat_count)
+        / (summary.heartbeat_count + EXCLUDED.heartbeat_count),
+        summary.mean_latency_sec,
+        EXCLUDED.mean_latency_sec
+    )
+RETURNING 1
+)
+SELECT (SELECT count(*) FROM written), (SELECT count(*) FROM deleted)
+"""
+
+
+def _floor_minute(moment):
+    return moment.replace(second=0, microsecond=0)
+
+
+def _get_watermark(connection):
+    return connection.execute(
+        text(f"SELECT watermark FROM {RollupWatermark.__tablename__} WHERE name = :name"),
+        {"name": WATERMARK_NAME},
+    ).scalar()
+
+
+def _set_watermark(connection, watermark):
+    connection.execute(
+        text(
+            f"INSERT INTO {RollupWatermark.__tablename__} (name, watermark) "
+            f"VALUES (:name, :watermark) "
+            f"ON CONFLICT (name) DO UPDATE SET watermark = EXCLUDED.watermark"
+        ),
+        {"name": WATERMARK_NAME, "watermark": watermark},
+    )
+
+
+def _rollup_range(engine, lower, upper, window, delete_batch_size, advance_watermark):
+    """Rolls up the raw heartbeats received in [lower, upper), oldest first."""
+    minutes = 0
+    deleted = 0
+    while True:
+        with engine.begin() as connection:
+            oldest = connection.execute(
+                text(
+                    "SELECT min(received_time_utc) FROM cached_heartbeats "
+                    "WHERE received_time_utc >= :lower AND received_time_utc < :upper"
+                ),
+                {"lower": lower, "upper": upper},
+            ).scalar()
+            if oldest is None:
+                break
+            start = _floor_minute(oldest)
+            # whole minutes, so that each minute is summarized at once
+            stop = min(max(_floor_minute(start + window), start + timedelta(minutes=1)), upper)
+            overflow = connection.execute(
+                text(
+                    "SELECT received_time_utc FROM cached_heartbeats "
+                    "WHERE received_time_utc >= :start AND received_time_utc < :stop "
+                    "ORDER BY received_time_utc OFFSET :batch_size LIMIT 1"
+                ),
+                {"start": start, "stop": stop, "batch_size": delete_batch_size},
+            ).scalar()
+            if overflow is not None:
+                stop = max(_floor_minute(overflow), start + timedelta(minutes=1))
+            written, count = connection.execute(
+                text(ROLLUP_SQL), {"start": start, "stop": stop}
+            ).one()
+            if advance_watermark:
+                _set_watermark(connection, stop)
+            minutes += written
+            deleted += count
+    return minutes, deleted
+
+
+def rollup_heartbeats(
+    engine,
+    older_than: timedelta = timedelta(days=1),
+    window: timedelta = timedelta(hours=1),
+    delete_batch_size: int = 10_000,
+):
+    """
+    Downsamples old raw heartbeats into per-detector, per-minute summaries.
+
+    Heartbeats received before `older_than` ago are summarized into
+    `heartbeat_minute_summary` (count, status transitions, last status and
+    min/max/mean latency between machine and received time), then deleted
+    from `cached_heartbeats`. Each transaction deletes the raw rows of up to
+    `window` of whole minutes and summarizes the rows it deleted, so a raw
+    row is summarized exactly once, no transaction holds locks for long and
+    an interrupted run resumes where it stopped. A transaction takes fewer
+    minutes if they hold more than `delete_batch_size` rows, but always at
+    least one.
+
+    Each run starts from the time up to which heartbeats were summarized,
+    kept in `rollup_watermarks` and advanced with every transaction.
+    Heartbeats written late with a received time below it (e.g. drained from
+    a spool or reprocessed from dead_letters) are summarized first and merged
+    into the minutes already summarized; a minute keeps its last status
+    unless they were received after it, and the status transition into the
+    heartbeat after them is not recounted.
+
+    Args:
+        engine: The SQLAlchemy engine of the PostgreSQL database.
+        older_than: Age after which raw heartbeats are rolled up.
+        window: Longest range of received_time_utc summarized per transaction.
+        delete_batch_size: Number of raw rows from which a transaction stops
+                           adding minutes.
+
+    Returns:
+        A dict with the number of 'minutes' written and raw rows 'deleted',
+        how many of those were 'late', and the new 'watermark'.
+    """
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    cutoff = _floor_minute(now - older_than)
+
+    with engine.begin() as connection:
+        watermark = _get_watermark(connection)
+
+    late_minutes, late = 0, 0
+    if watermark is not None:
+        # raw rows left below the watermark were written after their range was rolled up
+        late_minutes, late = _rollup_range(
+            engine, datetime.min, min(watermark, cutoff), window, delete_batch_size,
+            advance_watermark=False,
+        )
+        if late:
+            log.info(f"Rolled up {late} heartbeats written late, before {watermark}")
+
+    minutes, deleted = _rollup_range(
+        engine, watermark or datetime.min, cutoff, window, delete_batch_size,
+        advance_watermark=True,
+    )
+    if watermark is None or watermark < cutoff:
+        watermark = cutoff
+        with engine.begin() as connection:
+            _set_watermark(connection, watermark)
+
+    if minutes:
+        log.info(
+            f"Rolled up {deleted} heartbeats into {minutes} detector minutes up to {watermark}"
+        )
+    return {
+        "minutes": minutes + late_minutes,
+        "deleted": deleted + late,
+        "late": late,
+        "watermark": watermark,
+    }
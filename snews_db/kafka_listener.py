@@ -1,69 +1,485 @@
-import json
 import os
-import pickle
 import random
 import sys
 import time
+from contextlib import nullcontext
 from datetime import datetime 
+from functools import partial
+
 import adc.errors
+import adc.kafka
 
 import click
+import confluent_kafka
 from hop import Stream
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from snews_db.database.models import Base 
-from snews_db.db_operations import write_arbitrary_message
+from snews_db.database.partitions import PartitionMaintainer, create_partitions
+from snews_db.db_operations import (
+    add_dead_letters,
+    dead_letter_row,
+    get_latest_statuses,
+    is_transient_error,
+    write_arbitrary_message,
+)
+from snews_db.batch_writer import BatchWriter
+from snews_db.decoding import decode_payload
+from snews_db.dedup import RecentMessageCache
+from snews_db.latest_status import LatestStatusCache
+from snews_db.metrics import ListenerMetrics, MetricsServer, log_slow_statements
+from snews_db.offsets import OffsetTracker
+from snews_db.profiling import IngestProfiler
+from snews_db.spool import MessageSpool
+
 
 class DBKafkaListener:
-    def __init__(self, firedrill=False):
+    def __init__(
+        self,
+        firedrill=False,
+        batch_size=1,
+        batch_timeout_ms=1000,
+        dedup_cache_size=100_000,
+        group_id=None,
+        dead_letters=True,
+        spool_path=None,
+        metrics_port=None,
+        slow_statement_ms=250,
+        slow_statement_sample_rate=1.0,
+        profile_path=None,
+        profile_messages=1000,
+        profile_mode="sample",
+    ):
         self.observation_topic = os.getenv(
             "FIREDRILL_OBSERVATION_TOPIC" if firedrill else "OBSERVATION_TOPIC"
         )
         self.database_url = os.getenv("DATABASE_URL")
         self.retriable_error_count = 0
+        # batch_size > 1 collects messages and writes each batch in one transaction
+        self.batch_size = batch_size
+        self.batch_timeout_ms = batch_timeout_ms
+        # drops redelivered messages before they reach the database; 0 disables it
+        self.recent_messages = RecentMessageCache(dedup_cache_size) if dedup_cache_size else None
+        # latest heartbeat or retraction status of each detector, mirrored to detector_latest_status
+        self.latest_statuses = LatestStatusCache()
+        # consumer group shared with other listeners; None reads every partition alone
+        self.group_id = group_id
+        # without a group_id, the group hop made up for the first connection, reused on reconnects
+        self.stream_group_id = None
+        self.assigned_partitions = []
+        self.batch_writer = None
+        # Kafka offsets only advance over messages whose writes have committed
+        self.offsets = OffsetTracker()
+        # messages handed to the write path and messages that failed to be written
+        self.handled = 0
+        self.write_errors = 0
+        # keep messages that cannot be decoded or written in dead_letters, to reprocess them
+        self.dead_letters = dead_letters
+        self.session_factory = None
+        # creates the upcoming partitions while the listener runs
+        self.partition_maintainer = None
+        # local file taking the messages while the database is unavailable; None disables it
+        self.spool_path = spool_path
+        self.spool = None
+        # message rates, stage latencies and errors, served over HTTP on metrics_port if set
+        self.metrics = ListenerMetrics()
+        self.metrics.queue_depth.set_function(self._queue_depth)
+        self.metrics.spool_pending.set_function(
+            lambda: len(self.spool) if self.spool is not None else 0
+        )
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        # statements slower than this are counted and (a sample_rate fraction) logged
+        self.slow_statement_ms = slow_statement_ms
+        self.slow_statement_sample_rate = slow_statement_sample_rate
+        # profiles the first profile_messages messages read if profile_path is set
+        self.profiler = None
+        if profile_path is not None:
+            self.profiler = IngestProfiler(
+                profile_path, messages=profile_messages, mode=profile_mode, metrics=self.metrics
+            )
+
+    @staticmethod
+    def _dedup_key(snews_message):
+        return (snews_message.get("tier"), snews_message.get("uuid"))
+
+    def _is_duplicate(self, snews_message):
+        if self.recent_messages is None or snews_message.get("uuid") is None:
+            return False
+        return self.recent_messages.check_and_add(self._dedup_key(snews_message))
+
+    def _queue_depth(self):
+        return len(self.batch_writer) if self.batch_writer is not None else 0
+
+    def _start_metrics_server(self):
+        if self.metrics_port is not None and self.metrics_server is None:
+            self.metrics_server = MetricsServer(self.metrics.registry, self.metrics_port)
+            self.metrics_server.start()
+            click.secho(
+                f"{datetime.utcnow().isoformat()} Serving metrics on "
+                f"http://127.0.0.1:{self.metrics_server.port}/metrics\n"
+            )
+
+    def _stop_metrics_server(self):
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.metrics_server = None
+
+    def _record_profile(self):
+        if self.profiler is not None and self.profiler.record():
+            self._report_profile()
+
+    def _stop_profile(self):
+        if self.profiler is not None and self.profiler.stop():
+            self._report_profile()
+
+    def _report_profile(self):
+        click.secho(
+            f"{datetime.utcnow().isoformat()} Profile of {self.profiler.recorded} messages "
+            f"written to {', '.join(self.profiler.report_paths)}\n"
+        )
+
+    def _log_slow_statements(self, engine):
+        log_slow_statements(
+            engine,
+            threshold_ms=self.slow_statement_ms,
+            sample_rate=self.slow_statement_sample_rate,
+            metrics=self.metrics,
+        )
+
+    def _report_write_error(self, snews_message, error):
+        self.write_errors += 1
+        if self.recent_messages is not None:
+            # let a redelivery of this message try again
+            self.recent_messages.discard(self._dedup_key(snews_message))
+        click.secho(
+            f"{datetime.utcnow().isoformat()} Error writing message "
+            f"{snews_message.get('uuid')}: {error}\n",
+            fg="red",
+        )
+
+    def _store_dead_letter(self, error, snews_message=None, raw_payload=None):
+        """Stores one message that could not be decoded or written in dead_letters."""
+        if not self.dead_letters or self.session_factory is None:
+            return
+        with self.session_factory() as session:
+            row = dead_letter_row(error, snews_message=snews_message, raw_payload=raw_payload)
+            add_dead_letters(session, [row])
+            session.commit()
+
+    def _prepare_database(self):
+        """Creates the tables and upcoming partitions and loads the known detector statuses."""
+        db_engine = create_engine(self.database_url)
+        self._log_slow_statements(db_engine)
+        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=db_engine)
+        Base.metadata.create_all(bind=db_engine)
+        # partitioned tables only accept rows a partition exists for
+        create_partitions(db_engine)
+        if self.partition_maintainer is None:
+            self.partition_maintainer = PartitionMaintainer(db_engine)
+            self.partition_maintainer.start()
+        with SessionLocal() as session:
+            for row in get_latest_statuses(session).values():
+                self.latest_statuses.update(
+                    {column.key: getattr(row, column.key) for column in row.__table__.columns}
+                )
+        self.session_factory = SessionLocal
+        if self.spool_path is not None and self.spool is None:
+            self.spool = MessageSpool(
+                self.spool_path,
+                SessionLocal,
+                drain_batch_size=max(self.batch_size, 1000),
+                status_cache=self.latest_statuses,
+                dead_letter=self.dead_letters,
+                metrics=self.metrics,
+                on_error=self._report_write_error,
+            )
+            self.spool.start()
+        return db_engine, SessionLocal
+
+    def _stop_partition_maintenance(self):
+        if self.partition_maintainer is not None:
+            self.partition_maintainer.close()
+            self.partition_maintainer = None
+
+    def _close_spool(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+    def _spool(self, messages, error=None):
+        """
+        Appends messages to the spool, if the listener has one and the database is unavailable.
+
+        Returns:
+            Whether the messages were spooled.
+        """
+        if self.spool is None or self.spool.failure is not None:
+            return False
+        if error is not None and not is_transient_error(error):
+            return False
+        if error is None and not self.spool.active:
+            return False
+        self.spool.append(messages)
+        return True
 
     def run_db_listener(self):
         self.retriable_error_count = 0
+        self._start_metrics_server()
         # create db session
-        db_engine = create_engine(self.database_url, echo=True)
-        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=db_engine)
-        Base.metadata.create_all(bind=db_engine)
+        db_engine, SessionLocal = self._prepare_database()
+        batch_writer = None
+        if self.batch_size > 1:
+            batch_writer = self.batch_writer = BatchWriter(
+                SessionLocal,
+                max_batch_size=self.batch_size,
+                max_batch_delay_ms=self.batch_timeout_ms,
+                on_error=self._report_write_error,
+                status_cache=self.latest_statuses,
+                dead_letter=self.dead_letters,
+                spool=self.spool,
+                metrics=self.metrics,
+            )
+            batch_writer.start()
+
+        def write(snews_message, on_written):
+            if batch_writer is not None:
+                batch_writer.add(snews_message, on_written)
+                return
+            if self._spool([snews_message]):
+                on_written()
+                return
+            try:
+                with SessionLocal() as session:
+                    write_arbitrary_message(
+                        session,
+                        snews_message,
+                        status_cache=self.latest_statuses,
+                        metrics=self.metrics,
+                    )
+            except Exception as e:
+                if is_transient_error(e):
+                    self.metrics.errors.inc(kind="transient")
+                if self._spool([snews_message], e):
+                    on_written()
+                    return
+                if is_transient_error(e):
+                    # reread the message from the last checkpoint
+                    raise
+                self._report_write_error(snews_message, e)
+                self._store_dead_letter(e, snews_message=snews_message)
+            on_written()
+
+        try:
+            # the batch writer is closed first, as its last batch may go to the spool
+            with batch_writer if batch_writer is not None else nullcontext():
+                self._consume(write)
+        finally:
+            self._close_spool()
+            self._stop_partition_maintenance()
+            self._stop_metrics_server()
+            self._stop_profile()
+
+    def _reset_writes(self):
+        """Forgets the messages read but not written, before rereading from the last checkpoint."""
+        if self.batch_writer is not None:
+            self.batch_writer.discard()
+        for key in self.offsets.reset():
+            if self.recent_messages is not None:
+                self.recent_messages.discard(key)
+
+    def _checkpoint(self, kafka_consumer, topic, partition, offset):
+        """Marks a message as written and stores the partition's offset if it advanced."""
+        checkpoint = self.offsets.done(topic, partition, offset)
+        if checkpoint is None:
+            return
+        try:
+            # committed to Kafka in the background, and when the consumer closes
+            kafka_consumer.store_offsets(
+                offsets=[confluent_kafka.TopicPartition(topic, partition, checkpoint)]
+            )
+        except confluent_kafka.KafkaException:
+            # the partition went to another consumer, which rereads from the last commit
+            pass
+
+    def _resume_from_checkpoints(self, kafka_consumer, partitions):
+        """
+        Points assigned partitions at their last checkpoint, to reread what was not written.
+
+        Kafka only knows the offsets committed so far, and none at all if the
+        first writes failed, in which case a new connection would start at
+        the end of the topic. The partitions this listener has read instead
+        resume from the first message it has not written.
+
+        Args:
+            kafka_consumer: The confluent_kafka consumer.
+            partitions: The assigned `TopicPartition`s; partitions not read
+                        yet keep their offset.
+        """
+        checkpoints = self.offsets.checkpoints()
+        resumed = False
+        for p in partitions:
+            checkpoint = checkpoints.get((p.topic, p.partition))
+            if checkpoint is not None:
+                p.offset = checkpoint
+                resumed = True
+        if resumed:
+            kafka_consumer.assign(partitions)
+
+    def _drain_writes(self):
+        """Blocks until every message handed to the write path is written."""
+        if self.batch_writer is not None:
+            self.batch_writer.flush()
+
+    def _join_consumer_group(self, consumer):
+        """
+        Lets Kafka spread the topic's partitions over the listeners of the consumer group.
+
+        hop assigns every partition of the topic to each consumer. Subscribing
+        instead makes this listener one member of `group_id`, so Kafka assigns
+        it a share of the partitions and moves them when listeners join or
+        leave. Before giving up partitions, the listener writes what it has
+        read from them and commits its offsets, so the next owner resumes
+        exactly after the last message written.
+
+        Args:
+            consumer: An open hop consumer.
+        """
+
+        def on_assign(kafka_consumer, partitions):
+            self._resume_from_checkpoints(kafka_consumer, partitions)
+            self.assigned_partitions = sorted(
+                self.assigned_partitions + [p.partition for p in partitions]
+            )
+            click.secho(
+                f"{datetime.utcnow().isoformat()} Assigned partitions "
+                f"{[p.partition for p in partitions]} of {self.observation_topic}\n"
+            )
+
+        def on_revoke(kafka_consumer, partitions):
+            revoked = {p.partition for p in partitions}
+            self.assigned_partitions = [p for p in self.assigned_partitions if p not in revoked]
+            self._drain_writes()
+            try:
+                kafka_consumer.commit(asynchronous=False)
+            except confluent_kafka.KafkaException as e:
+                # nothing read since the last commit
+                if e.args[0].code() != confluent_kafka.KafkaError._NO_OFFSET:
+                    raise
+            for p in partitions:
+                self.offsets.forget(p.topic, p.partition)
+            click.secho(
+                f"{datetime.utcnow().isoformat()} Revoked partitions {sorted(revoked)} "
+                f"of {self.observation_topic}\n"
+            )
+
+        def on_lost(kafka_consumer, partitions):
+            # offsets can no longer be committed; the next owner rereads from the last
+            # commit and the rows already written are skipped on their message_uuid
+            lost = {p.partition for p in partitions}
+            self.assigned_partitions = [p for p in self.assigned_partitions if p not in lost]
+            self._drain_writes()
+            for p in partitions:
+                self.offsets.forget(p.topic, p.partition)
+
+        _, _, topics = adc.kafka.parse_kafka_url(self.observation_topic)
+        # neither hop nor adc expose group subscriptions, so use the underlying client
+        kafka_consumer = consumer._consumer._consumer
+        kafka_consumer.unassign()
+        kafka_consumer.subscribe(
+            topics, on_assign=on_assign, on_revoke=on_revoke, on_lost=on_lost
+        )
+
+    def _consume(self, handle):
+        """
+        Reads the observation topic until told to stop, reconnecting on errors.
+
+        Offsets are not committed as messages are read: each message's offset
+        is stored once `handle` reports it written, and Kafka commits the
+        stored offsets periodically. When a write fails, or the connection to
+        Kafka is reopened for any other reason, the listener forgets what was
+        not written yet and resumes each partition from its last checkpoint
+        (see `_resume_from_checkpoints`), so every message is written at
+        least once (duplicates are skipped on their message_uuid).
+
+        Args:
+            handle: Called as `handle(message, on_written)` with every decoded
+                    message that is not a duplicate. `on_written()` must be
+                    called once the message is written (or permanently
+                    rejected); an exception aborts the stream and rereads it
+                    from the last checkpoint.
+        """
         stream = Stream(until_eos=False)
+        if self.profiler is not None:
+            # in the consuming thread, which cProfile traces
+            self.profiler.start()
         while True:
             try:
+                self._reset_writes()
                 click.secho(
                     f"{datetime.utcnow().isoformat()} (re)Initializing Database Listener System for "
                     f"{self.observation_topic}\n"
                 )
-                with stream.open(self.observation_topic, "r") as s:
-                    for snews_message in s:
-                        try:
-                            snews_message = snews_message.content
-                        except Exception:
-                            pass
-
-                        # Unpack the message
-                        try:
-                            if isinstance(snews_message, bytes):
-                                snews_message = pickle.loads(snews_message)
-                                snews_message = snews_message.model_dump()
-                            elif isinstance(snews_message, str):
-                                snews_message = json.loads(snews_message)
-                            else:
-                                continue
-
+                with stream.open(
+                    self.observation_topic, "r", group_id=self.group_id or self.stream_group_id
+                ) as s:
+                    # neither hop nor adc expose offset storing, so use the underlying client
+                    kafka_consumer = s._consumer._consumer
+                    if self.group_id is not None:
+                        self._join_consumer_group(s)
+                    else:
+                        # hop makes up a new group, starting at the end of the topic, each time
+                        self.stream_group_id = s._conf.group_id
+                        self._resume_from_checkpoints(kafka_consumer, kafka_consumer.assignment())
+                    try:
+                        for snews_message, metadata in s.read(metadata=True, autocommit=False):
+                            position = (metadata.topic, metadata.partition, metadata.offset)
+                            try:
+                                snews_message = snews_message.content
+                            except Exception:
+                                pass
 
-                            # TODO: check if message is a test message, if it is don't add it to the database
-                            with SessionLocal() as session:
-                                write_arbitrary_message(session, snews_message)
+                            # Unpack the message
+                            try:
+                                with self.metrics.time("decode"):
+                                    snews_message = decode_payload(snews_message)
+                            except Exception as e:
+                                self.metrics.errors.inc(kind="decode")
+                                click.secho(
+                                    f"{datetime.utcnow().isoformat()} Error processing message: {e}\n",
+                                    fg="red",
+                                )
+                                if isinstance(snews_message, (bytes, str)):
+                                    self._store_dead_letter(e, raw_payload=snews_message)
+                                snews_message = None  # Skip to the next message
 
-                        except Exception as e:
-                            click.secho(
-                                f"{datetime.utcnow().isoformat()} Error processing message: {e}\n",
-                                fg="red",
+                            is_duplicate = snews_message is not None and self._is_duplicate(
+                                snews_message
+                            )
+                            if is_duplicate:
+                                self.metrics.duplicates.inc()
+                            if snews_message is None or is_duplicate:
+                                self.offsets.add(*position)
+                                self._checkpoint(kafka_consumer, *position)
+                                continue
+                            self.offsets.add(
+                                *position,
+                                key=(
+                                    self._dedup_key(snews_message)
+                                    if snews_message.get("uuid") is not None
+                                    else None
+                                ),
                             )
-                            continue  # Skip to the next message
+
+                            # TODO: check if message is a test message, if it is don't add it to the database
+                            self.handled += 1
+                            handle(snews_message, partial(self._checkpoint, kafka_consumer, *position))
+                            self._record_profile()
+                    except KeyboardInterrupt:
+                        # store the offsets of what was read before the consumer commits them
+                        self._drain_writes()
+                        raise
 
             except KeyboardInterrupt:
                 sys.exit(0)
@@ -76,17 +492,17 @@ class DBKafkaListener:
                         )
                         sys.exit(0)
                     else:
-                        time.sleep(
-                            (1.5 ** self.retriable_error_count)
-                            * (1 + random.random())
-                            / 2
-                        )
+                        backoff_s = (1.5 ** self.retriable_error_count) * (1 + random.random()) / 2
+                        self.metrics.backoffs.inc()
+                        self.metrics.backoff_seconds.inc(backoff_s)
+                        time.sleep(backoff_s)
                 else:
                     click.secho(
                         f"{datetime.utcnow().isoformat()} Non-retriable error, exiting...\n"
                     )
                     sys.exit(0)
             except Exception as e:
+                self.metrics.errors.inc(kind="restart")
                 click.secho(
                     f"{datetime.utcnow().isoformat()} Unexpected error: {e}, restarting listener...\n"
                 )
@@ -0,0 +1,55 @@
+import threading
+
+
+class LatestStatusCache:
+    """
+    Maps each detector to its latest heartbeat or retraction status.
+
+    The listener keeps one up to date as it writes messages, so the current
+    state of every detector can be read without a database query. It also
+    lets the write path skip mirroring statuses older than the one already
+    known to the `detector_latest_status` table. A status is a dict with the
+    columns of that table; statuses are ordered by their received_time_utc.
+    """
+
+    def __init__(self):
+        self._statuses = {}
+        self._lock = threading.Lock()
+
+    def update(self, status):
+        """
+        Records a detector's status unless a more recent one is known.
+
+        Args:
+            status: A dict holding at least 'detector_name' and 'received_time_utc'.
+
+        Returns:
+            True if the status was recorded, False if it is older than the known one.
+        """
+        with self._lock:
+            known = self._statuses.get(status["detector_name"])
+            if known is not None and known["received_time_utc"] > status["received_time_utc"]:
+                return False
+            self._statuses[status["detector_name"]] = dict(status)
+            return True
+
+    def is_outdated(self, status):
+        """Returns True if a more recent status of the detector is known, without recording it."""
+        with self._lock:
+            known = self._statuses.get(status["detector_name"])
+            return known is not None and known["received_time_utc"] > status["received_time_utc"]
+
+    def get(self, detector_name):
+        """Returns a copy of a detector's latest status, or None if it is unknown."""
+        with self._lock:
+            status = self._statuses.get(detector_name)
+            return dict(status) if status is not None else None
+
+    def snapshot(self):
+        """Returns a copy of the latest status of every known detector."""
+        with self._lock:
+            return {name: dict(status) for name, status in self._statuses.items()}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._statuses)
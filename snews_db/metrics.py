@@ -0,0 +1,329 @@
+import bisect
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import event
+
+# Setup logger
+log = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+# Longest statement text included in a slow statement log line
+SLOW_STATEMENT_LOG_CHARS = 500
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """A named metric with one value (or histogram) per combination of label values."""
+
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} takes the labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """Yields the (name, labels, value) samples of the metric."""
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in sorted(values, key=lambda item: [str(v) for _, v in item[0]]):
+            yield self.name, key, value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """A count that only goes up, e.g. of messages written."""
+
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, set directly or read from a function when rendered."""
+
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        """Reads the (unlabelled) value from `function()` whenever the gauge is rendered."""
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            yield self.name, (), self._function()
+            return
+        yield from super().samples()
+
+
+class Histogram(_Metric):
+    """Observations counted in cumulative buckets, e.g. of stage latencies in seconds."""
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ((0,) * len(self.buckets), 0.0)
+            bucket = bisect.bisect_left(self.buckets, value)
+            # replaced rather than updated, so samples read while rendering stay consistent
+            counts = counts[:bucket] + (counts[bucket] + 1,) + counts[bucket + 1:]
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the time spent in the `with` block, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels)) or ((), 0.0)
+            return sum(counts)
+
+    def totals(self):
+        """Returns the number and sum of the observations of each combination of label values."""
+        with self._lock:
+            return {key: (sum(counts), total) for key, (counts, total) in self._values.items()}
+
+    def samples(self):
+        for name, labels, (counts, total) in super().samples():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{name}_bucket", labels + (("le", _format_value(bound)),), cumulative
+            yield f"{name}_sum", labels, total
+            yield f"{name}_count", labels, cumulative
+
+
+class MetricsRegistry:
+    """The metrics of a process, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Serves a registry's metrics over HTTP, at /metrics, from a background thread.
+
+    Args:
+        registry: The `MetricsRegistry` to serve.
+        port: The port to listen on; 0 picks a free one (see `port`).
+        host: The address to listen on. Defaults to the local host only.
+    """
+
+    def __init__(self, registry, port, host="127.0.0.1"):
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] not in ("/", "/metrics"):
+                    handler.send_error(404)
+                    return
+                body = registry.render().encode()
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                # scrapes are not worth a log line each
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._server.serve_forever, name="snews-db-metrics", daemon=True
+            )
+            self._thread.start()
+            log.info(f"Serving metrics on port {self.port}")
+
+    def close(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+
+class ListenerMetrics:
+    """
+    Metrics of the listener and its write path.
+
+    Messages written are counted per tier (`rate()` gives messages per
+    second), and the duration of each stage of a message is observed in a
+    histogram: 'decode' (Kafka payload to dict), 'validate' (dict to table
+    row), 'insert' (INSERT statements) and 'commit'.
+    """
+
+    def __init__(self):
+        self.registry = MetricsRegistry()
+        self.messages_written = self.registry.counter(
+            "snews_db_messages_written_total", "Messages written to the database", ["tier"]
+        )
+        self.stage_duration = self.registry.histogram(
+            "snews_db_stage_duration_seconds",
+            "Time spent in each stage of the write path",
+            ["stage"],
+        )
+        self.errors = self.registry.counter(
+            "snews_db_errors_total",
+            "Errors, by kind: decode, invalid, rejected, transient or restart",
+            ["kind"],
+        )
+        self.duplicates = self.registry.counter(
+            "snews_db_duplicates_total", "Redelivered messages dropped before being written"
+        )
+        self.backoffs = self.registry.counter(
+            "snews_db_retriable_backoffs_total", "Backoffs after retriable Kafka errors"
+        )
+        self.backoff_seconds = self.registry.counter(
+            "snews_db_retriable_backoff_seconds_total", "Time spent backing off"
+        )
+        self.queue_depth = self.registry.gauge(
+            "snews_db_queue_depth", "Messages read and waiting to be written"
+        )
+        self.spool_pending = self.registry.gauge(
+            "snews_db_spool_pending", "Messages in the spool waiting for the database"
+        )
+        self.slow_statements = self.registry.counter(
+            "snews_db_slow_statements_total", "SQL statements slower than the threshold"
+        )
+
+    def time(self, stage):
+        """Returns a context manager observing the duration of a stage."""
+        return self.stage_duration.time(stage=stage)
+
+
+def time_stage(metrics, stage):
+    """Times a stage in `metrics` (a `ListenerMetrics`), or does nothing if it is None."""
+    return nullcontext() if metrics is None else metrics.time(stage)
+
+
+def log_slow_statements(engine, threshold_ms=250, sample_rate=1.0, metrics=None):
+    """
+    Logs the SQL statements of an engine that take longer than `threshold_ms`.
+
+    Unlike `echo=True`, which logs every statement, only slow statements are
+    logged, and only a `sample_rate` fraction of them, so a database that
+    slows down under load does not also fill the disk with logs. All of
+    them are counted in `metrics`, if given. Parameters are not logged.
+
+    Args:
+        engine: The SQLAlchemy engine (for an async engine, its `sync_engine`).
+        threshold_ms: Duration from which a statement counts as slow.
+        sample_rate: Fraction of the slow statements logged.
+        metrics: Optional `ListenerMetrics` counting the slow statements.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("statement_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - connection.info["statement_start"].pop()) * 1000
+        if elapsed_ms < threshold_ms:
+            return
+        if metrics is not None:
+            metrics.slow_statements.inc()
+        if random.random() < sample_rate:
+            text = " ".join(statement.split())
+            log.warning(
+                f"Slow statement ({elapsed_ms:.0f} ms): {text[:SLOW_STATEMENT_LOG_CHARS]}"
+            )
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # the failed statement's start time is not popped by after_cursor_execute
+        connection = context.connection
+        if connection is not None and connection.info.get("statement_start"):
+            connection.info["statement_start"].pop()
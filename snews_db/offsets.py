@@ -0,0 +1,99 @@
+import threading
+from collections import OrderedDict
+
+
+class OffsetTracker:
+    """
+    Tracks which consumed Kafka messages are durably written, per partition.
+
+    Messages of a partition are written in batches that may complete out of
+    order (e.g. with several writers). A partition's checkpoint, the offset
+    Kafka should resume from, only advances over messages that are all
+    written, so committing it never skips a message whose batch has not
+    reached the database yet.
+
+    Each tracked message may carry a key (e.g. its dedup key), returned by
+    `reset` for the messages that were read but not written.
+    """
+
+    def __init__(self):
+        self._pending = {}  # (topic, partition) -> OrderedDict of offset -> key
+        self._done = {}  # (topic, partition) -> set of written offsets still pending
+        self._checkpoints = {}  # (topic, partition) -> offset to resume reading from
+        self._lock = threading.Lock()
+
+    def add(self, topic, partition, offset, key=None):
+        """Records a message read from Kafka, in the order of its partition."""
+        with self._lock:
+            self._pending.setdefault((topic, partition), OrderedDict())[offset] = key
+            self._done.setdefault((topic, partition), set())
+            # until it is written, the first message read is where the partition resumes
+            self._checkpoints.setdefault((topic, partition), offset)
+
+    def done(self, topic, partition, offset):
+        """
+        Marks a message as written (or permanently rejected).
+
+        Returns:
+            The new checkpoint of the partition, i.e. the offset of the next
+            message to read, or None if it did not advance.
+        """
+        with self._lock:
+            pending = self._pending.get((topic, partition))
+            if pending is None or offset not in pending:
+                return None
+            done = self._done[(topic, partition)]
+            done.add(offset)
+            checkpoint = None
+            while pending:
+                first = next(iter(pending))
+                if first not in done:
+                    break
+                pending.popitem(last=False)
+                done.discard(first)
+                checkpoint = first + 1
+            if checkpoint is not None:
+                self._checkpoints[(topic, partition)] = checkpoint
+            return checkpoint
+
+    def forget(self, topic, partition):
+        """Stops tracking a partition, e.g. because it was assigned to another consumer."""
+        with self._lock:
+            self._pending.pop((topic, partition), None)
+            self._done.pop((topic, partition), None)
+            self._checkpoints.pop((topic, partition), None)
+
+    def checkpoints(self):
+        """
+        Returns the checkpoint of every partition read, kept across `reset`.
+
+        Returns:
+            A dict of (topic, partition) to the offset of the first message of
+            the partition that is not written yet.
+        """
+        with self._lock:
+            return dict(self._checkpoints)
+
+    def reset(self):
+        """
+        Stops tracking every message, e.g. before rereading from the last checkpoint.
+
+        The partitions' checkpoints are kept, as the position to reread from.
+
+        Returns:
+            The keys of the messages that were read but not written.
+        """
+        with self._lock:
+            keys = [
+                key
+                for (topic, partition), pending in self._pending.items()
+                for offset, key in pending.items()
+                if key is not None and offset not in self._done[(topic, partition)]
+            ]
+            self._pending.clear()
+            self._done.clear()
+            return keys
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(pending) for pending in self._pending.values())
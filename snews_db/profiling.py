@@ -0,0 +1,226 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+
+# Setup logger
+log = logging.getLogger(__name__)
+
+PROFILE_MODES = ("sample", "cprofile")
+# Seconds between two stack samples
+SAMPLE_INTERVAL_S = 0.005
+# Number of functions listed in a profile summary
+SUMMARY_FUNCTIONS = 40
+
+
+def _frame_name(code):
+    # ';' separates the frames of a folded stack
+    name = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return name.replace(";", ":")
+
+
+class StackSampler:
+    """
+    Samples the stacks of every thread of the process from a background thread.
+
+    The samples are wall-clock: a thread waiting on the database or on
+    Kafka is sampled like a busy one, which is what a latency spike needs.
+
+    Args:
+        interval_s: Seconds between two samples.
+    """
+
+    def __init__(self, interval_s=SAMPLE_INTERVAL_S):
+        self.interval_s = interval_s
+        # (thread name, outermost frame, ..., innermost frame) -> number of samples
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own_ident = threading.get_ident()
+        while not self._stopped.wait(self.interval_s):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}").replace(";", ":"))
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, name="snews-db-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write_folded(self, path):
+        """Writes the samples as folded stacks, the input of flamegraph.pl and speedscope."""
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+    def summary(self, limit=SUMMARY_FUNCTIONS):
+        """Returns the functions with the most samples, in them (self) and below them (total)."""
+        total = sum(self.stacks.values())
+        self_samples = Counter()
+        total_samples = Counter()
+        for stack, count in self.stacks.items():
+            # the thread name is not a function
+            frames = stack[1:]
+            if frames:
+                self_samples[frames[-1]] += count
+            # once per stack, even in a recursion; outermost first so that ties read top-down
+            for frame in dict.fromkeys(frames):
+                total_samples[frame] += count
+        lines = [
+            f"{total} samples, every {self.interval_s * 1000:g} ms of each thread (wall clock)",
+            "",
+            f"{'total %':>8} {'self %':>8}  function",
+        ]
+        for frame, count in total_samples.most_common(limit):
+            lines.append(
+                f"{100 * count / total:8.1f} {100 * self_samples[frame] / total:8.1f}  {frame}"
+            )
+        return lines
+
+
+class IngestProfiler:
+    """
+    Profiles the ingest path for a bounded number of messages, then writes its reports.
+
+    In 'sample' mode a `StackSampler` samples every thread (the consumer,
+    batch writers and event loop alike) and the report holds folded stacks
+    (`PREFIX.folded`, for flamegraph.pl or speedscope). In 'cprofile' mode
+    `cProfile` traces every call of the thread that called `start()`, which
+    costs more and misses the writer threads of the batched and async
+    listeners, and the report is a pstats file (`PREFIX.prof`, for snakeviz
+    or gprof2dot). Both write a per-function summary to `PREFIX.txt`,
+    preceded by the time spent in each write stage during the window if
+    `metrics` is given.
+
+    Once `messages` messages are recorded the profiler stops and the
+    ingest carries on unprofiled.
+
+    Args:
+        output_prefix: Path prefix of the report files.
+        messages: Number of messages profiled.
+        mode: 'sample' or 'cprofile'.
+        metrics: Optional `ListenerMetrics` timing the write stages.
+        interval_s: Seconds between two stack samples, in 'sample' mode.
+    """
+
+    def __init__(
+        self, output_prefix, messages=1000, mode="sample", metrics=None,
+        interval_s=SAMPLE_INTERVAL_S,
+    ):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode '{mode}', expected one of {PROFILE_MODES}")
+        self.output_prefix = output_prefix
+        self.messages = messages
+        self.mode = mode
+        self.metrics = metrics
+        self.interval_s = interval_s
+        self.recorded = 0
+        self.report_paths = []
+        self._profiler = None
+        self._stage_totals = {}
+        self._lock = threading.Lock()
+        self._state = "ready"
+
+    @property
+    def active(self):
+        return self._state == "running"
+
+    def start(self):
+        """Starts profiling; does nothing if the profiler already ran."""
+        with self._lock:
+            if self._state != "ready":
+                return
+            self._state = "running"
+        if self.metrics is not None:
+            self._stage_totals = self.metrics.stage_duration.totals()
+        if self.mode == "cprofile":
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self._profiler = StackSampler(self.interval_s)
+            self._profiler.start()
+        log.info(f"Profiling the next {self.messages} messages ({self.mode})")
+
+    def record(self, count=1):
+        """
+        Counts messages ingested while profiling, and stops once there are enough of them.
+
+        Returns:
+            True if this call completed the profile and wrote its reports.
+        """
+        if not self.active:
+            return False
+        self.recorded += count
+        if self.recorded < self.messages:
+            return False
+        return self.stop()
+
+    def stop(self):
+        """
+        Stops profiling and writes the reports, even if fewer messages than asked were ingested.
+
+        Returns:
+            True if the profiler was running.
+        """
+        with self._lock:
+            if self._state != "running":
+                return False
+            self._state = "done"
+        if self.mode == "cprofile":
+            self._profiler.disable()
+        else:
+            self._profiler.stop()
+
+        directory = os.path.dirname(self.output_prefix)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        lines = [f"Profile of {self.recorded} messages", ""] + self._stage_lines()
+        if self.mode == "cprofile":
+            profile_path = f"{self.output_prefix}.prof"
+            self._profiler.dump_stats(profile_path)
+            stream = io.StringIO()
+            stats = pstats.Stats(self._profiler, stream=stream)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(SUMMARY_FUNCTIONS)
+            lines.append(stream.getvalue())
+        else:
+            profile_path = f"{self.output_prefix}.folded"
+            self._profiler.write_folded(profile_path)
+            lines.extend(self._profiler.summary())
+        summary_path = f"{self.output_prefix}.txt"
+        with open(summary_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        self.report_paths = [profile_path, summary_path]
+        self._profiler = None
+        log.info(f"Profile of {self.recorded} messages written to {profile_path}, {summary_path}")
+        return True
+
+    def _stage_lines(self):
+        if self.metrics is None:
+            return []
+        lines = [f"{'stage':<10} {'count':>8} {'total s':>10} {'mean ms':>10}"]
+        for key, (count, total) in sorted(self.metrics.stage_duration.totals().items()):
+            start_count, start_total = self._stage_totals.get(key, (0, 0.0))
+            count, total = count - start_count, total - start_total
+            if count:
+                stage = dict(key)["stage"]
+                lines.append(
+                    f"{stage:<10} {count:>8} {total:>10.3f} {1000 * total / count:>10.3f}"
+                )
+        return lines + [""]
@@ -0,0 +1,219 @@
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, NamedTuple
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.orm import Session
+
+from snews_db.db_operations import to_naive_utc
+from snews_db.decoding import TIER_SCHEMAS
+
+# Largest page returned by `messages_page`
+MAX_PAGE_SIZE = 10_000
+
+
+class PageCursor(NamedTuple):
+    """Position of a row in (received_time_utc, id) order, where the next page starts."""
+
+    received_time_utc: datetime
+    id: int
+
+    def encode(self) -> str:
+        """Returns the cursor as an opaque string, e.g. for a dashboard URL."""
+        return f"{self.received_time_utc.isoformat()}~{self.id}"
+
+    @classmethod
+    def decode(cls, token: str) -> "PageCursor":
+        """
+        Parses a cursor returned by `encode`.
+
+        Raises:
+            ValueError: If the token is not a cursor.
+        """
+        received, _, row_id = token.rpartition("~")
+        return cls(datetime.fromisoformat(received), int(row_id))
+
+
+class Page(NamedTuple):
+    rows: list
+    # None on the last page
+    next_cursor: PageCursor | None
+
+
+def tier_model(tier):
+    """
+    Returns the archive model class of a tier.
+
+    Args:
+        tier: A `Tier`, its name (e.g. 'CoincidenceTier') or its table name.
+
+    Raises:
+        ValueError: If the tier is unknown.
+    """
+    for schema_tier, schema in TIER_SCHEMAS.items():
+        if tier in (schema_tier, schema_tier.value, schema.model_class.__tablename__):
+            return schema.model_class
+    raise ValueError(f"Unknown tier {tier}")
+
+
+def _filtered(model_class, start, end, detector_name):
+    statement = select(model_class)
+    if start is not None:
+        statement = statement.where(model_class.received_time_utc >= to_naive_utc(start))
+    if end is not None:
+        statement = statement.where(model_class.received_time_utc < to_naive_utc(end))
+    if detector_name is not None:
+        statement = statement.where(model_class.detector_name == detector_name)
+    return statement
+
+
+def _after(model_class, cursor: PageCursor, descending: bool):
+    time_column, id_column = model_class.received_time_utc, model_class.id
+    received = to_naive_utc(cursor.received_time_utc)
+    # the bound on the time column alone keeps the scan an index range scan
+    if descending:
+        return and_(
+            time_column <= received,
+            or_(time_column < received, and_(time_column == received, id_column < cursor.id)),
+        )
+    return and_(
+        time_column >= received,
+        or_(time_column > received, and_(time_column == received, id_column > cursor.id)),
+    )
+
+
+def messages_page(
+    session: Session,
+    tier,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    detector_name: str | None = None,
+    limit: int = 100,
+    after: PageCursor | None = None,
+    descending: bool = False,
+) -> Page:
+    """
+    Returns one page of the messages of a tier, in received time order.
+
+    Pages are selected with keyset pagination on (received_time_utc, id):
+    pass the `next_cursor` of a page as `after` to get the next one, with
+    the same filters and order. A page starts right after the last row of
+    the previous one, so a deep page costs as much as the first one, unlike
+    OFFSET, which reads and discards every earlier row.
+
+    Args:
+        session: The SQLAlchemy session object.
+        tier: A `Tier`, its name or its table name.
+        start: Only rows received at or after this time (naive UTC or timezone-aware).
+        end: Only rows received before this time.
+        detector_name: Only the rows of this detector.
+        limit: Number of rows per page, at most `MAX_PAGE_SIZE`.
+        after: The cursor of the previous page. Defaults to the first page.
+        descending: Whether to return the newest rows first.
+
+    Raises:
+        ValueError: If the tier is unknown or the limit out of range.
+    """
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"Page size must be between 1 and {MAX_PAGE_SIZE}, got {limit}")
+    model_class = tier_model(tier)
+    statement = _filtered(model_class, start, end, detector_name)
+    if after is not None:
+        statement = statement.where(_after(model_class, after, descending))
+    order = (model_class.received_time_utc, model_class.id)
+    if descending:
+        order = tuple(column.desc() for column in order)
+    # one row more than the page tells whether another page follows
+    rows = session.scalars(statement.order_by(*order).limit(limit + 1)).all()
+    if len(rows) <= limit:
+        return Page(rows, None)
+    rows = rows[:limit]
+    return Page(rows, PageCursor(rows[-1].received_time_utc, rows[-1].id))
+
+
+def iter_messages(
+    session: Session,
+    tier,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    detector_name: str | None = None,
+    chunk_size: int = 1000,
+) -> Iterator:
+    """
+    Yields the messages of a tier oldest first, fetched `chunk_size` at a time.
+
+    Rows are streamed through a server-side cursor, so memory use does not
+    depend on the number of rows. The session's transaction stays open
+    until the iteration ends.
+
+    Args:
+        session: The SQLAlchemy session object.
+        tier: A `Tier`, its name or its table name.
+        start: Only rows received at or after this time (naive UTC or timezone-aware).
+        end: Only rows received before this time.
+        detector_name: Only the rows of this detector.
+        chunk_size: Number of rows fetched from the server at a time.
+
+    Raises:
+        ValueError: If the tier is unknown.
+    """
+    model_class = tier_model(tier)
+    statement = _filtered(model_class, start, end, detector_name).order_by(
+        model_class.received_time_utc, model_class.id
+    )
+    yield from session.scalars(statement.execution_options(yield_per=chunk_size))
+
+
+def latest_messages(
+    session: Session, tier, limit: int = 10, detector_name: str | None = None
+) -> list:
+    """
+    Returns the `limit` most recently received messages of a tier, newest first.
+
+    Args:
+        session: The SQLAlchemy session object.
+        tier: A `Tier`, its name or its table name.
+        limit: Number of messages.
+        detector_name: Only the messages of this detector.
+    """
+    return messages_page(
+        session, tier, detector_name=detector_name, limit=limit, descending=True
+    ).rows
+
+
+def messages_around(
+    session: Session,
+    neutrino_time: datetime,
+    window: timedelta = timedelta(seconds=10),
+    tiers=None,
+) -> dict:
+    """
+    Returns the messages of every tier within `window` of a neutrino time.
+
+    Tiers that carry a neutrino time (coincidence and timing) are matched on
+    neutrino_time_utc, the others on received_time_utc.
+
+    Args:
+        session: The SQLAlchemy session object.
+        neutrino_time: The neutrino time, naive UTC or timezone-aware.
+        window: Half-width of the time window.
+        tiers: Optional list of tiers to search. Defaults to all tiers.
+
+    Returns:
+        The rows of each tier within the window, by table name, in time order.
+    """
+    neutrino_time = to_naive_utc(neutrino_time)
+    found = {}
+    for tier in tiers or list(TIER_SCHEMAS):
+        model_class = tier_model(tier)
+        column = getattr(model_class, "neutrino_time_utc", model_class.received_time_utc)
+        start, end = neutrino_time - window, neutrino_time + window
+        if column is not model_class.received_time_utc:
+            # neutrino_time_utc is a timestamptz: compare with aware bounds
+            start, end = (moment.replace(tzinfo=timezone.utc) for moment in (start, end))
+        statement = (
+            select(model_class)
+            .where(column >= start, column <= end)
+            .order_by(column, model_class.id)
+        )
+        found[model_class.__tablename__] = session.scalars(statement).all()
+    return found
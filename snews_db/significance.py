@@ -0,0 +1,355 @@
+import hashlib
+import itertools
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
+
+import numpy as np
+from sqlalchemy import BigInteger, cast, extract, func, select
+
+from snews_db.database.models import SigTierArchive
+from snews_db.db_operations import to_naive_utc
+
+# Setup logger
+log = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# Smallest p-value combined: keeps log(p) and the normal quantile of p finite
+MIN_P_VALUE = np.finfo(np.float64).tiny
+COMBINATION_METHODS = ("fisher", "stouffer")
+
+
+class AlignedPValues(NamedTuple):
+    """p-values of every detector on a common time grid."""
+
+    # start of each grid cell holding data, in microseconds since the epoch
+    cell_times: np.ndarray
+    cell_width_us: int
+    detector_names: np.ndarray
+    # detectors x cells, NaN where a detector has no p-value for the cell
+    p_values: np.ndarray
+
+    def save(self, path):
+        """Saves the arrays to a .npz file."""
+        np.savez(
+            path,
+            cell_times=self.cell_times,
+            cell_width_us=self.cell_width_us,
+            detector_names=self.detector_names.astype(str),
+            p_values=self.p_values,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Loads arrays saved with `save`."""
+        with np.load(path) as saved:
+            return cls(
+                saved["cell_times"],
+                int(saved["cell_width_us"]),
+                saved["detector_names"],
+                saved["p_values"],
+            )
+
+    def times(self):
+        """Returns the start of each grid cell as a UTC datetime."""
+        return [EPOCH + timedelta(microseconds=int(t)) for t in self.cell_times]
+
+
+class CombinedSignificance(NamedTuple):
+    cell_times: np.ndarray
+    # combined p-value of each cell, NaN where too few detectors have data
+    p_values: np.ndarray
+    # number of detectors combined in each cell
+    detector_counts: np.ndarray
+
+
+def _sig_tier_query(start, end, is_test):
+    statement = select(
+        SigTierArchive.detector_name,
+        cast(extract("epoch", SigTierArchive.machine_time_utc) * 1_000_000, BigInteger),
+        SigTierArchive.t_bin_width_sec,
+        SigTierArchive.p_values,
+    ).where(
+        SigTierArchive.machine_time_utc.is_not(None),
+        SigTierArchive.t_bin_width_sec > 0,
+        func.cardinality(SigTierArchive.p_values) > 0,
+    )
+    if start is not None:
+        statement = statement.where(SigTierArchive.machine_time_utc >= start)
+    if end is not None:
+        statement = statement.where(SigTierArchive.machine_time_utc < end)
+    if is_test is not None:
+        statement = statement.where(SigTierArchive.is_test == int(is_test))
+    return statement
+
+
+def align_bins(
+    detector_names, series_starts, bin_widths_us, series_lengths, p_values, cell_width_us
+) -> AlignedPValues:
+    """
+    Puts p-value series of different bin widths on a grid of `cell_width_us` cells.
+
+    The grid starts at the epoch. A bin covers every cell it overlaps. When
+    several bins of a detector overlap a cell, the cell takes their smallest
+    p-value, Šidák-corrected for the number of bins (1 - (1 - p)^m), so a
+    detector with finer bins does not weigh more in the combination. A bin
+    wider than a cell gives its p-value to each cell it covers.
+
+    Args:
+        detector_names: The detector of each series.
+        series_starts: The start of each series, in microseconds since the epoch.
+        bin_widths_us: The bin width of each series, in microseconds.
+        series_lengths: The number of p-values of each series.
+        p_values: The p-values of all the series, concatenated.
+        cell_width_us: The width of the grid cells, in microseconds.
+    """
+    names, detectors = np.unique(np.asarray(detector_names, dtype=str), return_inverse=True)
+    series_lengths = np.asarray(series_lengths, dtype=np.int64)
+    p_values = np.clip(np.asarray(p_values, dtype=np.float64), MIN_P_VALUE, 1)
+
+    # one entry per bin: its detector, start and end
+    bin_series = np.repeat(np.arange(len(series_lengths)), series_lengths)
+    bin_numbers = np.arange(len(p_values)) - np.repeat(
+        np.cumsum(series_lengths) - series_lengths, series_lengths
+    )
+    widths = np.asarray(bin_widths_us, dtype=np.int64)[bin_series]
+    bin_starts = np.asarray(series_starts, dtype=np.int64)[bin_series] + bin_numbers * widths
+    first_cells = np.floor_divide(bin_starts, cell_width_us)
+    # the last cell holding part of the bin
+    last_cells = np.floor_divide(bin_starts + widths - 1, cell_width_us)
+
+    # one entry per (bin, cell) overlap
+    spans = last_cells - first_cells + 1
+    overlap_bins = np.repeat(np.arange(len(p_values)), spans)
+    overlap_cells = np.repeat(first_cells, spans) + (
+        np.arange(spans.sum()) - np.repeat(np.cumsum(spans) - spans, spans)
+    )
+    cells, cell_index = np.unique(overlap_cells, return_inverse=True)
+    overlap_detectors = detectors[bin_series[overlap_bins]]
+
+    smallest = np.full((len(names), len(cells)), np.inf)
+    np.minimum.at(smallest, (overlap_detectors, cell_index), p_values[overlap_bins])
+    counts = np.zeros((len(names), len(cells)), dtype=np.int64)
+    np.add.at(counts, (overlap_detectors, cell_index), 1)
+    # expm1 and log1p keep the precision of small p-values
+    with np.errstate(invalid="ignore"):
+        aligned = np.where(counts > 0, -np.expm1(counts * np.log1p(-smallest)), np.nan)
+    return AlignedPValues(cells * cell_width_us, cell_width_us, names, aligned)
+
+
+def _cache_path(cache_dir, engine, parameters, statement):
+    with engine.connect() as connection:
+        # rows added or removed since the cache was written change the key
+        fingerprint = connection.execute(
+            select(func.count(), func.max(SigTierArchive.id)).where(statement.whereclause)
+        ).one()
+    key = json.dumps([parameters, list(fingerprint), str(engine.url)], default=str)
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"sig_tier_aligned-{digest}.npz")
+
+
+def load_aligned_p_values(
+    engine,
+    cell_width: timedelta = timedelta(seconds=1),
+    start: datetime | None = None,
+    end: datetime | None = None,
+    is_test: bool | None = None,
+    cache_dir: str | None = None,
+    chunk_size: int = 10_000,
+) -> AlignedPValues:
+    """
+    Reads the p-value series of sig_tier_archive and aligns them on a common grid.
+
+    Each series starts at its message's machine_time_utc and holds bins of
+    t_bin_width_sec. Rows are streamed through a server-side cursor and the
+    p-values gathered into flat arrays, then aligned with `align_bins`.
+
+    With a `cache_dir`, the aligned arrays are saved there and reused by the
+    next call with the same arguments, as long as the selected rows have not
+    changed.
+
+    Args:
+        engine: The SQLAlchemy engine of the database.
+        cell_width: Width of the grid cells.
+        start: Only series starting at or after this time (naive UTC or timezone-aware).
+        end: Only series starting before this time.
+        is_test: Only test (True) or non-test (False) messages. Defaults to both.
+        cache_dir: Optional directory of the cached arrays.
+        chunk_size: Number of rows fetched from the server at a time.
+    """
+    start, end = (
+        None if moment is None else to_naive_utc(moment).replace(tzinfo=timezone.utc)
+        for moment in (start, end)
+    )
+    cell_width_us = cell_width // timedelta(microseconds=1)
+    statement = _sig_tier_query(start, end, is_test)
+
+    cache_path = None
+    if cache_dir is not None:
+        parameters = [cell_width_us, start, end, is_test]
+        cache_path = _cache_path(cache_dir, engine, parameters, statement)
+        if os.path.exists(cache_path):
+            log.info(f"Using the aligned p-values cached in {cache_path}")
+            return AlignedPValues.load(cache_path)
+
+    names, starts, widths, lengths, values = [], [], [], [], []
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=chunk_size).execute(
+            statement
+        )
+        for rows in result.partitions():
+            chunk_names, chunk_starts, chunk_widths, chunk_values = zip(*rows)
+            chunk_lengths = np.fromiter(map(len, chunk_values), np.int64, len(rows))
+            names.extend(chunk_names)
+            starts.append(np.array(chunk_starts, dtype=np.int64))
+            widths.append(np.rint(np.array(chunk_widths) * 1_000_000).astype(np.int64))
+            lengths.append(chunk_lengths)
+            values.append(
+                np.fromiter(
+                    itertools.chain.from_iterable(chunk_values),
+                    np.float64,
+                    int(chunk_lengths.sum()),
+                )
+            )
+    if not names:
+        aligned = AlignedPValues(
+            np.array([], dtype=np.int64), cell_width_us, np.array([], dtype=str), np.empty((0, 0))
+        )
+    else:
+        aligned = align_bins(
+            names,
+            np.concatenate(starts),
+            np.concatenate(widths),
+            np.concatenate(lengths),
+            np.concatenate(values),
+            cell_width_us,
+        )
+    log.info(
+        f"Aligned {len(names)} p-value series of {len(aligned.detector_names)} detectors "
+        f"on {len(aligned.cell_times)} cells"
+    )
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        aligned.save(cache_path)
+    return aligned
+
+
+def normal_sf(z):
+    """Survival function of the standard normal distribution, accurate to ~1e-7 relative."""
+    x = np.abs(np.asarray(z, dtype=np.float64)) / np.sqrt(2)
+    # erfc approximation of Numerical Recipes (erfcc), fractional error below 1.2e-7
+    t = 1 / (1 + 0.5 * x)
+    polynomial = -1.26551223 + t * (
+        1.00002368 + t * (
+            0.37409196 + t * (
+                0.09678418 + t * (
+                    -0.18628806 + t * (
+                        0.27886807 + t * (
+                            -1.13520398 + t * (1.48851587 + t * (-0.82215223 + t * 0.17087277))
+                        )
+                    )
+                )
+            )
+        )
+    )
+    erfc = t * np.exp(-x * x + polynomial)
+    return np.where(np.asarray(z) >= 0, 0.5 * erfc, 1 - 0.5 * erfc)
+
+
+# Coefficients of Acklam's approximation of the normal quantile (relative error 1.15e-9)
+_A = (-3.969683028665376e01, 2.209460984245205e02, -2.759285104469687e02,
+      1.383577518672690e02, -3.066479806614716e01, 2.506628277459239e00)
+_B = (-5.447609879822406e01, 1.615858368580409e02, -1.556989798598866e02,
+      6.680131188771972e01, -1.328068155288572e01)
+_C = (-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e00,
+      -2.549732539343734e00, 4.374664141464968e00, 2.938163982698783e00)
+_D = (7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e00,
+      3.754408661907416e00)
+
+
+def normal_isf(p):
+    """Inverse survival function of the standard normal distribution: the z of a p-value."""
+    p = np.asarray(p, dtype=np.float64)
+    # the lower tail quantile of q = min(p, 1 - p), mirrored for p > 0.5
+    q = np.clip(np.minimum(p, 1 - p), MIN_P_VALUE, 0.5)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = np.sqrt(-2 * np.log(q))
+        tail = (((((_C[0] * r + _C[1]) * r + _C[2]) * r + _C[3]) * r + _C[4]) * r + _C[5]) / (
+            (((_D[0] * r + _D[1]) * r + _D[2]) * r + _D[3]) * r + 1
+        )
+        s = q - 0.5
+        u = s * s
+        central = (
+            (((((_A[0] * u + _A[1]) * u + _A[2]) * u + _A[3]) * u + _A[4]) * u + _A[5]) * s
+        ) / (((((_B[0] * u + _B[1]) * u + _B[2]) * u + _B[3]) * u + _B[4]) * u + 1)
+    lower_quantile = np.where(q < 0.02425, tail, central)
+    return np.where(p <= 0.5, -lower_quantile, lower_quantile)
+
+
+def fisher(p_values: np.ndarray) -> np.ndarray:
+    """
+    Combines p-values with Fisher's method, along the first axis, ignoring NaN.
+
+    -2 sum(log p) follows a chi-square distribution with 2k degrees of
+    freedom for k p-values, whose survival function has the closed form
+    exp(-x/2) sum_{i<k} (x/2)^i / i!.
+    """
+    present = ~np.isnan(p_values)
+    k = present.sum(axis=0)
+    half_statistic = -np.where(present, np.log(np.clip(p_values, MIN_P_VALUE, 1)), 0).sum(axis=0)
+    term = np.exp(-half_statistic)
+    total = np.zeros_like(half_statistic)
+    for i in range(int(k.max(initial=0))):
+        total += np.where(i < k, term, 0)
+        term = term * half_statistic / (i + 1)
+    return np.where(k > 0, np.minimum(total, 1), np.nan)
+
+
+def stouffer(p_values: np.ndarray, weights: np.ndarray | None = None) -> np.ndarray:
+    """
+    Combines p-values with Stouffer's method, along the first axis, ignoring NaN.
+
+    Each p-value is turned into its normal z-score, and the combined p-value
+    is that of sum(w z) / sqrt(sum(w^2)).
+
+    Args:
+        p_values: The p-values, detectors along the first axis.
+        weights: Optional weight of each detector. Defaults to equal weights.
+    """
+    present = ~np.isnan(p_values)
+    if weights is None:
+        weights = np.ones(p_values.shape[0])
+    weights = np.where(present, np.asarray(weights, dtype=np.float64)[:, None], 0)
+    z = np.where(present, normal_isf(np.clip(p_values, MIN_P_VALUE, 1)), 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        combined = (weights * z).sum(axis=0) / np.sqrt((weights**2).sum(axis=0))
+    return np.where(present.any(axis=0), normal_sf(combined), np.nan)
+
+
+def combine_p_values(
+    aligned: AlignedPValues, method: str = "fisher", min_detectors: int = 2, weights=None
+) -> CombinedSignificance:
+    """
+    Computes the combined significance of the detectors in each cell of the grid.
+
+    Args:
+        aligned: The aligned p-values, as returned by `load_aligned_p_values`.
+        method: 'fisher' or 'stouffer'.
+        min_detectors: Cells with fewer detectors get a NaN p-value.
+        weights: Optional weight of each detector of `aligned.detector_names`,
+                 for Stouffer's method.
+
+    Raises:
+        ValueError: If the method is unknown.
+    """
+    if method not in COMBINATION_METHODS:
+        raise ValueError(f"Unknown combination method {method}, use one of {COMBINATION_METHODS}")
+    detector_counts = (~np.isnan(aligned.p_values)).sum(axis=0)
+    if method == "fisher":
+        combined = fisher(aligned.p_values)
+    else:
+        combined = stouffer(aligned.p_values, weights)
+    combined = np.where(detector_counts >= min_detectors, combined, np.nan)
+    return CombinedSignificance(aligned.cell_times, combined, detector_counts)
@@ -0,0 +1,242 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+from snews_db.db_operations import is_transient_error, to_naive_utc, write_messages_bulk
+from snews_db.decoding import dumps_json, loads_json
+
+# Setup logger
+log = logging.getLogger(__name__)
+
+
+class MessageSpool:
+    """
+    Append-only local store for messages that cannot reach the database yet.
+
+    While Postgres is unavailable the listener appends its messages here
+    instead of stopping, so consumption continues at Kafka speed and the
+    messages' offsets can advance: a spooled message is as durable as a
+    written one. Messages are kept as JSON in a SQLite file in WAL mode,
+    which survives crashes of the listener.
+
+    Once started, a background thread drains the spool into Postgres with
+    `write_messages_bulk`, `drain_batch_size` messages per transaction and
+    in arrival order, retrying every `retry_interval_s` seconds while the
+    database is down. Messages keep the time they were first received, and
+    those the database rejects are reported through `on_error`. While the
+    spool holds messages it is `active`, and writers should append new
+    messages to it rather than to the database.
+
+    A drain that fails for another reason than the database being
+    unavailable would fail again, so the spool stops draining, logs the
+    error and keeps its messages for the next run. It is then no longer
+    `active` and its `failure` is set: writers should not append to it.
+
+    Args:
+        path: The SQLite file of the spool, created if missing.
+        session_factory: A callable returning a new SQLAlchemy session, used
+                         to drain the spool.
+        drain_batch_size: Number of messages written per drain transaction.
+        retry_interval_s: Seconds between two drain attempts while the
+                          database is unavailable.
+        status_cache: Optional `LatestStatusCache` kept up to date with the
+                      heartbeats and retractions drained.
+        dead_letter: Whether drained messages the database rejects are
+                     stored in dead_letters.
+        metrics: Optional `ListenerMetrics` of the drain writes.
+        on_error: Called as `on_error(message, exception)` for every drained
+                  message the database rejects. Defaults to logging it.
+    """
+
+    def __init__(
+        self,
+        path,
+        session_factory=None,
+        drain_batch_size=1000,
+        retry_interval_s=5,
+        status_cache=None,
+        dead_letter=False,
+        metrics=None,
+        on_error=None,
+    ):
+        self.path = path
+        self.session_factory = session_factory
+        self.drain_batch_size = drain_batch_size
+        self.retry_interval_s = retry_interval_s
+        self.status_cache = status_cache
+        self.dead_letter = dead_letter
+        self.metrics = metrics
+        self.on_error = on_error or self._log_error
+        self.failure = None  # the error that stopped the drain, if it cannot be retried
+
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # in WAL mode NORMAL survives a crash of the process (not of the machine)
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS spooled_messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, received_time_utc TEXT, payload BLOB)"
+        )
+        self._lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._pending = self._connection.execute(
+            "SELECT count(*) FROM spooled_messages"
+        ).fetchone()[0]
+        self._closed = False
+        self._drainer = None
+        self.spooled = 0
+        self.drained = 0
+        self.drain_rate = 0.0  # messages per second of the last drain run
+        if self._pending:
+            log.warning(f"Spool {path} holds {self._pending} messages from a previous run")
+
+    @property
+    def active(self):
+        """Whether messages are waiting to be drained."""
+        return self._pending > 0 and self.failure is None
+
+    def __len__(self):
+        return self._pending
+
+    def size_bytes(self):
+        """Returns the size of the spool's files on disk."""
+        return sum(
+            os.path.getsize(self.path + suffix)
+            for suffix in ("", "-wal")
+            if os.path.exists(self.path + suffix)
+        )
+
+    def stats(self):
+        """Returns the pending, spooled and drained message counts, size and drain rate."""
+        return {
+            "pending": self._pending,
+            "spooled": self.spooled,
+            "drained": self.drained,
+            "size_bytes": self.size_bytes(),
+            "drain_rate_per_sec": self.drain_rate,
+        }
+
+    def append(self, messages, received_time_utc=None):
+        """
+        Stores messages durably, to be written to the database later.
+
+        Args:
+            messages: The message dicts, as accepted by `write_messages_bulk`.
+            received_time_utc: The time the messages were received. Defaults to now.
+        """
+        received = to_naive_utc(received_time_utc or datetime.now(timezone.utc)).isoformat()
+        rows = [(received, dumps_json(snews_message)) for snews_message in messages]
+        with self._lock:
+            with self._connection:
+                self._connection.execute("BEGIN")
+                self._connection.executemany(
+                    "INSERT INTO spooled_messages (received_time_utc, payload) VALUES (?, ?)", rows
+                )
+            was_empty = self._pending == 0
+            self._pending += len(rows)
+            self.spooled += len(rows)
+        if was_empty:
+            log.warning(f"Database unavailable, spooling messages to {self.path}")
+        with self._condition:
+            self._condition.notify_all()
+
+    def drain(self):
+        """
+        Writes the spooled messages to the database until the spool is empty.
+
+        Returns:
+            The number of messages drained.
+
+        Raises:
+            Exception: The error that stopped the drain, e.g. the database
+                       being still unavailable.
+        """
+        drained = 0
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                batch = self._connection.execute(
+                    "SELECT id, received_time_utc, payload FROM spooled_messages "
+                    "ORDER BY id LIMIT ?",
+                    (self.drain_batch_size,),
+                ).fetchall()
+            if not batch:
+                break
+            messages = [loads_json(payload) for _, _, payload in batch]
+            with self.session_factory() as session:
+                results = write_messages_bulk(
+                    session,
+                    messages,
+                    status_cache=self.status_cache,
+                    dead_letter=self.dead_letter,
+                    metrics=self.metrics,
+                    received_times=[
+                        datetime.fromisoformat(received) for _, received, _ in batch
+                    ],
+                )
+            # written and committed: forget them (drained twice after a crash, they are skipped)
+            with self._lock:
+                with self._connection:
+                    self._connection.execute("BEGIN")
+                    self._connection.execute(
+                        "DELETE FROM spooled_messages WHERE id <= ?", (batch[-1][0],)
+                    )
+                self._pending -= len(batch)
+                self.drained += len(batch)
+            for snews_message, error in zip(messages, results):
+                if error is not None:
+                    self.on_error(snews_message, error)
+            drained += len(batch)
+            self.drain_rate = drained / max(time.monotonic() - start, 1e-9)
+        if drained:
+            log.info(
+                f"Drained {drained} spooled messages into the database "
+                f"({self.drain_rate:.0f} msg/s)"
+            )
+        return drained
+
+    def start(self):
+        """Starts the background thread that drains the spool into the database."""
+        if self._drainer is None:
+            self._drainer = threading.Thread(
+                target=self._drain_when_pending, name="snews-db-spool", daemon=True
+            )
+            self._drainer.start()
+
+    def close(self):
+        """Stops the drain thread, leaving what is still spooled for the next run."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._drainer is not None:
+            self._drainer.join()
+            self._drainer = None
+        with self._lock:
+            self._connection.close()
+
+    def _drain_when_pending(self):
+        while True:
+            with self._condition:
+                while not self._closed and not self.active:
+                    self._condition.wait()
+                if self._closed:
+                    return
+            try:
+                self.drain()
+            except Exception as e:
+                if not is_transient_error(e):
+                    self.failure = e
+                    log.error(
+                        f"Stopped draining the spool {self.path}, which keeps "
+                        f"{self._pending} messages for the next run: {e}"
+                    )
+                    return
+                with self._condition:
+                    self._condition.wait(self.retry_interval_s)
+
+    @staticmethod
+    def _log_error(message, error):
+        log.error(f"Dropped spooled message {message.get('uuid')}: {error}")
@@ -0,0 +1,157 @@
+import json
+import os
+import pickle
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+from snews.models.messages import HeartbeatMessage, Tier, TimingTierMessage
+from snews_db.database.models import CachedHeartbeats, TimeTierArchive
+from snews_db.decoding import (
+    TIER_SCHEMAS,
+    TierField,
+    _parse_utc_text,
+    make_row_builder,
+    decode_payload,
+    decode_row,
+    parse_utc_datetime,
+    to_ns_offsets,
+)
+
+def recent_time(**offset):
+    moment = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(hours=1, **offset)
+    return moment.isoformat().replace("+00:00", "Z")
+
+def test_decode_pickled_model():
+    heartbeat = HeartbeatMessage(
+        detector_name="KamLAND", detector_status="ON", machine_time_utc=recent_time()
+    )
+    decoded = decode_payload(pickle.dumps(heartbeat))
+    assert decoded == heartbeat.model_dump()
+    assert decoded["tier"] is Tier.HEART_BEAT
+
+def test_decode_json():
+    message = {"tier": "Heartbeat", "uuid": "uuid-json", "detector_status": "OFF"}
+    assert decode_payload(json.dumps(message)) == message
+    assert decode_payload(json.dumps(message).encode()) == message
+    assert decode_payload(message) is message
+    assert decode_payload(json.dumps([1, 2])) is None
+    with pytest.raises(ValueError):
+        decode_payload(b"{not json")
+
+class Exploit:
+    def __reduce__(self):
+        return (os.system, ("echo unpickled",))
+
+def _short_unicode(text):
+    encoded = text.encode()
+    return b"\x8c" + bytes([len(encoded)]) + encoded
+
+def test_refuse_arbitrary_pickles():
+    with pytest.raises(pickle.UnpicklingError):
+        decode_payload(pickle.dumps(Exploit()))
+
+    # datetime.__builtins__.get("eval")(code), through an allowed module's attributes
+    code = "__import__('os').environ.__setitem__('SNEWS_DB_UNPICKLED', '1')"
+    payload = (
+        b"\x80\x04"
+        + _short_unicode("datetime")
+        + _short_unicode("__builtins__.get")
+        + b"\x93"  # STACK_GLOBAL
+        + _short_unicode("eval")
+        + b"\x85R"  # TUPLE1, REDUCE
+        + _short_unicode(code)
+        + b"\x85R."
+    )
+    with pytest.raises(pickle.UnpicklingError):
+        decode_payload(payload)
+    assert "SNEWS_DB_UNPICKLED" not in os.environ
+    for module, name in [("datetime", "sys"), ("snews.models.messages", "create_messages")]:
+        with pytest.raises(pickle.UnpicklingError):
+            decode_payload(b"\x80\x04" + _short_unicode(module) + _short_unicode(name) + b"\x93.")
+
+def test_decode_pickle_protocols():
+    heartbeat = HeartbeatMessage(
+        detector_name="KamLAND", detector_status="ON", machine_time_utc=recent_time()
+    )
+    for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+        assert decode_payload(pickle.dumps(heartbeat, protocol=protocol)) == heartbeat.model_dump()
+
+def test_decode_row():
+    neutrino_time = recent_time(seconds=5)
+    timing = TimingTierMessage(
+        detector_name="IceCube",
+        machine_time_utc=recent_time(),
+        neutrino_time_utc=neutrino_time,
+        start_time_utc=neutrino_time,
+        timing_series=[0, 1_500, 2_000_000],
+    )
+    received = datetime(2024, 1, 1)
+    schema, values = decode_row(decode_payload(pickle.dumps(timing)), received)
+    assert schema.model_class is TimeTierArchive
+    row = dict(zip(schema.columns, values))
+    assert row["message_uuid"] == timing.uuid
+    assert row["received_time_utc"] == received
+    assert row["neutrino_time_utc"] == datetime.fromisoformat(neutrino_time)
+    assert row["timing_series"] == [0, 1_500, 2_000_000]
+
+    schema, values = decode_row(
+        {"tier": "Heartbeat", "id": "hb", "uuid": "uuid-hb", "detector_name": "KamLAND",
+         "machine_time": "2024-01-01T00:00:00.123456789Z", "detector_status": "ON",
+         "is_test": True},
+        received,
+    )
+    assert schema.model_class is CachedHeartbeats
+    assert values[4] == datetime(2024, 1, 1, 0, 0, 0, 123456, tzinfo=timezone.utc)
+    with pytest.raises(ValueError):
+        decode_row({"tier": "Unknown"}, received)
+
+def test_parse_utc_datetime_cache():
+    _parse_utc_text.cache_clear()
+    first = parse_utc_datetime("2024-01-01T00:00:00.5Z", "machine_time_utc")
+    again = parse_utc_datetime("2024-01-01T00:00:00.5Z", "machine_time_utc")
+    assert first is again
+    assert first == datetime(2024, 1, 1, 0, 0, 0, 500000, tzinfo=timezone.utc)
+    assert _parse_utc_text.cache_info().hits == 1
+    assert parse_utc_datetime("2024-01-01T01:00:00+01:00", "x") == datetime(
+        2024, 1, 1, tzinfo=timezone.utc
+    )
+    with pytest.raises(ValueError):
+        parse_utc_datetime("not a time", "machine_time_utc")
+
+def test_timestamp_series_offsets():
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    # UTC timestamps are converted as a datetime64[ns] array, keeping nanoseconds
+    assert to_ns_offsets(
+        ["2024-01-01T00:00:00.000000001Z", "2024-01-01T00:00:01.5"], start
+    ) == [1, 1_500_000_000]
+    assert to_ns_offsets(
+        np.array(["2024-01-01T00:00:02"], dtype="datetime64[ns]"), start
+    ) == [2_000_000_000]
+    # explicit offsets go through the per-value path
+    assert to_ns_offsets(["2024-01-01T01:00:00.000001+01:00"], start) == [1_000]
+    assert to_ns_offsets(np.array([0, 1_500]), None) == [0, 1_500]
+    with pytest.raises(ValueError):
+        to_ns_offsets(["2024-01-01T00:00:01Z"], None)
+    with pytest.raises(ValueError):
+        to_ns_offsets(["2024-01-01T00:00:01Z", "bogus"], start)
+
+def test_make_row_builder():
+    build = make_row_builder(
+        (
+            TierField("received_time_utc"),
+            TierField("time", ("time", "legacy_time"), convert=int),
+            TierField("start", ("start",), required=False, default="time"),
+            TierField("shifted", ("shift",), convert=lambda shift, start: start + shift,
+                      reference="start"),
+        )
+    )
+    assert build({"legacy_time": "7", "shift": 1}, "now") == ("now", 7, 7, 8)
+    assert build({"time": 1, "start": 5, "shift": 1}, "now") == ("now", 1, 5, 6)
+    with pytest.raises(ValueError, match="No time key"):
+        build({"shift": 1}, "now")
+    with pytest.raises(ValueError):
+        make_row_builder((TierField("shifted", ("shift",), reference="start"),))
+    # every tier's builder yields one value per column
+    for schema in TIER_SCHEMAS.values():
+        assert len(schema.fields) == len(schema.columns)
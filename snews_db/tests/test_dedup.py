@@ -0,0 +1,25 @@
+from snews_db.dedup import RecentMessageCache
+
+def test_check_and_add():
+    cache = RecentMessageCache(capacity=10)
+    assert cache.check_and_add(("Heartbeat", "uuid-1")) is False
+    assert cache.check_and_add(("Heartbeat", "uuid-1")) is True
+    # same uuid in another tier is a different message
+    assert cache.check_and_add(("TimingTier", "uuid-1")) is False
+    assert len(cache) == 2
+
+def test_least_recently_seen_key_is_evicted():
+    cache = RecentMessageCache(capacity=2)
+    cache.check_and_add("a")
+    cache.check_and_add("b")
+    cache.check_and_add("a")  # refreshes "a"
+    cache.check_and_add("c")  # evicts "b"
+    assert "a" in cache and "c" in cache
+    assert "b" not in cache
+
+def test_discard():
+    cache = RecentMessageCache()
+    cache.check_and_add("a")
+    cache.discard("a")
+    cache.discard("never-added")
+    assert cache.check_and_add("a") is False
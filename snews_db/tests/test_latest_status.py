@@ -0,0 +1,32 @@
+from datetime import datetime
+
+from snews_db.latest_status import LatestStatusCache
+
+def status(detector_name, second, detector_status="ON"):
+    return {
+        "detector_name": detector_name,
+        "detector_status": detector_status,
+        "received_time_utc": datetime(2024, 1, 1, 0, 0, second),
+    }
+
+def test_keeps_latest_status_per_detector():
+    cache = LatestStatusCache()
+    assert cache.update(status("DetectorA", 1))
+    assert cache.update(status("DetectorB", 1))
+    assert cache.update(status("DetectorA", 2, "OFF"))
+    assert cache.get("DetectorA")["detector_status"] == "OFF"
+    assert len(cache) == 2
+    assert cache.get("DetectorC") is None
+
+def test_ignores_older_status():
+    cache = LatestStatusCache()
+    cache.update(status("DetectorA", 5, "OFF"))
+    assert not cache.update(status("DetectorA", 4, "ON"))
+    assert cache.get("DetectorA")["detector_status"] == "OFF"
+
+def test_snapshot_is_a_copy():
+    cache = LatestStatusCache()
+    cache.update(status("DetectorA", 1))
+    snapshot = cache.snapshot()
+    snapshot["DetectorA"]["detector_status"] = "OFF"
+    assert cache.get("DetectorA")["detector_status"] == "ON"
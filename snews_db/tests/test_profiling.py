@@ -0,0 +1,66 @@
+import pstats
+import time
+
+import pytest
+from snews_db.metrics import ListenerMetrics
+from snews_db.profiling import IngestProfiler
+
+def busy_ingest(seconds):
+    deadline = time.perf_counter() + seconds
+    total = 0
+    while time.perf_counter() < deadline:
+        total += sum(range(100))
+    return total
+
+def test_sampling_profile(tmp_path):
+    metrics = ListenerMetrics()
+    # observed before the profile starts, so not part of it
+    metrics.stage_duration.observe(1.0, stage="insert")
+    profiler = IngestProfiler(
+        str(tmp_path / "profiles" / "ingest"), messages=3, metrics=metrics, interval_s=0.001
+    )
+    assert not profiler.record()
+    profiler.start()
+    for _ in range(2):
+        busy_ingest(0.05)
+        metrics.stage_duration.observe(0.002, stage="insert")
+        assert not profiler.record()
+    busy_ingest(0.05)
+    assert profiler.record()
+    assert not profiler.active
+    # stopped for good: neither recording nor restarting profiles again
+    assert not profiler.record()
+    profiler.start()
+    assert not profiler.active
+
+    folded_path, summary_path = profiler.report_paths
+    assert folded_path.endswith("ingest.folded")
+    with open(folded_path) as f:
+        stacks = [line.rsplit(" ", 1) for line in f.read().splitlines()]
+    busy = [stack for stack, count in stacks if "busy_ingest (test_profiling.py" in stack]
+    assert busy and all(stack.startswith("MainThread;") for stack in busy)
+    assert all(int(count) > 0 for _, count in stacks)
+    with open(summary_path) as f:
+        summary = f.read()
+    assert summary.startswith("Profile of 3 messages")
+    assert "insert            2      0.004      2.000" in summary
+    assert "busy_ingest (test_profiling.py" in summary
+
+def test_cprofile_profile(tmp_path):
+    profiler = IngestProfiler(str(tmp_path / "ingest"), messages=10, mode="cprofile")
+    profiler.start()
+    busy_ingest(0.01)
+    # stopped before enough messages were recorded, e.g. on shutdown
+    assert profiler.stop()
+    assert not profiler.stop()
+
+    profile_path, summary_path = profiler.report_paths
+    stats = pstats.Stats(profile_path)
+    assert any(name == "busy_ingest" for _, _, name in stats.stats)
+    with open(summary_path) as f:
+        summary = f.read()
+    assert summary.startswith("Profile of 0 messages")
+    assert "busy_ingest" in summary
+
+    with pytest.raises(ValueError):
+        IngestProfiler(str(tmp_path / "ingest"), mode="perf")
@@ -0,0 +1,136 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import click
+
+# Setup logger
+log = logging.getLogger(__name__)
+
+
+def _report_progress(worker_id, listener, reports, interval_s):
+    while True:
+        time.sleep(interval_s)
+        reports.put(
+            {
+                "worker": worker_id,
+                "handled": listener.handled,
+                "write_errors": listener.write_errors,
+                "partitions": list(listener.assigned_partitions),
+                "spooled": len(listener.spool) if listener.spool is not None else 0,
+                "time": time.monotonic(),
+            }
+        )
+
+
+def _run_worker(worker_id, listener_class, listener_options, reports, interval_s):
+    if listener_options.get("spool_path") is not None:
+        # one spool per worker; a restarted worker drains what its predecessor left
+        root, extension = os.path.splitext(listener_options["spool_path"])
+        listener_options = dict(listener_options, spool_path=f"{root}-{worker_id}{extension}")
+    if listener_options.get("profile_path") is not None:
+        listener_options = dict(
+            listener_options, profile_path=f"{listener_options['profile_path']}-{worker_id}"
+        )
+    if listener_options.get("metrics_port") is not None:
+        # one metrics endpoint per worker, on consecutive ports
+        listener_options = dict(
+            listener_options, metrics_port=listener_options["metrics_port"] + worker_id
+        )
+    listener = listener_class(**listener_options)
+    if interval_s:
+        threading.Thread(
+            target=_report_progress,
+            args=(worker_id, listener, reports, interval_s),
+            name="snews-db-progress",
+            daemon=True,
+        ).start()
+    try:
+        listener.run_db_listener()
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(listener_class, listener_options, workers, stats_interval_s=60):
+    """
+    Runs several listeners in separate processes, as members of one Kafka consumer group.
+
+    Kafka spreads the partitions of the observation topic over the workers
+    and reassigns them when a worker starts or stops. Each worker writes
+    the messages it read from a partition and commits its offsets before
+    giving the partition up, so a reassignment neither loses nor repeats
+    writes. Every `stats_interval_s` seconds the messages handled per
+    second, write errors and assigned partitions of each worker are
+    printed (0 disables the reports).
+
+    Args:
+        listener_class: DBKafkaListener or a subclass, instantiated in each worker.
+        listener_options: Keyword arguments of the listener; 'group_id' is required.
+        workers: Number of worker processes.
+        stats_interval_s: Seconds between two throughput reports.
+    """
+    if listener_options.get("group_id") is None:
+        raise ValueError("workers need a consumer group id to share the topic's partitions")
+    # spawn, so no worker inherits Kafka or database connections
+    context = multiprocessing.get_context("spawn")
+    reports = context.Queue()
+    processes = [
+        context.Process(
+            target=_run_worker,
+            args=(n, listener_class, listener_options, reports, stats_interval_s),
+            name=f"snews-db-worker-{n}",
+        )
+        for n in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    previous = {}
+    latest = {}
+    exited = set()
+    next_report = time.monotonic() + stats_interval_s if stats_interval_s else float("inf")
+    try:
+        while any(process.is_alive() for process in processes):
+            try:
+                progress = reports.get(timeout=1)
+                latest[progress["worker"]] = progress
+            except queue.Empty:
+                pass
+            for worker_id, process in enumerate(processes):
+                if not process.is_alive() and worker_id not in exited:
+                    exited.add(worker_id)
+                    click.secho(
+                        f"{datetime.utcnow().isoformat()} worker {worker_id} exited "
+                        f"with code {process.exitcode}, its partitions go to the others",
+                        fg="red",
+                    )
+            if time.monotonic() < next_report:
+                continue
+            next_report += stats_interval_s
+            for worker_id, progress in sorted(latest.items()):
+                before = previous.get(worker_id)
+                rate = 0.0
+                if before is not None and progress["time"] > before["time"]:
+                    rate = (progress["handled"] - before["handled"]) / (
+                        progress["time"] - before["time"]
+                    )
+                click.secho(
+                    f"{datetime.utcnow().isoformat()} worker {worker_id} "
+                    f"(pid {processes[worker_id].pid}) partitions {progress['partitions']}: "
+                    f"{rate:.1f} msg/s, {progress['handled']} messages, "
+                    f"{progress['write_errors']} write errors, "
+                    f"{progress['spooled']} spooled"
+                )
+            previous = dict(latest)
+    except KeyboardInterrupt:
+        # the workers got the interrupt too; let them write what they hold and leave the group
+        pass
+    finally:
+        for process in processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()